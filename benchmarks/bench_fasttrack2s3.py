@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+
+
+# Time and memory-profile the fasttrack2s3.py filter modes against synthetic
+# abcd_fastqc01.txt files and append the results to a JSON history, so that
+# regressions in the filter hot paths show up between commits.
+
+
+# imports
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from logging import debug, info, warning, error, critical
+from pathlib import Path
+
+HERE = Path(__file__).parent.absolute()
+sys.path.insert(0, str(HERE.parent))
+
+from fasttrack2s3 import LOG_FORMAT, LOG_LEVELS
+from synthetic_fastqc import write_synthetic
+from utilities import available, writable
+
+
+# constants
+FASTTRACK2S3 = HERE.parent / 'fasttrack2s3.py'
+
+# every mode's extra fasttrack2s3.py options, {pids} and {csv} are filled in
+MODES = {
+    'plain': [],
+    'csv': ['-csv', '{csv}'],
+    'pid': ['-ptxt', '{pids}'],
+    'sep': ['-sep'],
+    'multi-datatype': ['-d', 'all-anat', 'only-task-rest', 'all-qa'],
+    'chunk': ['-chunk', '100000'],
+    'cache': ['-cache'],
+    'compact': ['-compact'],
+}
+
+# the share of participants picked for the -csv and -ptxt modes
+SAMPLE_FRACTION = 0.1
+
+# slowdowns against the last matching history entry worth a warning
+REGRESSION_RATIO = 1.2
+
+
+def git_commit():
+    # describe the checked out commit of this repository, if any
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE.parent,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_samples(qc_input, work_dir, seed):
+    # write -ptxt and -csv files for a sample of the synthetic participants
+    pairs = set()
+    with open(qc_input, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        next(reader)
+        next(reader)
+        for row in reader:
+            pairs.add((row[3], 'ses-' + row[8]))
+
+    rng = random.Random(seed)
+    participants = sorted(set(pid for pid, _ in pairs))
+    sample = set(rng.sample(participants, max(1, int(len(participants) * SAMPLE_FRACTION))))
+
+    pids = work_dir / f"{qc_input.stem}_pids.txt"
+    with open(pids, 'w') as f:
+        for pid in sorted(sample):
+            f.write(f"{pid}\n")
+
+    sessions = work_dir / f"{qc_input.stem}_sessions.csv"
+    with open(sessions, 'w') as f:
+        for pid, ses in sorted(pairs):
+            if pid in sample:
+                f.write(f"{pid},{ses}\n")
+
+    return pids, sessions
+
+
+def run_mode(qc_input, output_dir, options):
+    # run fasttrack2s3.py once, returning its wall time and peak RSS
+    command = [sys.executable, str(FASTTRACK2S3), str(qc_input), str(output_dir), '-l', 'ERROR'] + options
+    debug(command)
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    if returncode != 0:
+        raise RuntimeError(f"fasttrack2s3.py failed with exit code {returncode}: {' '.join(command)}")
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    return seconds, usage.ru_maxrss * scale / 1024 ** 2
+
+
+def read_history(history):
+    if history.exists():
+        with open(history, 'r') as f:
+            return json.load(f)
+
+    return []
+
+
+def last_result(history, rows, mode):
+    # the latest earlier result for the same table size and mode
+    for result in reversed(history):
+        if result['rows'] == rows and result['mode'] == mode:
+            return result
+
+    return None
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="Benchmark the fasttrack2s3.py filter modes on synthetic "
+                    "abcd_fastqc01.txt files and record the results.")
+
+    parser.add_argument('-n', '--rows', nargs='+', type=int, default=[10000, 100000, 1000000],
+                        metavar='ROWS',
+                        help="The space-separated synthetic table sizes. "
+                            "Defaults to 10000 100000 1000000.")
+
+    parser.add_argument('-m', '--modes', nargs='+', default=list(MODES.keys()),
+                        choices=list(MODES.keys()), metavar='MODE',
+                        help="The space-separated modes to benchmark. Defaults to all.\n"
+                            "Options are:\n"
+                            f"    {', '.join(MODES.keys())}")
+
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="Runs per size and mode, the fastest one is "
+                            "recorded. Defaults to 3.")
+
+    parser.add_argument('-w', '--work-dir', type=writable, default=None, metavar='DIR',
+                        help="Where to keep the synthetic tables between runs. "
+                            "Defaults to a temporary directory that is removed "
+                            "afterwards.")
+
+    parser.add_argument('-o', '--history', type=available,
+                        default=HERE / 'bench_history.json', metavar='FILE',
+                        help="The JSON history file to append results to. "
+                            "Defaults to bench_history.json next to this script.")
+
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help="The random seed for the synthetic tables. Defaults to 0.")
+
+    parser.add_argument('-l', '--log-level', metavar='LEVEL',
+                        choices=LOG_LEVELS, default='INFO',
+                        help="Set the minimum logging level. Defaults to INFO.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+
+    logging.basicConfig(format=LOG_FORMAT, level=getattr(logging, args.log_level))
+    debug(args)
+
+    if args.repeat < 1:
+        raise ValueError(f"Invalid number of repeats: {args.repeat}")
+
+    if args.work_dir is None:
+        work_dir = Path(tempfile.mkdtemp(prefix='bench_fasttrack2s3_'))
+    else:
+        work_dir = args.work_dir
+
+    history = read_history(args.history)
+    commit = git_commit()
+    stamp = datetime.now().isoformat(timespec='seconds')
+
+    try:
+        for rows in args.rows:
+            # synthetic tables are kept and reused per size and seed
+            qc_input = work_dir / f"synthetic_n-{rows}_seed-{args.seed}_fastqc01.txt"
+            if not qc_input.exists():
+                info(f"Writing a {rows} row synthetic table to {qc_input}")
+                write_synthetic(qc_input, rows, seed=args.seed)
+
+            pids, sessions = write_samples(qc_input, work_dir, args.seed)
+
+            for mode in args.modes:
+                options = [option.format(pids=pids, csv=sessions) for option in MODES[mode]]
+                best = None
+
+                for _ in range(args.repeat):
+                    output_dir = Path(tempfile.mkdtemp(prefix='output_', dir=work_dir))
+                    try:
+                        seconds, max_rss_mb = run_mode(qc_input, output_dir, options)
+                    finally:
+                        shutil.rmtree(output_dir)
+
+                    if best is None or seconds < best[0]:
+                        best = (seconds, max_rss_mb)
+
+                result = {
+                    'time': stamp,
+                    'commit': commit,
+                    'rows': rows,
+                    'mode': mode,
+                    'options': MODES[mode],
+                    'seconds': round(best[0], 4),
+                    'max_rss_mb': round(best[1], 1),
+                    'python': platform.python_version(),
+                    'host': platform.node(),
+                }
+
+                previous = last_result(history, rows, mode)
+                if previous is not None and result['seconds'] > previous['seconds'] * REGRESSION_RATIO:
+                    warning(f"{mode} on {rows} rows took {result['seconds']}s, "
+                            f"up from {previous['seconds']}s at {previous['commit']}")
+
+                info(f"{mode:>15} {rows:>9} rows {result['seconds']:>9.3f}s {result['max_rss_mb']:>9.1f} MB")
+                history.append(result)
+
+    finally:
+        # keep whatever finished even if a later run failed
+        with open(args.history, 'w') as f:
+            json.dump(history, f, indent=4)
+
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+
+
+# Compare the pipeline.py unpack_tgz engines, both per TGZ (one unpacking at a
+# time) and per node (as many concurrent unpackings as workers), on real or
+# synthetic TGZs, and append the results to a JSON history.
+
+
+# imports
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from logging import debug, info, warning, error, critical
+from pathlib import Path
+
+HERE = Path(__file__).parent.absolute()
+sys.path.insert(0, str(HERE.parent))
+
+from bench_fasttrack2s3 import git_commit, read_history
+from pipeline import LOG_FORMAT, LOG_LEVELS, unpack_tgz
+from utilities import available, readable, writable
+
+
+# constants
+ENGINES = ['pigz', 'igzip', 'gzip', 'python']
+
+
+def write_synthetic_tgz(tgz_file, n_files, file_kb, seed):
+    # a func run worth of same-sized DICOM-like files: a shared header, a
+    # mostly empty image, and some noise, which compresses about as well
+    rng = random.Random(seed)
+    header = bytes(rng.getrandbits(8) for _ in range(4096))
+    run = 'sub-NDARINVSYNTHETC/ses-baselineYear1Arm1/func/ABCD-rsfMRI-run-01'
+
+    with tarfile.open(tgz_file, 'w:gz') as tar:
+        for i in range(n_files):
+            body = header + bytes(max(0, file_kb * 1024 - 4096 - 1024)) + os.urandom(1024)
+            member = tarfile.TarInfo(f'{run}/synthetic_dicom{i + 1:06d}.dcm')
+            member.size = len(body)
+            member.mtime = time.time()
+            tar.addfile(member, fileobj=io.BytesIO(body))
+
+
+def unpacked_bytes(tgz_file):
+    with tarfile.open(tgz_file, 'r:gz') as tar:
+        return sum(member.size for member in tar.getmembers() if member.isfile())
+
+
+def timed_unpack(tgz_file, output_dir, engine):
+    start = time.perf_counter()
+    unpack_tgz(tgz_file, output_dir, engine)
+    return time.perf_counter() - start
+
+
+def available_engines():
+    return [engine for engine in ENGINES if engine == 'python' or shutil.which(engine) is not None]
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="Benchmark the pipeline.py unpack_tgz engines per TGZ and per node.")
+
+    parser.add_argument('-i', '--tgz', nargs='+', type=readable, default=None, metavar='TGZ',
+                        help="The space-separated TGZs to unpack. Defaults to one "
+                            "synthetic TGZ of a func run's worth of DICOMs.")
+
+    parser.add_argument('-e', '--engines', nargs='+', choices=ENGINES, default=None, metavar='ENGINE',
+                        help="The space-separated engines to compare. Defaults to "
+                            "every installed one.\n"
+                            "Options are:\n"
+                            f"    {', '.join(ENGINES)}")
+
+    parser.add_argument('-f', '--synthetic-files', type=int, default=3000, metavar='COUNT',
+                        help="The number of DICOM-like files in the synthetic TGZ. Defaults to 3000.")
+
+    parser.add_argument('-k', '--synthetic-kb', type=int, default=120, metavar='KB',
+                        help="The size of every synthetic DICOM-like file. Defaults to 120.")
+
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help="The number of concurrent unpackings for the per node "
+                            "throughput. Defaults to the number of CPUs.")
+
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="Runs per TGZ and engine, the fastest one is recorded. Defaults to 3.")
+
+    parser.add_argument('-w', '--work-dir', type=writable, default=None, metavar='DIR',
+                        help="Where to unpack. Use the scratch filesystem the "
+                            "pipeline runs on. Defaults to a temporary directory.")
+
+    parser.add_argument('-o', '--history', type=available,
+                        default=HERE / 'bench_unpack_history.json', metavar='FILE',
+                        help="The JSON history file to append results to. "
+                            "Defaults to bench_unpack_history.json next to this script.")
+
+    parser.add_argument('-l', '--log-level', metavar='LEVEL',
+                        choices=LOG_LEVELS, default='INFO',
+                        help="Set the minimum logging level. Defaults to INFO.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+
+    logging.basicConfig(format=LOG_FORMAT, level=getattr(logging, args.log_level))
+    debug(args)
+
+    if args.repeat < 1 or args.workers < 1:
+        raise ValueError(f"Invalid number of repeats or workers: {args.repeat}, {args.workers}")
+
+    engines = args.engines if args.engines is not None else available_engines()
+    for engine in engines:
+        if engine != 'python' and shutil.which(engine) is None:
+            raise ValueError(f"The {engine} engine is not installed")
+
+    work_dir = Path(tempfile.mkdtemp(prefix='bench_unpack_', dir=args.work_dir))
+    history = read_history(args.history)
+    commit = git_commit()
+    stamp = datetime.now().isoformat(timespec='seconds')
+
+    try:
+        if args.tgz is None:
+            tgz_files = [work_dir / 'synthetic.tgz']
+            info(f"Writing a synthetic TGZ of {args.synthetic_files} files of {args.synthetic_kb} KB")
+            write_synthetic_tgz(tgz_files[0], args.synthetic_files, args.synthetic_kb, seed=0)
+        else:
+            tgz_files = args.tgz
+
+        for tgz_file in tgz_files:
+            megabytes = unpacked_bytes(tgz_file) / 1024 ** 2
+            compressed = os.path.getsize(tgz_file) / 1024 ** 2
+
+            for engine in engines:
+                # one unpacking at a time
+                best = None
+                for i in range(args.repeat):
+                    output_dir = work_dir / f'{engine}_{i}'
+                    seconds = timed_unpack(tgz_file, output_dir, engine)
+                    shutil.rmtree(output_dir)
+                    best = seconds if best is None else min(best, seconds)
+
+                # as many concurrent unpackings as workers
+                output_dirs = [work_dir / f'{engine}_node_{i}' for i in range(args.workers)]
+                start = time.perf_counter()
+                with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                    list(executor.map(timed_unpack, [tgz_file] * args.workers, output_dirs,
+                                      [engine] * args.workers))
+                node_seconds = time.perf_counter() - start
+                for output_dir in output_dirs:
+                    shutil.rmtree(output_dir)
+
+                result = {
+                    'time': stamp,
+                    'commit': commit,
+                    'tgz': Path(tgz_file).name,
+                    'compressed_mb': round(compressed, 1),
+                    'unpacked_mb': round(megabytes, 1),
+                    'engine': engine,
+                    'seconds': round(best, 4),
+                    'tgz_mb_per_second': round(megabytes / best, 1),
+                    'workers': args.workers,
+                    'node_seconds': round(node_seconds, 4),
+                    'node_mb_per_second': round(megabytes * args.workers / node_seconds, 1),
+                    'python': platform.python_version(),
+                    'host': platform.node(),
+                }
+
+                info(f"{engine:>7} {Path(tgz_file).name}: {result['tgz_mb_per_second']:>8.1f} MB/s per TGZ, "
+                     f"{result['node_mb_per_second']:>8.1f} MB/s per node with {args.workers} workers")
+                history.append(result)
+
+    finally:
+        with open(args.history, 'w') as f:
+            json.dump(history, f, indent=4)
+
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+
+
+# Write a synthetic NDA-formatted abcd_fastqc01.txt for benchmarking and
+# testing fasttrack2s3.py without the real NDA file. Every participant gets
+# one scanner vendor, a subset of the SESSIONS with follow-up attrition, and
+# about one session's worth of series per session, including repeated runs,
+# QA series, and series types outside of DATATYPES.
+
+
+# imports
+import argparse
+import csv
+import logging
+import random
+import string
+import sys
+
+from logging import debug, info, warning, error, critical
+from pathlib import Path
+
+HERE = Path(__file__).parent.absolute()
+sys.path.insert(0, str(HERE.parent))
+
+from fasttrack2s3 import DATATYPES, LOG_FORMAT, LOG_LEVELS, SESSIONS
+from utilities import available
+
+
+# constants
+HEADER = [
+    ('collection_id', 'collection_id'),
+    ('abcd_fastqc01_id', 'abcd_fastqc01_id'),
+    ('dataset_id', 'dataset_id'),
+    ('subjectkey', 'The NDAR Global Unique Identifier (GUID) for research subject'),
+    ('src_subject_id', 'Subject ID how it\'s defined in lab/project'),
+    ('interview_date', 'Date on which the interview/genetic test/sampling/imaging/biospecimen was completed. MM/DD/YYYY'),
+    ('interview_age', 'Age in months at the time of the interview/test/sampling/imaging.'),
+    ('sex', 'Sex of subject at birth'),
+    ('eventname', 'The event name for which the data was collected'),
+    ('visit', 'Visit name'),
+    ('file_source', 'File source'),
+    ('ftq_series_id', 'Series ID'),
+    ('ftq_complete', 'Complete'),
+    ('ftq_usable', 'Usable'),
+    ('ftq_notes', 'Notes'),
+    ('ftq_quality', 'Quality'),
+]
+
+VENDORS = ['SIEMENS', 'GE', 'Philips']
+
+# how many times each series type is usually acquired in one session
+REPEATS = {
+    'ABCD-rsfMRI': 4,
+    'ABCD-MID-fMRI': 2,
+    'ABCD-nBack-fMRI': 2,
+    'ABCD-SST-fMRI': 2,
+    'ABCD-fMRI-FM': 2,
+}
+
+# series types the DATATYPES filters never select
+OTHER_TYPES = ['ABCD-localizer', 'ABCD-ASL']
+QA_TYPES = ['ABCD-T1-QA', 'ABCD-rsfMRI-QA', 'ABCD-DTI-QA']
+
+# the share of participants still scanned at each later session
+RETENTION = 0.85
+
+S3_PREFIX = 's3://NDAR_Central_4/submission_{submission}/'
+GUID_CHARACTERS = ''.join(c for c in string.ascii_uppercase + string.digits if c not in 'IOQS')
+
+
+def series_types():
+    # every "_TYPE_" DATATYPES entry, plus the QA and other series types
+    types = set()
+    for datatype in DATATYPES.values():
+        for t in datatype['types']:
+            if t.startswith('_'):
+                types.add(t.strip('_'))
+
+    return sorted(types) + QA_TYPES + OTHER_TYPES
+
+
+def session_protocol(rng, types):
+    # one session's series types, dropping and repeating some at random
+    protocol = []
+    for series_type in types:
+        if rng.random() < 0.1:
+            continue
+
+        repeats = REPEATS.get(series_type, 1)
+        if rng.random() < 0.05:
+            repeats += 1
+
+        protocol += [series_type] * repeats
+
+    return protocol
+
+
+def synthetic_rows(rows, participants, seed):
+    # yield the rows of a synthetic fastqc table, stopping after rows rows
+    rng = random.Random(seed)
+    types = series_types()
+    count = 0
+    pid_number = 0
+
+    while count < rows:
+        if participants is not None and pid_number >= participants:
+            break
+
+        pid_number += 1
+        guid = 'NDAR_INV' + ''.join(rng.choice(GUID_CHARACTERS) for _ in range(8))
+        vendor = rng.choice(VENDORS)
+        sex = rng.choice(['F', 'M'])
+        age = rng.randint(108, 131)
+
+        for s, session in enumerate(SESSIONS):
+            if s > 0 and rng.random() > RETENTION ** s:
+                break
+
+            eventname = session[len('ses-'):]
+            year = 2017 + 2 * s
+            date = f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{year}"
+
+            for series_type in session_protocol(rng, types):
+                if count >= rows:
+                    return
+
+                series_id = f"{guid.replace('_', '')}_{eventname}_{series_type}_{vendor}_{year}{rng.randrange(10**10):010d}"
+                prefix = S3_PREFIX.format(submission=rng.randint(1, 40))
+
+                complete = '1' if rng.random() < 0.95 else '0'
+                usable = '1' if complete == '1' and rng.random() < 0.9 else '0'
+                notes = rng.choice(['', '', '', 'ok', 'motion, "severe"'])
+
+                yield [
+                    '2573', str(count + 1), str(rng.randint(1, 99999)), guid, guid,
+                    date, str(age + 24 * s), sex, eventname, '',
+                    f"{prefix}{series_id}.tgz", series_id,
+                    complete, usable, notes, str(rng.randint(0, 3)),
+                ]
+
+                count += 1
+
+
+def write_synthetic(output, rows, participants=None, seed=0):
+    """
+    Write a synthetic NDA-formatted abcd_fastqc01.txt
+    :param output: Path of the file to write
+    :param rows: Maximum number of series rows, after the description row
+    :param participants: Maximum number of participants, or None for as many as rows needs
+    :param seed: Random seed, the same seed always writes the same file
+    :return: Number of series rows written
+    """
+    count = 0
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow([column for column, _ in HEADER])
+        writer.writerow([description for _, description in HEADER])
+
+        for row in synthetic_rows(rows, participants, seed):
+            writer.writerow(row)
+            count += 1
+
+    return count
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="Write a synthetic NDA-formatted abcd_fastqc01.txt with "
+                    "realistic participants, sessions, series types, and "
+                    "scanner vendors for benchmarking fasttrack2s3.py.")
+
+    parser.add_argument(dest='output', metavar='OUTPUT_FILE', type=available,
+                        help="The synthetic abcd_fastqc01.txt file to write.")
+
+    parser.add_argument('-n', '--rows', type=int, default=10000, metavar='ROWS',
+                        help="The number of series rows to write. Defaults to 10000.")
+
+    parser.add_argument('-p', '--participants', type=int, default=None, metavar='COUNT',
+                        help="The maximum number of participants. Defaults to "
+                            "as many as needed to reach ROWS.")
+
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help="The random seed. Defaults to 0.")
+
+    parser.add_argument('-l', '--log-level', metavar='LEVEL',
+                        choices=LOG_LEVELS, default='INFO',
+                        help="Set the minimum logging level. Defaults to INFO.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+
+    logging.basicConfig(format=LOG_FORMAT, level=getattr(logging, args.log_level))
+    debug(args)
+
+    if args.rows < 1:
+        raise ValueError(f"Invalid number of rows: {args.rows}")
+
+    count = write_synthetic(args.output, args.rows, args.participants, args.seed)
+    info(f"Wrote {count} synthetic series rows to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,20 @@
 
 # Importing the required libraries
 import argparse
+import csv
+import filecmp
+import hashlib
 import json
 import logging
 import os
 import pandas
 import re
 import shutil
+import time
 
 from bids import BIDSLayout
-from copy import deepcopy
-from dependencies.sefm_eval_and_json_editor import insert_edit_json
+from bids.layout import BIDSLayoutIndexer, parse_file_entities
+from bids.layout.validation import DEFAULT_LOCATIONS_TO_IGNORE
 from dependencies.sefm_eval_and_json_editor import read_bids_layout
 from dependencies.sefm_eval_and_json_editor import sefm_select
 from dependencies.sefm_eval_and_json_editor import seperate_concatenated_fm
@@ -30,6 +34,11 @@ ds_desc = HERE / 'dependencies/bids/dataset_description.json'
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
+# the corrections log's columns, and how often its rows are written out
+LOG_COLUMNS = ['time', 'function', 'file', 'field', 'original_value', 'corrected_value']
+LOG_FLUSH_ROWS = 100
+LOG_FLUSH_SECONDS = 10
+
 # create help strings for the log level option
 log_levels_str = "\n    ".join(LOG_LEVELS)
 
@@ -134,6 +143,21 @@ def cli():
                         help='Remove any present BVAL and BVEC files alongside '
                             'field maps.')
 
+    parser.add_argument('--fuseEdits', action='store_true', required=False,
+                        help='Apply all JSON sidecar edits of the enabled corrections '
+                            'in memory and write every edited sidecar once at the end, '
+                            'instead of reading and writing it once per edit.')
+
+    parser.add_argument('--n-procs', type=int, default=1,
+                        help='The number of (subject, session) pairs to correct in '
+                            'parallel processes. Defaults to 1, which corrects the '
+                            'whole dataset in this process.')
+
+    parser.add_argument('--layout-cache', type=available, default=None, metavar='DIR',
+                        help='Keep a pybids index of every session in this directory '
+                            'between runs. Only sessions whose files changed since they '
+                            'were last indexed are indexed again.')
+
     parser.add_argument('--DCAN', nargs=1, default=None, required=False,
                         metavar='MRE_DIR',
                         help='Run all of the DCAN-Labs/abcd-dicom2bids recommendations. '
@@ -157,12 +181,294 @@ def fsl_check():
     return fsl_dir
 
 
-def df_append(df, data):
-    df = pandas.concat([df, pandas.DataFrame(data, index=[0])], ignore_index=True)
-    return df
+class CorrectionsLog:
+    # The corrections log TSV, streamed one row per correction as they
+    # happen instead of held in memory. Rows are flushed every
+    # LOG_FLUSH_ROWS rows or LOG_FLUSH_SECONDS seconds, so that a run that
+    # dies still leaves a record of what it already changed on disk.
+
+    def __init__(self, log_file):
+        self.file = open(log_file, 'w', newline='')
+        self.writer = csv.writer(self.file, delimiter='\t', lineterminator='\n')
+        self.writer.writerow(LOG_COLUMNS)
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def append(self, data):
+        self.writer.writerow([data[column] for column in LOG_COLUMNS])
+        self.unflushed += 1
+
+        if self.unflushed >= LOG_FLUSH_ROWS or time.monotonic() - self.last_flush >= LOG_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.file.close()
+
+
+def copy_file(source, destination):
+    # copy a file, leaving an identical destination untouched so that its session stays cached
+    if os.path.exists(destination) and filecmp.cmp(source, destination, shallow=False):
+        return
+
+    shutil.copyfile(source, destination)
 
 
-def correct_old_GE_DV25_DV28(layout, subsess, args, df):
+def sidecar_stem(path):
+    # the path without its BIDS extension, shared by a data file and its JSON sidecar
+    path = str(path)
+    for extension in ['.nii.gz', '.nii', '.json', '.bval', '.bvec', '.tsv']:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+
+    return path
+
+
+def write_json(json_path, contents):
+    # write a JSON sidecar next to the old one first, so that it is replaced atomically
+    temporary = f'{json_path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(contents, f, indent=4)
+
+    shutil.copymode(json_path, temporary)
+    os.replace(temporary, json_path)
+
+
+def session_path(root, subject, session):
+    # a session's directory, or the subject's directory when session is None
+    if session is None:
+        return Path(root) / f'sub-{subject}'
+
+    return Path(root) / f'sub-{subject}' / f'ses-{session}'
+
+
+def session_layout(root, subject, session, **kwargs):
+    # a BIDSLayout of the top level files and one session directory only, or
+    # one subject directory when session is None
+    ignore = list(DEFAULT_LOCATIONS_TO_IGNORE) + [
+        re.compile(rf'^/sub-(?!{re.escape(subject)}(/|$))'),
+    ]
+    if session is not None:
+        ignore.append(re.compile(rf'^/sub-{re.escape(subject)}/ses-(?!{re.escape(session)}(/|$))'))
+
+    return BIDSLayout(root, indexer=BIDSLayoutIndexer(ignore=ignore), **kwargs)
+
+
+def session_signature(root, subject, session):
+    # the paths, sizes and modification times of the top level JSON sidecars,
+    # which the session's files inherit metadata from, and of every file in
+    # the session directory
+    paths = sorted(Path(root).glob('*.json'))
+    for dirpath, _, filenames in os.walk(session_path(root, subject, session)):
+        paths += [Path(dirpath) / filename for filename in filenames]
+
+    stats = []
+    for path in sorted(paths):
+        stat = path.stat()
+        stats.append([str(path), stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha256(json.dumps(stats).encode('utf-8')).hexdigest()
+
+
+def cached_session_layout(cache_dir, root, subject, session):
+    # a session's BIDSLayout from its pybids database in the layout cache,
+    # indexed again only if the session's signature changed since
+    name = f'sub-{subject}' if session is None else f'sub-{subject}_ses-{session}'
+    database_path = Path(cache_dir) / name
+    signature_file = database_path / 'signature.txt'
+    signature = session_signature(root, subject, session)
+
+    if (database_path / 'layout_index.sqlite').exists() and signature_file.exists() \
+            and signature_file.read_text() == signature:
+        debug(f'Loading the cached layout of {subject}, {session}')
+        return BIDSLayout(root, database_path=database_path)
+
+    # the old signature goes first, so that an interrupted indexing is redone
+    debug(f'Indexing {subject}, {session} into the layout cache')
+    if signature_file.exists():
+        signature_file.unlink()
+
+    layout = session_layout(root, subject, session, database_path=database_path, reset_database=True)
+    signature_file.write_text(signature)
+
+    return layout
+
+
+class IncrementalLayout:
+    # A BIDSLayout that indexes the dataset once. The corrections tell it
+    # about every metadata field they set or delete and every file they
+    # remove, which it patches into its metadata cache and query results.
+    # Only corrections that add files re-scan, and only the affected session
+    # directory, which then answers that session's queries.
+    #
+    # In fused mode the JSON sidecar edits are applied to each sidecar's
+    # contents in memory, in the order the corrections make them, and every
+    # edited sidecar is written out once by flush().
+    #
+    # With a layout cache, every session is indexed on its own into a pybids
+    # database that later runs load instead, as long as the session's files
+    # did not change.
+
+    def __init__(self, root, fused=False, subject=None, session=None, cache_dir=None):
+        self.root = root
+        self.cache_dir = cache_dir
+        if subject is not None and cache_dir is not None:
+            self.layout = cached_session_layout(cache_dir, root, subject, session)
+        elif subject is not None:
+            self.layout = session_layout(root, subject, session)
+        elif cache_dir is not None:
+            # every session is loaded from the cache on its first query
+            self.layout = None
+        else:
+            self.layout = BIDSLayout(root)
+
+        self.sessions = {}
+        self.metadata = {}
+        self.removed_paths = set()
+        self.fused = fused
+        self.sidecars = {}
+        self.originals = {}
+
+    def layout_for(self, subject, session):
+        if self.layout is None and (subject, session) not in self.sessions:
+            self.sessions[(subject, session)] = cached_session_layout(self.cache_dir, self.root, subject, session)
+
+        return self.sessions.get((subject, session), self.layout)
+
+    def get(self, **filters):
+        layout = self.layout_for(filters.get('subject'), filters.get('session'))
+        files = layout.get(**filters)
+
+        if len(self.removed_paths) > 0:
+            files = [f for f in files if os.path.join(f.dirname, f.filename) not in self.removed_paths]
+
+        return files
+
+    def get_subjects(self, **filters):
+        if self.layout is None:
+            return sorted(set(subject for subject, _ in list_sessions(self.root)))
+
+        return self.layout.get_subjects(**filters)
+
+    def get_sessions(self, **filters):
+        if self.layout is None:
+            return [session for subject, session in list_sessions(self.root)
+                    if subject == filters.get('subject') and session is not None]
+
+        return self.layout.get_sessions(**filters)
+
+    def get_metadata(self, path):
+        stem = sidecar_stem(path)
+        if stem not in self.metadata:
+            entities = parse_file_entities(str(path))
+            layout = self.layout_for(entities.get('subject'), entities.get('session'))
+            self.metadata[stem] = layout.get_metadata(str(path))
+
+        return dict(self.metadata[stem])
+
+    def set_metadata(self, json_path, field, value):
+        # a field was inserted into or replaced in a JSON sidecar
+        stem = sidecar_stem(json_path)
+        if stem not in self.metadata:
+            self.get_metadata(stem + '.nii.gz')
+        self.metadata[stem][field] = value
+
+    def delete_metadata(self, json_path, field):
+        # a field was deleted from a JSON sidecar
+        stem = sidecar_stem(json_path)
+        if stem not in self.metadata:
+            self.get_metadata(stem + '.nii.gz')
+        self.metadata[stem].pop(field, None)
+
+    def reload_metadata(self, json_path):
+        # fields were inserted into or replaced in a JSON sidecar by code
+        # that does not report them, so the sidecar is read again
+        with open(json_path, 'r') as f:
+            contents = json.load(f)
+
+        for field, value in contents.items():
+            self.set_metadata(json_path, field, value)
+
+    def read_json(self, json_path):
+        # the contents of a JSON sidecar, including the fused edits so far
+        json_path = str(json_path)
+        if json_path in self.sidecars:
+            return self.sidecars[json_path]
+
+        with open(json_path, 'r') as f:
+            contents = json.load(f)
+
+        if self.fused:
+            self.sidecars[json_path] = contents
+            self.originals[json_path] = json.dumps(contents)
+
+        return contents
+
+    def edit_json(self, json_path, field, value):
+        # insert or replace a field in a JSON sidecar, leaving a sidecar that
+        # already has the value untouched so that its session stays cached
+        contents = self.read_json(json_path)
+        if field in contents and contents[field] != value:
+            print(f'WARNING: Replacing {field}: {contents[field]} with {value} in {json_path}')
+        else:
+            print(f'Inserting {field}: {value} in {json_path}')
+
+        if field not in contents or json.dumps(contents[field]) != json.dumps(value):
+            contents[field] = value
+            if not self.fused:
+                write_json(json_path, contents)
+
+        self.set_metadata(json_path, field, value)
+
+    def remove_json_field(self, json_path, field):
+        # delete a field from a JSON sidecar and return its value
+        contents = self.read_json(json_path)
+        value = contents.pop(field)
+
+        if not self.fused:
+            write_json(json_path, contents)
+
+        self.delete_metadata(json_path, field)
+
+        return value
+
+    def flush(self):
+        # write every sidecar whose contents the fused edits changed, once
+        # each, and forget the contents, since code outside of the
+        # corrections may edit them next
+        for json_path in sorted(self.sidecars):
+            if json.dumps(self.sidecars[json_path]) != self.originals[json_path]:
+                write_json(json_path, self.sidecars[json_path])
+
+        self.sidecars = {}
+        self.originals = {}
+
+    def removed(self, path):
+        # a file was deleted
+        self.removed_paths.add(str(path))
+        self.metadata.pop(sidecar_stem(path), None)
+        self.sidecars.pop(str(path), None)
+        self.originals.pop(str(path), None)
+
+    def rescan(self, subject, session):
+        # files were added to one session, so index just that session again
+        # and let it answer the session's queries from now on
+        if self.cache_dir is not None:
+            self.sessions[(subject, session)] = cached_session_layout(self.cache_dir, self.root, subject, session)
+        else:
+            self.sessions[(subject, session)] = session_layout(self.root, subject, session)
+
+        session_dir = str(session_path(self.root, subject, session)) + os.sep
+        self.metadata = {stem: metadata for stem, metadata in self.metadata.items()
+                         if not stem.startswith(session_dir)}
+        self.removed_paths = {path for path in self.removed_paths if not path.startswith(session_dir)}
+
+
+def correct_old_GE_DV25_DV28(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         # Check if there are any old GE DV25 through DV28 DWI BVAL and BVEC files
@@ -180,8 +486,8 @@ def correct_old_GE_DV25_DV28(layout, subsess, args, df):
                             # correct the bval and bvec files
                             info(f'Overwriting the bval and bvec files for GE {version}: {dwi_nifti}')
                             if version == 'DV25':
-                                shutil.copyfile(dwi_tables.joinpath('GE_bvals_DV25.txt'), dwi_bval)
-                                df = df_append(df, {
+                                copy_file(dwi_tables.joinpath('GE_bvals_DV25.txt'), dwi_bval)
+                                log.append({
                                     'time': pandas.Timestamp.now(),
                                     'function': 'correct_old_GE_DV25_DV28',
                                     'file': os.path.basename(dwi_bval),
@@ -189,8 +495,8 @@ def correct_old_GE_DV25_DV28(layout, subsess, args, df):
                                     'original_value': 'n/a',
                                     'corrected_value': 'GE_bvals_DV25.txt'
                                 })
-                                shutil.copyfile(dwi_tables.joinpath('GE_bvecs_DV25.txt'), dwi_bvec)
-                                df = df_append(df, {
+                                copy_file(dwi_tables.joinpath('GE_bvecs_DV25.txt'), dwi_bvec)
+                                log.append({
                                     'time': pandas.Timestamp.now(),
                                     'function': 'correct_old_GE_DV25_DV28',
                                     'file': os.path.basename(dwi_bvec),
@@ -199,8 +505,8 @@ def correct_old_GE_DV25_DV28(layout, subsess, args, df):
                                     'corrected_value': 'GE_bvecs_DV25.txt'
                                 })
                             else:
-                                shutil.copyfile(dwi_tables.joinpath('GE_bvals_DV26.txt'), dwi_bval)
-                                df = df_append(df, {
+                                copy_file(dwi_tables.joinpath('GE_bvals_DV26.txt'), dwi_bval)
+                                log.append({
                                     'time': pandas.Timestamp.now(),
                                     'function': 'correct_old_GE_DV25_DV28',
                                     'file': os.path.basename(dwi_bval),
@@ -208,8 +514,8 @@ def correct_old_GE_DV25_DV28(layout, subsess, args, df):
                                     'original_value': 'n/a',
                                     'corrected_value': 'GE_bvals_DV26.txt'
                                 })
-                                shutil.copyfile(dwi_tables.joinpath('GE_bvecs_DV26.txt'), dwi_bvec)
-                                df = df_append(df, {
+                                copy_file(dwi_tables.joinpath('GE_bvecs_DV26.txt'), dwi_bvec)
+                                log.append({
                                     'time': pandas.Timestamp.now(),
                                     'function': 'correct_old_GE_DV25_DV28',
                                     'file': os.path.basename(dwi_bvec),
@@ -218,10 +524,10 @@ def correct_old_GE_DV25_DV28(layout, subsess, args, df):
                                     'corrected_value': 'GE_bvecs_DV26.txt'
                                 })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def correct_IntendedFor(layout, subsess, args, df):
+def correct_IntendedFor(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         # Check if there are any IntendedFor fields in the JSONs
@@ -234,19 +540,12 @@ def correct_IntendedFor(layout, subsess, args, df):
 
                 if 'IntendedFor' in fmap_metadata:
                     # load in the JSON file
-                    with open(fmap_json, 'r') as f:
-                        contents = json.load(f)
-
-                    original_value = contents['IntendedFor']
+                    original_value = layout.read_json(fmap_json)['IntendedFor']
 
                     # if it's an empty list
                     if original_value == []:
                         # remove the empty IntendedFor field
-                        del contents['IntendedFor']
-
-                        # write the JSON file back out
-                        with open(fmap_json, 'w') as f:
-                            json.dump(contents, f, indent=4)
+                        layout.remove_json_field(fmap_json, 'IntendedFor')
 
                     # else if it's a list with entries
                     elif type(original_value) is list:
@@ -254,21 +553,22 @@ def correct_IntendedFor(layout, subsess, args, df):
                         for entry in original_value:
                             corrected_value.append(re.sub(r'^.*(sub-.+/)', '\g<1>', entry))
 
-                        insert_edit_json(fmap_json, 'IntendedFor', corrected_value)
+                        layout.edit_json(fmap_json, 'IntendedFor', corrected_value)
 
                     # otherwise it's a string and we need to correct just the one entry
                     else:
                         corrected_value = re.sub(r'^.*(sub-.+/)', '\g<1>', original_value)
-                        insert_edit_json(fmap_json, 'IntendedFor', corrected_value)
+                        layout.edit_json(fmap_json, 'IntendedFor', corrected_value)
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
 # Most of the following functions are based on the DCAN-Labs/abcd-dicom2bids
 # sefm_eval_and_json_editor.py or correct_jsons.py main functions
 
-def separate_fmaps(layout, subsess, args, df):
+def separate_fmaps(layout, subsess, args, log):
     fsl_dir = fsl_check()
+    layout.flush()
 
     for subject, sessions in subsess:
 
@@ -284,7 +584,8 @@ def separate_fmaps(layout, subsess, args, df):
 
                 # remove the old concatenated field maps
                 os.remove(fmap_nifti)
-                df = df_append(df, {
+                layout.removed(fmap_nifti)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'separate_fmaps',
                     'file': os.path.basename(fmap_nifti),
@@ -293,7 +594,8 @@ def separate_fmaps(layout, subsess, args, df):
                     'corrected_value': 'REMOVED'
                 })
                 os.remove(fmap_json)
-                df = df_append(df, {
+                layout.removed(fmap_json)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'separate_fmaps',
                     'file': os.path.basename(fmap_json),
@@ -302,13 +604,13 @@ def separate_fmaps(layout, subsess, args, df):
                     'corrected_value': 'REMOVED'
                 })
 
-            # recreate layout with the additional fmaps
-            layout = BIDSLayout(args.bids)
+            # index the additional fmaps
+            layout.rescan(subject, sessions)
 
-    return layout, df
+    return layout
 
 
-def assign_funcfmapIntendedFor(layout, subsess, args, df):
+def assign_funcfmapIntendedFor(layout, subsess, args, log):
     fsl_dir = fsl_check()
     if args.DCAN != None:
         MRE_DIR = args.DCAN[0]
@@ -318,6 +620,7 @@ def assign_funcfmapIntendedFor(layout, subsess, args, df):
         raise Exception("No MRE_DIR provided for func fmap IntendedFor assignment.")
 
     debug(MRE_DIR)
+    layout.flush()
 
     for subject, sessions in subsess:
 
@@ -329,8 +632,13 @@ def assign_funcfmapIntendedFor(layout, subsess, args, df):
             # base_temp_dir = fmaps[0].dirname
             base_temp_dir = args.temporary
             best_pos, best_neg = sefm_select(layout, subject, sessions, base_temp_dir, fsl_dir, MRE_DIR, debug=False)
+
+            # sefm_select edited the PhaseEncodingDirection and IntendedFor fields
+            for fmap in [os.path.join(x.dirname, x.filename) for x in fmaps]:
+                layout.reload_metadata(fmap.replace('.nii.gz', '.json'))
+
             for best in [best_pos, best_neg]:
-                df = df_append(df, {
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'assign_funcfmapIntendedFor',
                     'file': os.path.basename(best),
@@ -339,10 +647,10 @@ def assign_funcfmapIntendedFor(layout, subsess, args, df):
                     'corrected_value': 'ADDED'
                 })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def assign_dwifmapIntendedFor(layout, subsess, args, df):
+def assign_dwifmapIntendedFor(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         # grap the DWI NIfTIs and the AP dwi fmap JSON
@@ -358,8 +666,8 @@ def assign_dwifmapIntendedFor(layout, subsess, args, df):
             sorted_APs = sorted([os.path.join(AP.dirname, AP.filename) for AP in APs])
             debug(sorted_APs)
             AP_json = sorted_APs[0]
-            insert_edit_json(AP_json, 'IntendedFor', dwi_relpath)
-            df = df_append(df, {
+            layout.edit_json(AP_json, 'IntendedFor', dwi_relpath)
+            log.append({
                 'time': pandas.Timestamp.now(),
                 'function': 'assign_dwifmapIntendedFor',
                 'file': os.path.basename(AP_json),
@@ -368,10 +676,10 @@ def assign_dwifmapIntendedFor(layout, subsess, args, df):
                 'corrected_value': str(dwi_relpath)
             })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def inject_anatDwellTime(layout, subsess, args, df):
+def inject_anatDwellTime(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         anat = layout.get(subject=subject, session=sessions, datatype='anat', extension='.nii.gz')
@@ -391,8 +699,8 @@ def inject_anatDwellTime(layout, subsess, args, df):
                     error(f"Manufacturer not recognized for {TX} in inject_anatDwellTime")
                     continue
 
-                insert_edit_json(TX_json, 'DwellTime', corrected_value)
-                df = df_append(df, {
+                layout.edit_json(TX_json, 'DwellTime', corrected_value)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'inject_anatDwellTime',
                     'file': os.path.basename(TX_json),
@@ -401,10 +709,10 @@ def inject_anatDwellTime(layout, subsess, args, df):
                     'corrected_value': corrected_value
                 })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def inject_dwiTotalReadoutTime(layout, subsess, args, df):
+def inject_dwiTotalReadoutTime(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         dwi = layout.get(subject=subject, session=sessions, datatype='dwi', suffix='dwi', extension='.nii.gz')
@@ -435,8 +743,8 @@ def inject_dwiTotalReadoutTime(layout, subsess, args, df):
                 error(f"Manufacturer not recognized for {scan} in inject_dwiTotalReadoutTime")
                 continue
 
-            insert_edit_json(scan_json, 'TotalReadoutTime', corrected_value)
-            df = df_append(df, {
+            layout.edit_json(scan_json, 'TotalReadoutTime', corrected_value)
+            log.append({
                 'time': pandas.Timestamp.now(),
                 'function': 'inject_dwiTotalReadoutTime',
                 'file': os.path.basename(scan_json),
@@ -445,10 +753,10 @@ def inject_dwiTotalReadoutTime(layout, subsess, args, df):
                 'corrected_value': corrected_value
             })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def inject_dwiEffectiveEchoSpacing(layout, subsess, args, df):
+def inject_dwiEffectiveEchoSpacing(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         dwi = layout.get(subject=subject, session=sessions, datatype='dwi', suffix='dwi', extension='.nii.gz')
@@ -479,8 +787,8 @@ def inject_dwiEffectiveEchoSpacing(layout, subsess, args, df):
                 error(f"Manufacturer not recognized for {scan} in inject_dwiEffectiveEchoSpacing")
                 continue
 
-            insert_edit_json(scan_json, 'EffectiveEchoSpacing', corrected_value)
-            df = df_append(df, {
+            layout.edit_json(scan_json, 'EffectiveEchoSpacing', corrected_value)
+            log.append({
                 'time': pandas.Timestamp.now(),
                 'function': 'inject_dwiEffectiveEchoSpacing',
                 'file': os.path.basename(scan_json),
@@ -489,10 +797,10 @@ def inject_dwiEffectiveEchoSpacing(layout, subsess, args, df):
                 'corrected_value': corrected_value
             })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def inject_funcfmapEffectiveEchoSpacing(layout, subsess, args, df):
+def inject_funcfmapEffectiveEchoSpacing(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         fmap = layout.get(subject=subject, session=sessions, datatype='fmap', extension='.nii.gz', acquisition='func')
@@ -512,8 +820,8 @@ def inject_funcfmapEffectiveEchoSpacing(layout, subsess, args, df):
                     error(f"Manufacturer not recognized for {fm} in inject_funcfmapEffectiveEchoSpacing")
                     continue
 
-                insert_edit_json(fm_json, 'EffectiveEchoSpacing', corrected_value)
-                df = df_append(df, {
+                layout.edit_json(fm_json, 'EffectiveEchoSpacing', corrected_value)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'inject_funcfmapEffectiveEchoSpacing',
                     'file': os.path.basename(fm_json),
@@ -522,10 +830,10 @@ def inject_funcfmapEffectiveEchoSpacing(layout, subsess, args, df):
                     'corrected_value': corrected_value
                 })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def inject_funcEffectiveEchoSpacing(layout, subsess, args, df):
+def inject_funcEffectiveEchoSpacing(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         func = layout.get(subject=subject, session=sessions, datatype='func', extension='.nii.gz')
@@ -548,8 +856,8 @@ def inject_funcEffectiveEchoSpacing(layout, subsess, args, df):
                     error(f"Manufacturer not recognized for {task} in inject_funcEffectiveEchoSpacing")
                     continue
 
-                insert_edit_json(task_json, 'EffectiveEchoSpacing', corrected_value)
-                df = df_append(df, {
+                layout.edit_json(task_json, 'EffectiveEchoSpacing', corrected_value)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'inject_funcEffectiveEchoSpacing',
                     'file': os.path.basename(task_json),
@@ -558,10 +866,10 @@ def inject_funcEffectiveEchoSpacing(layout, subsess, args, df):
                     'corrected_value': corrected_value
                 })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def inject_dwifmapPhaseEncodingDirection(layout, subsess, args, df):
+def inject_dwifmapPhaseEncodingDirection(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         AP = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='dwi', direction='AP', extension='.nii.gz')
@@ -572,8 +880,8 @@ def inject_dwifmapPhaseEncodingDirection(layout, subsess, args, df):
                 fm_json = fm.replace('.nii.gz', '.json')
                 corrected_value = 'j-'
 
-                insert_edit_json(fm_json, 'PhaseEncodingDirection', corrected_value)
-                df = df_append(df, {
+                layout.edit_json(fm_json, 'PhaseEncodingDirection', corrected_value)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'inject_dwifmapPhaseEncodingDirection',
                     'file': os.path.basename(fm_json),
@@ -587,8 +895,8 @@ def inject_dwifmapPhaseEncodingDirection(layout, subsess, args, df):
                 fm_json = fm.replace('.nii.gz', '.json')
                 corrected_value = 'j'
 
-                insert_edit_json(fm_json, 'PhaseEncodingDirection', corrected_value)
-                df = df_append(df, {
+                layout.edit_json(fm_json, 'PhaseEncodingDirection', corrected_value)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'inject_dwifmapPhaseEncodingDirection',
                     'file': os.path.basename(fm_json),
@@ -597,10 +905,10 @@ def inject_dwifmapPhaseEncodingDirection(layout, subsess, args, df):
                     'corrected_value': corrected_value
                 })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def add_PhaseEncodingAxisAndDirection(layout, subsess, args, df):
+def add_PhaseEncodingAxisAndDirection(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         # PE direction vs axis
@@ -614,8 +922,8 @@ def add_PhaseEncodingAxisAndDirection(layout, subsess, args, df):
                 # add whichever field is missing based on the other
                 if "PhaseEncodingAxis" in task_metadata:
                     corrected_value = task_metadata['PhaseEncodingAxis']
-                    insert_edit_json(task_json, 'PhaseEncodingDirection', corrected_value)
-                    df = df_append(df, {
+                    layout.edit_json(task_json, 'PhaseEncodingDirection', corrected_value)
+                    log.append({
                         'time': pandas.Timestamp.now(),
                         'function': 'add_PhaseEncodingAxisAndDirection',
                         'file': os.path.basename(task_json),
@@ -626,8 +934,8 @@ def add_PhaseEncodingAxisAndDirection(layout, subsess, args, df):
 
                 elif "PhaseEncodingDirection" in task_metadata:
                     corrected_value = task_metadata['PhaseEncodingDirection'].strip('-')
-                    insert_edit_json(task_json, 'PhaseEncodingAxis', corrected_value)
-                    df = df_append(df, {
+                    layout.edit_json(task_json, 'PhaseEncodingAxis', corrected_value)
+                    log.append({
                         'time': pandas.Timestamp.now(),
                         'function': 'add_PhaseEncodingAxisAndDirection',
                         'file': os.path.basename(task_json),
@@ -636,10 +944,10 @@ def add_PhaseEncodingAxisAndDirection(layout, subsess, args, df):
                         'corrected_value': corrected_value
                     })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def remove_func_slice_timing(layout, subsess, args, df):
+def remove_func_slice_timing(layout, subsess, args, log):
     for subject, sessions in subsess:
         funcs = layout.get(subject=subject, session=sessions, datatype='func', extension='.nii.gz')
 
@@ -647,16 +955,9 @@ def remove_func_slice_timing(layout, subsess, args, df):
             func_json = func.replace('.nii.gz', '.json')
 
             if 'SliceTiming' in layout.get_metadata(func):
-                with open(func_json, 'r') as f:
-                    contents = json.load(f)
-
-                st = deepcopy(contents['SliceTiming'])
-                del contents['SliceTiming']
+                st = layout.remove_json_field(func_json, 'SliceTiming')
 
-                with open(func_json, 'w') as f:
-                    json.dump(contents, f, indent=4)
-
-                df = df_append(df, {
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'remove_func_slice_timing',
                     'file': os.path.basename(func_json),
@@ -665,10 +966,10 @@ def remove_func_slice_timing(layout, subsess, args, df):
                     'corrected_value': 'REMOVED'
                 })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def calculate_fmapTotalReadoutTime(layout, subsess, args, df):
+def calculate_fmapTotalReadoutTime(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         fmaps = layout.get(subject=subject, session=sessions, datatype='fmap', extension='.nii.gz')
@@ -680,8 +981,8 @@ def calculate_fmapTotalReadoutTime(layout, subsess, args, df):
 
                 if 'EffectiveEchoSpacing' in fm_metadata and 'ReconMatrixPE' in fm_metadata:
                     corrected_value = fm_metadata['EffectiveEchoSpacing'] * ( fm_metadata['ReconMatrixPE'] - 1 )
-                    insert_edit_json(fm_json, 'TotalReadoutTime', corrected_value)
-                    df = df_append(df, {
+                    layout.edit_json(fm_json, 'TotalReadoutTime', corrected_value)
+                    log.append({
                         'time': pandas.Timestamp.now(),
                         'function': 'calculate_fmapTotalReadoutTime',
                         'file': os.path.basename(fm_json),
@@ -690,10 +991,10 @@ def calculate_fmapTotalReadoutTime(layout, subsess, args, df):
                         'corrected_value': corrected_value
                     })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def calculate_funcTotalReadoutTime(layout, subsess, args, df):
+def calculate_funcTotalReadoutTime(layout, subsess, args, log):
     for subject, sessions in subsess:
 
         funcs = layout.get(subject=subject, session=sessions, datatype='func', extension='.nii.gz')
@@ -705,8 +1006,8 @@ def calculate_funcTotalReadoutTime(layout, subsess, args, df):
 
                 if 'EffectiveEchoSpacing' in task_metadata and 'ReconMatrixPE' in task_metadata:
                     corrected_value = task_metadata['EffectiveEchoSpacing'] * ( task_metadata['ReconMatrixPE'] - 1 )
-                    insert_edit_json(task_json, 'TotalReadoutTime', corrected_value)
-                    df = df_append(df, {
+                    layout.edit_json(task_json, 'TotalReadoutTime', corrected_value)
+                    log.append({
                         'time': pandas.Timestamp.now(),
                         'function': 'calculate_funcTotalReadoutTime',
                         'file': os.path.basename(task_json),
@@ -715,10 +1016,10 @@ def calculate_funcTotalReadoutTime(layout, subsess, args, df):
                         'corrected_value': corrected_value
                     })
 
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def remove_fmap_bval_bvec(layout, subsess, args, df):
+def remove_fmap_bval_bvec(layout, subsess, args, log):
     for subject, sessions in subsess:
         fmaps = layout.get(subject=subject, session=sessions, datatype='fmap', extension='.nii.gz')
         for fmap in [os.path.join(x.dirname, x.filename) for x in fmaps]:
@@ -726,7 +1027,8 @@ def remove_fmap_bval_bvec(layout, subsess, args, df):
             bvec = fmap.replace('.nii.gz', '.bvec')
             if os.path.exists(bval):
                 os.remove(bval)
-                df = df_append(df, {
+                layout.removed(bval)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'remove_fmap_bval_bvec',
                     'file': bval,
@@ -736,7 +1038,8 @@ def remove_fmap_bval_bvec(layout, subsess, args, df):
                 })
             if os.path.exists(bvec):
                 os.remove(bvec)
-                df = df_append(df, {
+                layout.removed(bvec)
+                log.append({
                     'time': pandas.Timestamp.now(),
                     'function': 'remove_fmap_bval_bvec',
                     'file': bvec,
@@ -745,10 +1048,10 @@ def remove_fmap_bval_bvec(layout, subsess, args, df):
                     'corrected_value': 'REMOVED'
                 })
         
-    return BIDSLayout(args.bids), df
+    return layout
 
 
-def correct_dwi_bval_floating_point_error(layout, subsess, args, df):
+def correct_dwi_bval_floating_point_error(layout, subsess, args, log):
     for subject, sessions in subsess:
         dwis = layout.get(subject=subject, session=sessions, datatype='dwi', extension='.nii.gz')
         for dwi in [os.path.join(x.dirname, x.filename) for x in dwis]:
@@ -765,7 +1068,7 @@ def correct_dwi_bval_floating_point_error(layout, subsess, args, df):
                     with open(bval, 'w') as f:
                         f.write(newline)
 
-                    df = df_append(df, {
+                    log.append({
                         'time': pandas.Timestamp.now(),
                         'function': 'correct_dwi_bval_floating_point_error',
                         'file': os.path.basename(bval),
@@ -774,34 +1077,15 @@ def correct_dwi_bval_floating_point_error(layout, subsess, args, df):
                         'corrected_value': str(newline)
                     })
 
-    return BIDSLayout(args.bids), df
-
-
-def main():
-    # Parse the command line
-    args = cli()
+    return layout
 
-    df = pandas.DataFrame(columns=['time', 'function', 'file', 'field', 'original_value', 'corrected_value'])
-
-    # Set up logging
-    if args.log_level == 'DEBUG':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
-    elif args.log_level == 'INFO':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
-    elif args.log_level == 'WARNING':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.WARNING)
-    elif args.log_level == 'ERROR':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.ERROR)
-    elif args.log_level == 'CRITICAL':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.CRITICAL)
-    else:
-        raise ValueError(f"Invalid log level: {args.log_level}")
 
+def add_dataset_files(args, log):
     # add dataset_description.json to the BIDS directory
     dest_ds_desc = args.bids / 'dataset_description.json'
     if not dest_ds_desc.exists():
         shutil.copyfile(ds_desc, dest_ds_desc)
-        df = df_append(df, {
+        log.append({
             'time': pandas.Timestamp.now(),
             'function': 'main',
             'file': os.path.basename(dest_ds_desc),
@@ -817,7 +1101,7 @@ def main():
 
         if not dest_task_json.exists():
             shutil.copyfile(task_json, dest_task_json)
-            df = df_append(df, {
+            log.append({
                 'time': pandas.Timestamp.now(),
                 'function': 'main',
                 'file': os.path.basename(dest_task_json),
@@ -826,11 +1110,96 @@ def main():
                 'corrected_value': 'ADDED'
             })
 
-    # Load the bids layout
-    layout = BIDSLayout(args.bids)
+
+def list_sessions(bids):
+    # the (subject, session) pairs of a BIDS directory, without indexing it,
+    # with a session of None for every subject without session directories
+    subsess = []
+    for subject_dir in sorted(Path(bids).glob('sub-*')):
+        if not subject_dir.is_dir():
+            continue
+
+        subject = subject_dir.name[len('sub-'):]
+        sessions = sorted(x.name[len('ses-'):] for x in subject_dir.glob('ses-*') if x.is_dir())
+        if not sessions:
+            subsess.append((subject, None))
+        else:
+            subsess += [(subject, session) for session in sessions]
+
+    return subsess
+
+
+def correct_session(args, subject, session, log_file):
+    # run every enabled correction on one session, in its own process
+    layout = IncrementalLayout(args.bids, fused=args.fuseEdits, subject=subject, session=session,
+                               cache_dir=args.layout_cache)
+    log = CorrectionsLog(log_file)
+
+    try:
+        run_corrections(layout, [(subject, session)], args, log)
+    finally:
+        log.close()
+
+
+def correct_sessions(args, log):
+    from concurrent.futures import ProcessPoolExecutor
+
+    subsess = []
+    for subject, session in list_sessions(args.bids):
+        # the corrections only ever match sessions, like read_bids_layout's
+        # placeholder session does in the serial path
+        if session is None:
+            warning(f'sub-{subject} has no session directories, not correcting it')
+            continue
+
+        subsess.append((subject, session))
+    debug(subsess)
+
+    # every session writes its own log, merged into the main one afterwards
+    log_files = [args.temporary / f'bids_corrections_log_sub-{subject}_ses-{session}.tsv'
+                 for subject, session in subsess]
+
+    with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+        futures = [executor.submit(correct_session, args, subject, session, log_file)
+                   for (subject, session), log_file in zip(subsess, log_files)]
+
+    failed = []
+    for (subject, session), future, log_file in zip(subsess, futures, log_files):
+        try:
+            future.result()
+        except Exception as e:
+            error(f'Correcting {subject}, {session} failed: {e}')
+            failed.append((subject, session))
+
+        # a failed session's log still records what it changed
+        if log_file.exists():
+            with open(log_file, 'r', newline='') as f:
+                reader = csv.DictReader(f, delimiter='\t')
+                for row in reader:
+                    log.append(row)
+
+            log_file.unlink()
+
+    if len(failed) > 0:
+        raise RuntimeError(f'{len(failed)} of {len(subsess)} sessions failed to be corrected: {failed}')
+
+
+def correct(args, log):
+    add_dataset_files(args, log)
+
+    if args.n_procs > 1:
+        correct_sessions(args, log)
+        return
+
+    # Load the bids layout, indexing it only this once
+    layout = IncrementalLayout(args.bids, fused=args.fuseEdits, cache_dir=args.layout_cache)
     subsess = read_bids_layout(layout, subject_list=layout.get_subjects(), collect_on_subject=False)
     debug(subsess)
 
+    run_corrections(layout, subsess, args, log)
+
+
+def run_corrections(layout, subsess, args, log):
     # check if the DCAN argument was provided
     if args.DCAN != None:
         info("Running all DCAN-Labs/abcd-dicom2bids recommendations")
@@ -838,95 +1207,125 @@ def main():
     # check if the old GE DV25 through DV28 argument was provided
     if args.dwiCorrectOldGE or args.DCAN != None:
         info("Correcting old GE DV25 through DV28 DWI BVAL and BVEC files")
-        layout, df = correct_old_GE_DV25_DV28(layout, subsess, args, df)
+        layout = correct_old_GE_DV25_DV28(layout, subsess, args, log)
 
     # check if the acq-dwi fmap IntendedFor argument was provided
     if args.dwifmapIntendedFor or args.DCAN != None:
         info("Assigning dwi fmap IntendedFor field")
-        layout, df = assign_dwifmapIntendedFor(layout, subsess, args, df)
-        layout, df = correct_IntendedFor(layout, subsess, args, df)
+        layout = assign_dwifmapIntendedFor(layout, subsess, args, log)
+        layout = correct_IntendedFor(layout, subsess, args, log)
 
     # check if the acq-func fmap IntendedFor argument was provided
     # if so, also run the fmapSeparate option
     if args.funcfmapIntendedFor != None or args.DCAN != None:
         info("Separating concatenated field maps")
-        layout, df = separate_fmaps(layout, subsess, args, df)
+        layout = separate_fmaps(layout, subsess, args, log)
 
         info("Assigning func fmap IntendedFor fields")
-        layout, df = assign_funcfmapIntendedFor(layout, subsess, args, df)
-        layout, df = correct_IntendedFor(layout, subsess, args, df)
+        layout = assign_funcfmapIntendedFor(layout, subsess, args, log)
+        layout = correct_IntendedFor(layout, subsess, args, log)
     # if not and the fmapSeparate option was passed without the funcfmapIntendedFor
     elif args.funcfmapIntendedFor == None and args.fmapSeparate:
         info("Separating concatenated field maps")
-        layout, df = separate_fmaps(layout, subsess, args, df)
+        layout = separate_fmaps(layout, subsess, args, log)
 
     # check if the fmap IntendedFor correction argument was provided
     if args.fmapCorrectIntendedFor:
         info("Correcting fmap IntendedFor fields")
-        layout, df = correct_IntendedFor(layout, subsess, args, df)
+        layout = correct_IntendedFor(layout, subsess, args, log)
 
     # check if the anat DwellTime argument was provided
     if args.anatDwellTime or args.DCAN != None:
         info("Injecting anat DwellTime fields")
-        layout, df = inject_anatDwellTime(layout, subsess, args, df)
+        layout = inject_anatDwellTime(layout, subsess, args, log)
 
     # check if the dwi fmap TotalReadoutTime argument was provided
     if args.dwiTotalReadoutTime or args.DCAN != None:
         info("Injecting dwi and dwi fmap TotalReadoutTime fields")
-        layout, df = inject_dwiTotalReadoutTime(layout, subsess, args, df)
+        layout = inject_dwiTotalReadoutTime(layout, subsess, args, log)
 
     # check if the dwi fmap EffectiveEchoSpacing argument was provided
     if args.dwiEffectiveEchoSpacing or args.DCAN != None:
         info("Injecting dwi and dwi fmap EffectiveEchoSpacing fields")
-        layout, df = inject_dwiEffectiveEchoSpacing(layout, subsess, args, df)
+        layout = inject_dwiEffectiveEchoSpacing(layout, subsess, args, log)
 
     # check if the func fmap EffectiveEchoSpacing argument was provided
     if args.funcfmapEffectiveEchoSpacing or args.DCAN != None:
         info("Injecting func fmap EffectiveEchoSpacing fields")
-        layout, df = inject_funcfmapEffectiveEchoSpacing(layout, subsess, args, df)
+        layout = inject_funcfmapEffectiveEchoSpacing(layout, subsess, args, log)
 
     # check if the func EffectiveEchoSpacing argument was provided
     if args.funcEffectiveEchoSpacing or args.DCAN != None:
         info("Injecting func EffectiveEchoSpacing fields")
-        layout, df = inject_funcEffectiveEchoSpacing(layout, subsess, args, df)
+        layout = inject_funcEffectiveEchoSpacing(layout, subsess, args, log)
 
     # check if the dwi fmap PhaseEncodingDirection argument was provided
     if args.dwifmapPhaseEncodingDirection or args.DCAN != None:
         info("Injecting dwi fmap PhaseEncodingDirection fields")
-        layout, df = inject_dwifmapPhaseEncodingDirection(layout, subsess, args, df)
+        layout = inject_dwifmapPhaseEncodingDirection(layout, subsess, args, log)
 
     # check if the PhaseEncoding argument was provided
     if args.funcPhaseEncoding or args.DCAN != None:
         info("Adding PhaseEncodingAxis and Direction fields")
-        layout, df = add_PhaseEncodingAxisAndDirection(layout, subsess, args, df)
+        layout = add_PhaseEncodingAxisAndDirection(layout, subsess, args, log)
 
     # check if the func SliceTiming argument was provided
     if args.funcSliceTimingRemove or args.DCAN != None:
         info("Removing func SliceTiming fields")
-        layout, df = remove_func_slice_timing(layout, subsess, args, df)
+        layout = remove_func_slice_timing(layout, subsess, args, log)
 
     if args.dwibvalCorrectFloatingPointError or args.DCAN != None:
         info("Correcting floating point errors in DWI BVAL files")
-        layout, df = correct_dwi_bval_floating_point_error(layout, subsess, args, df)
+        layout = correct_dwi_bval_floating_point_error(layout, subsess, args, log)
     
     # check if the fmap TotalReadoutTime argument was provided
     if args.fmapTotalReadoutTime or args.DCAN != None:
         info("Calculating fmap TotalReadoutTime fields")
-        layout, df = calculate_fmapTotalReadoutTime(layout, subsess, args, df)
+        layout = calculate_fmapTotalReadoutTime(layout, subsess, args, log)
 
     # check if the func TotalReadoutTime argument was provided
     if args.funcTotalReadoutTime or args.DCAN != None:
         info("Calculating func TotalReadoutTime fields")
-        layout, df = calculate_funcTotalReadoutTime(layout, subsess, args, df)
+        layout = calculate_funcTotalReadoutTime(layout, subsess, args, log)
 
     # check if fmap bval/bvec removal argument was provided
     if args.fmapbvalbvecRemove:
         info("Removing field map BVAL and BVEC files")
-        layout, df = remove_fmap_bval_bvec(layout, subsess, args, df)
+        layout = remove_fmap_bval_bvec(layout, subsess, args, log)
 
-    # save the log
+    # write the fused JSON sidecar edits
+    layout.flush()
+
+
+def main():
+    # Parse the command line
+    args = cli()
+
+    # Set up logging
+    if args.log_level == 'DEBUG':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+    elif args.log_level == 'INFO':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    elif args.log_level == 'WARNING':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.WARNING)
+    elif args.log_level == 'ERROR':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.ERROR)
+    elif args.log_level == 'CRITICAL':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.CRITICAL)
+    else:
+        raise ValueError(f"Invalid log level: {args.log_level}")
+
+    if args.n_procs < 1:
+        raise ValueError(f"Invalid number of processes: {args.n_procs}")
+
+    # stream the corrections log
     pipeline_folder = args.bids.parent
-    df.to_csv(pipeline_folder / f'code/logs/bids_corrections_log_{pipeline_folder.name}.tsv', sep='\t', index=False)
+    log = CorrectionsLog(pipeline_folder / f'code/logs/bids_corrections_log_{pipeline_folder.name}.tsv')
+
+    try:
+        correct(args, log)
+    finally:
+        log.close()
 
 
 if __name__ == '__main__':
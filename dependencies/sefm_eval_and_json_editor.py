@@ -61,7 +61,7 @@ def sefm_select(layout, subject, sessions, base_temp_dir, fsl_dir, mre_dir,
         fsl_dir += "/"
 
     # Make a temporary working directory
-    temp_dir = os.path.join(base_temp_dir, subject + '_eta_temp')
+    temp_dir = os.path.join(base_temp_dir, subject + '_' + sessions + '_eta_temp')
     try:
         os.mkdir(temp_dir)
     except:
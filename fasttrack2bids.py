@@ -123,10 +123,16 @@ def main():
     filtered_s3links_folder = args.temporary_dir / 'filtered_abcd_fastqc01'
     filtered_s3links_folder.mkdir(parents=True, exist_ok=False)
 
+    # either filter to the sessions CSV or leave out the already-converted sessions
+    if args.sessions_csv != None:
+        sessions_filter = f'-csv {args.sessions_csv}'
+    else:
+        sessions_filter = f'-ignore {args.ignore}'
+
     # begin the nipype interfaces to call the three workflows as one big workflow
     fasttrack2s3 = Node(
         CommandLine(f'poetry run --directory {HERE} python {HERE}/fasttrack2s3.py',
-                    args=f'-csv {args.sessions_csv} {args.abcd_fastqc01} {filtered_s3links_folder} {config['fasttrack2s3']['options']}'),
+                    args=f'{sessions_filter} {args.abcd_fastqc01} {filtered_s3links_folder} {config['fasttrack2s3']['options']}'),
         name='1_fasttrack2s3'
     )
 
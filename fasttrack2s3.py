@@ -4,8 +4,6 @@
 # pseudocode
 #
 # @TODO: Add additonal option to save out logs to a specific file
-# @TODO: Add option to filter by either inclusion or exclusion of the ftq_* columns
-#    e.g. "{"ftq_complete": "0"}""
 # 1. Parse command line arguments
 # @TODO: Add levels of log messages of warning/caution for the user to know what's going on with datatypes specifically
 # 2. Warn users about the filtered qc_input file for invalid data. Things like:
@@ -25,14 +23,22 @@
 # imports
 import argparse
 import csv
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import math
+import os
 import pandas
 import re
+import shlex
+import shutil
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from logging import debug, info, warning, error, critical
 from pathlib import Path
-from utilities import readable, writable
+from utilities import bids_session_index, readable, writable
 
 
 # constants
@@ -41,6 +47,26 @@ HERE = Path(__file__).parent
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
+CACHE_VERSION = 1
+
+# -compact reads the qc_input in chunks of this many rows and stands in this
+# marker for the ftq_series_id inside every file_source
+COMPACT_CHUNK_ROWS = 25000
+SERIES_MARKER = '\0'
+
+# header.swarm budgets one session of about 25 series at 25 GB and 60 minutes,
+# during which the TGZs, unpacked DICOMs, and BIDS outputs share the scratch
+SESSION_SCRATCH_GB = 25
+SESSION_MINUTES = 60
+SESSION_SERIES = 25
+SCRATCH_PER_TGZ_GB = 3
+DEFAULT_TGZ_GB = SESSION_SCRATCH_GB / SESSION_SERIES / SCRATCH_PER_TGZ_GB
+MINUTES_PER_SERIES = SESSION_MINUTES / SESSION_SERIES
+
+# -qc conditions look like "ftq_usable == 1" or "ftq_complete in 0,1"
+QC_CONDITION = re.compile(r'^(ftq_\w+)\s*(==|!=|<=|>=|<|>|\s+not\s+in\s+|\s+in\s+)\s*(.+)$', re.IGNORECASE)
+QC_NUMERIC = ['<', '<=', '>', '>=']
+
 SESSIONS = [
     'ses-baselineYear1Arm1',
     'ses-2YearFollowUpYArm1',
@@ -287,124 +313,693 @@ datatypes_str = "\n    ".join( list(DATATYPES.keys()) )
 
 
 # functions
-def cli():
-    # build parser CLI
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawTextHelpFormatter,
-        description=f"Filter down NDA ABCD fast track series TGZ files from "
-                    "an abcd_fastqc01.txt file using datatype, participant ID, "
-                    "and session ID options.")
+def parse_series_keys(series_ids):
+    # split every ftq_series_id once into its participant, session, series
+    # type (e.g. ABCD-T1-NORM), and scanner suffix columns
+    parts = series_ids.str.split('_', n=3, expand=True).reindex(columns=range(4)).astype(object)
 
+    keys = pandas.DataFrame(index=series_ids.index)
+    keys['participant'] = parts[0]
+    keys['session'] = parts[1]
+    keys['series_type'] = parts[2]
+    keys['scanner_suffix'] = parts[3]
 
-    # positional arguments
-    parser.add_argument(dest='qc_input', metavar='INPUT_FILE', type=readable,
-                        help="The NDA-formatted abcd_fastqc01.txt as-provided "
-                            "from the NDA.")
+    # letter case is ignored and only the last 8 participant ID characters count
+    keys['participant_key'] = keys['participant'].str.upper().str[-8:]
+    keys['session_key'] = keys['session'].str.upper()
+    keys['subses_key'] = keys['participant_key'] + '_' + keys['session_key']
 
-    parser.add_argument(dest='output_dir', metavar='OUTPUT_DIR', type=writable,
-                        help="The output folder for the S3 links file and "
-                            "subset abcd_fastqc01.txt file.")
+    return keys
 
 
-    # make argument groups
-    part_sess = parser.add_argument_group(
-        title='Participant and Session Options',
-        description="You can filter by exact participants and sessions with "
-                    "the below options. All participant IDs can be in "
-                    "either NDA GUID or BIDS ID or just the last eight ID "
-                    "characters format. Letter case is ignored during "
-                    "filtering. In the absence of any participant or session "
-                    "options, all participants and sessions are included.")
+def datatype_mask(series_types, dt_list):
+    # "_TYPE_" entries must match the series type exactly, while entries
+    # like "QA_" only have to match the end of the series type
+    exact = set([t.strip('_') for t in dt_list if t.startswith('_')])
+    endings = [t.rstrip('_') for t in dt_list if not t.startswith('_')]
 
-    participants = part_sess.add_mutually_exclusive_group()
-    sessions = part_sess.add_mutually_exclusive_group()
+    mask = series_types.isin(exact)
+    for ending in endings:
+        mask = mask | series_types.str.endswith(ending).fillna(False).astype(bool)
 
-    control = parser.add_argument_group(title='Control Options')
+    return mask
 
 
-    # controls argument group
-    control.add_argument('-d', '--datatypes', nargs='+', default=['all'],
-                        choices=['all'] + list(DATATYPES.keys()), metavar='TYPE',
-                        help="The space-separated datatypes to include. Defaults to \"all\".\n"
-                            "Options are:\n"
-                            f"    {datatypes_str}")
+def filter_mask(keys, subses, subjects, sessions, dt_list, ignored=None):
+    # combine the exact subses, subject, session, and datatype set lookups
+    mask = datatype_mask(keys['series_type'], dt_list)
 
-    # control.add_argument('-x', '--exclude', nargs='+', type=str, default=[],
-    #                     help="Space-separated strings to exclude within"
-    #                         "ftq_series_id. Defaults to no exclusions.")
+    # anti-join against the already converted subses
+    if ignored:
+        mask = mask & ~keys['subses_key'].isin(ignored)
 
-    control.add_argument('-sep', '--separate', action='store_true', default=False,
-                        help="Separate the output file by session. Defaults "
-                            "to False.")
+    if len(subses) != 0:
+        mask = mask & keys['subses_key'].isin(set(subses))
 
-    control.add_argument('-l', '--log-level', metavar='LEVEL',
-                        choices=LOG_LEVELS, default='INFO',
-                        help="Set the minimum logging level. Defaults to INFO.\n"
-                            "Options, in most to least verbose order, are:\n"
-                            f"    {log_levels_str}")
+    if len(subjects) != 0:
+        mask = mask & keys['participant_key'].isin(set(subjects))
 
+    if len(sessions) != 0:
+        mask = mask & keys['session_key'].isin(set(sessions))
 
-    # participant and session argument group
-    part_sess.add_argument('-csv', '--csv', '--participant-session-csv',
-                            default=None, metavar='FILE',type=readable,
-                            help="The path to a comma-separated value file with "
-                                "no header or index column. The file MUST have "
-                                "exactly 1 participant ID, a comma, and then 1 "
-                                "session ID per line. This is the preferred "
-                                "method of passing in exact pairings of "
-                                "participants and sessions to convert.")
+    return mask
 
-    participants.add_argument('-pid', '--participant-id', nargs='+',
-                                default=None, metavar='PID', type=str,
-                                help="A space-separated exact participant ID "
-                                    "list to filter on. Mutually exclusive "
-                                    "with -ptxt.")
 
-    participants.add_argument('-ptxt', '--participant-txt',
-                                default=None, metavar='FILE', type=readable,
-                                help="The path to a newline-separated plain "
-                                    "text file with exactly 1 participant ID "
-                                    "per line. Mutually exclusive with -pid.")
+def split_unquoted(text, separator):
+    # split text at every separator regex match outside of "..." or '...'
+    parts = []
+    start = 0
 
-    sessions.add_argument('-sid', '--session-id', nargs='+', metavar='SID',
-                            choices=SESSIONS,
-                            default=SESSIONS,
-                            help="A space-separated session ID list to filter "
-                                "on. Defaults to all sessions. Mutually "
-                                "exclusive with -stxt.\n"
-                                "Options are:\n"
-                                f"    {sessions_str}")
+    for match in re.finditer(rf'"[^"]*"|\'[^\']*\'|(?P<separator>{separator})', text, flags=re.IGNORECASE):
+        if match.group('separator') is not None:
+            parts.append(text[start:match.start()])
+            start = match.end()
 
-    sessions.add_argument('-stxt', '--session-txt', metavar='FILE',
-                            default=None,  type=readable,
-                            help="The path to a newline-separated plain text "
-                                "file with exactly 1 session ID per line. "
-                                "Mutually exclusive with -sid.")
+    parts.append(text[start:])
 
+    return parts
 
-    return parser.parse_args()
 
+def parse_qc_filter(expression):
+    # compile "COND and COND or COND ..." into OR-ed lists of AND-ed
+    # (column, operator, values) conditions, "and" binding tighter than "or"
+    if expression is None:
+        return None
 
-def main():
-    # 1. Parse command line arguments
-    args = cli()
+    predicate = []
+    for any_of in split_unquoted(expression.strip(), r'\s+or\s+'):
+        all_of = []
+        for condition in split_unquoted(any_of.strip(), r'\s+and\s+'):
+            match = QC_CONDITION.match(condition.strip())
+            if match is None:
+                raise ValueError(f"Invalid QC filter condition: {condition}")
 
-    # Set up logging
-    if args.log_level == 'DEBUG':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
-    elif args.log_level == 'INFO':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
-    elif args.log_level == 'WARNING':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.WARNING)
-    elif args.log_level == 'ERROR':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.ERROR)
-    elif args.log_level == 'CRITICAL':
-        logging.basicConfig(format=LOG_FORMAT, level=logging.CRITICAL)
+            column, operator, value = match.groups()
+            operator = ' '.join(operator.lower().split())
+            values = [v.strip().strip('"\'') for v in split_unquoted(value, ',')]
+
+            if operator in ['==', '!='] and len(values) != 1:
+                raise ValueError(f"Use \"in\" or \"not in\" to compare against several values: {condition}")
+
+            if operator in QC_NUMERIC:
+                try:
+                    values = [float(v) for v in values]
+                except ValueError:
+                    raise ValueError(f"Invalid number in QC filter condition: {condition}")
+
+                if len(values) != 1:
+                    raise ValueError(f"Numeric comparisons take exactly one value: {condition}")
+
+            all_of.append((column.lower(), operator, values))
+
+        predicate.append(all_of)
+
+    return predicate
+
+
+def qc_filter_columns(predicate):
+    # every column a parsed -qc predicate compares
+    if predicate is None:
+        return set()
+
+    return set(column for all_of in predicate for column, _, _ in all_of)
+
+
+def qc_mask(input, predicate):
+    # evaluate a parsed -qc predicate over whole ftq_* columns at once
+    mask = pandas.Series(False, index=input.index)
+
+    for all_of in predicate:
+        submask = pandas.Series(True, index=input.index)
+
+        for column, operator, values in all_of:
+            if column not in input.columns:
+                raise ValueError(f"QC filter column {column} not found in the input")
+
+            series = input[column].astype(object)
+
+            if operator == '==':
+                submask = submask & (series == values[0])
+            elif operator == '!=':
+                submask = submask & (series != values[0])
+            elif operator == 'in':
+                submask = submask & series.isin(values)
+            elif operator == 'not in':
+                submask = submask & ~series.isin(values)
+            else:
+                # text that is not a number never passes a numeric comparison
+                numbers = pandas.to_numeric(series, errors='coerce')
+
+                if operator == '<':
+                    submask = submask & (numbers < values[0])
+                elif operator == '<=':
+                    submask = submask & (numbers <= values[0])
+                elif operator == '>':
+                    submask = submask & (numbers > values[0])
+                else:
+                    submask = submask & (numbers >= values[0])
+
+        mask = mask | submask
+
+    return mask
+
+
+def file_signature(path, with_hash=True):
+    # describe a file by its size, modification time, and content hash
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    if with_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                digest.update(block)
+        signature['sha256'] = digest.hexdigest()
+
+    return signature
+
+
+def cache_paths(qc_input):
+    # the cache sidecar files sit right next to the input file
+    base = qc_input.parent / f".{qc_input.name}.cache"
+    return Path(f"{base}.feather"), Path(f"{base}.json")
+
+
+def read_qc_cache(qc_input):
+    from pyarrow import feather
+
+    cache_table, cache_meta = cache_paths(qc_input)
+
+    if not (cache_table.exists() and cache_meta.exists()):
+        return None
+
+    with open(cache_meta, 'r') as f:
+        meta = json.load(f)
+
+    if meta.get('version') != CACHE_VERSION:
+        return None
+
+    # a matching size and modification time is trusted without hashing
+    signature = file_signature(qc_input, with_hash=False)
+    cached = meta['signature']
+
+    if signature['size'] != cached['size']:
+        return None
+
+    if signature['mtime_ns'] != cached['mtime_ns']:
+        # the file was touched or copied, so fall back to the content hash
+        signature = file_signature(qc_input)
+        if signature['sha256'] != cached['sha256']:
+            return None
+
+        meta['signature'] = signature
+        try:
+            with open(cache_meta, 'w') as f:
+                json.dump(meta, f, indent=4)
+        except OSError:
+            pass
+
+    # the filters need every row as pandas columns, so the table is read in
+    # full rather than memory-mapped
+    input = feather.read_table(cache_table).to_pandas()
+    row0 = pandas.Series(meta['row0'], name=0)[list(input.columns)]
+
+    return input, row0
+
+
+def write_qc_cache(qc_input, input, row0, signature):
+    from pyarrow import feather
+
+    cache_table, cache_meta = cache_paths(qc_input)
+
+    # only keep the columns used for filtering and the S3 links
+    columns = [column for column in input.columns if column == 'file_source' or column.startswith('ftq_')]
+    cached = input[columns].reset_index(drop=True)
+
+    # dictionary-encode every column that repeats its values
+    for column in columns:
+        if cached[column].nunique() <= len(cached) // 2:
+            cached[column] = cached[column].astype('category')
+
+    meta = {
+        'version': CACHE_VERSION,
+        'signature': signature,
+        'columns': columns,
+        'row0': {column: (None if pandas.isna(row0[column]) else row0[column]) for column in columns},
+    }
+
+    # write to temporary names first so concurrent runs never see half a cache
+    temp_suffix = f".{os.getpid()}.tmp"
+    feather.write_feather(cached, f"{cache_table}{temp_suffix}", compression='uncompressed')
+    with open(f"{cache_meta}{temp_suffix}", 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    os.replace(f"{cache_table}{temp_suffix}", cache_table)
+    os.replace(f"{cache_meta}{temp_suffix}", cache_meta)
+
+    return cached
+
+
+def qc_columns(column):
+    # the only qc_input columns filtering and the S3 links need
+    return column == 'file_source' or column.startswith('ftq_')
+
+
+def source_templates(file_sources, series_ids):
+    # "s3://.../submission_1/{series_id}.tgz" becomes "s3://.../submission_1/\0.tgz",
+    # so whole submission folders share one category instead of a string per row
+    templates = []
+    for source, series_id in zip(file_sources, series_ids):
+        if isinstance(source, str) and isinstance(series_id, str) and series_id != '' \
+                and series_id in source and SERIES_MARKER not in source:
+            source = source.replace(series_id, SERIES_MARKER, 1)
+
+        templates.append(source)
+
+    return pandas.Categorical(templates)
+
+
+def compact_keys(series_ids):
+    # parse_series_keys with the key columns dictionary-encoded and the
+    # scanner suffix, which is unique per series, in one Arrow buffer instead
+    # of a Python string per row
+    keys = parse_series_keys(series_ids)
+    suffixes = keys['scanner_suffix'].astype('string[pyarrow]')
+
+    keys = keys.drop(columns='scanner_suffix').astype('category')
+    keys['scanner_suffix'] = suffixes
+
+    return keys
+
+
+def compact_series_ids(keys):
+    # join every ftq_series_id back together from its compact keys
+    series_ids = []
+    for parts in zip(keys['participant'], keys['session'], keys['series_type'], keys['scanner_suffix']):
+        parts = list(itertools.takewhile(lambda part: isinstance(part, str), parts))
+        series_ids.append('_'.join(parts) if len(parts) != 0 else math.nan)
+
+    return pandas.Series(series_ids, index=keys.index, dtype=object)
+
+
+def expand_compact(input, keys, columns):
+    # put back the ftq_series_id and every file_source template's series ID,
+    # with the columns in their original order
+    if 'ftq_series_id' in input.columns:
+        series_ids = input['ftq_series_id']
     else:
-        raise ValueError(f"Invalid log level: {args.log_level}")
+        series_ids = compact_series_ids(keys)
 
-    debug(args)
+    sources = [source.replace(SERIES_MARKER, series_id, 1) if isinstance(source, str) and SERIES_MARKER in source else source
+               for source, series_id in zip(input['file_source'], series_ids)]
+
+    input = input.assign(ftq_series_id=series_ids, file_source=pandas.Series(sources, index=input.index, dtype=object))
+
+    return input[list(columns)]
+
+
+def filtered_chunks(input, keys, mask, columns):
+    # the compact rows passing the mask one chunk at a time, expanded, so that
+    # only one chunk of plain strings and no copy of the whole filtered table
+    # is ever held in memory
+    for start in range(0, max(len(input), 1), COMPACT_CHUNK_ROWS):
+        rows = mask.iloc[start:start + COMPACT_CHUNK_ROWS]
+        yield expand_compact(input.iloc[start:start + COMPACT_CHUNK_ROWS][rows],
+                             keys.iloc[start:start + COMPACT_CHUNK_ROWS][rows], columns)
+
+
+def read_compact_qc_input(qc_input):
+    # read only the file_source and ftq_* columns, chunk by chunk, storing
+    # every column dictionary-encoded and ftq_series_id only as its compact
+    # keys, to be joined back together for the filtered rows alone
+    reader = pandas.read_csv(qc_input, sep='\t', dtype=object, usecols=qc_columns,
+                             chunksize=COMPACT_CHUNK_ROWS)
+
+    row0 = None
+    chunks = []
+    key_chunks = []
+    for chunk in reader:
+        if row0 is None:
+            row0 = chunk.iloc[0]
+            chunk = chunk.iloc[1:]
+
+        compact = {}
+        for column in chunk.columns:
+            if column == 'file_source':
+                compact[column] = source_templates(chunk[column], chunk['ftq_series_id'])
+            elif column != 'ftq_series_id':
+                compact[column] = chunk[column].astype('category')
+
+        chunks.append(pandas.DataFrame(compact, index=chunk.index))
+        key_chunks.append(compact_keys(chunk['ftq_series_id']))
+
+    return concat_compact(chunks), concat_compact(key_chunks), row0
+
+
+def concat_compact(chunks):
+    # stitch compact chunks back together, merging their categories
+    from pandas.api.types import union_categoricals
+
+    index = chunks[0].index.append([chunk.index for chunk in chunks[1:]])
+    compact = pandas.DataFrame(index=index)
+
+    for column in chunks[0].columns:
+        values = [chunk[column] for chunk in chunks]
+        if isinstance(values[0].dtype, pandas.CategoricalDtype):
+            compact[column] = pandas.Series(union_categoricals(values), index=index)
+        else:
+            compact[column] = pandas.concat(values)
+
+    return compact
+
+
+def read_qc_input(qc_input, use_cache=False):
+    # return the qc_input table without its description row 0, plus that row 0
+    if use_cache:
+        cached = read_qc_cache(qc_input)
+
+        if cached is not None:
+            info(f"Using the cached columns of {qc_input}")
+            return cached
+
+        info(f"No valid cache found for {qc_input}, reading it in full")
+        signature = file_signature(qc_input)
+
+    input = pandas.read_csv(qc_input, sep='\t', dtype=str)
+    row0 = input.iloc[0]
+    input = input.iloc[1:]
+
+    if use_cache:
+        try:
+            input = write_qc_cache(qc_input, input, row0, signature)
+            row0 = row0[list(input.columns)]
+        except OSError as e:
+            warning(f"Unable to write the cache next to {qc_input}: {e}")
+
+    return input, row0
+
+
+def ignored_subses(ignore_bids, output_dir):
+    # index the already converted sessions as subses keys, caching the index
+    # in the output directory so the BIDS directory is only ever read
+    rawdata = ignore_bids / 'rawdata' if ignore_bids.joinpath('rawdata').is_dir() else ignore_bids
+    manifest = output_dir / 'bids_sessions_manifest.json'
+
+    ignored = set()
+    for sub, ses in bids_session_index(rawdata, manifest=manifest):
+        ignored.add(sub[len('sub-'):].upper()[-8:] + '_' + ses[len('ses-'):].upper())
+
+    return ignored
+
+
+def delta_columns(qc_input, previous_input):
+    # the file_source and ftq_* QC columns both snapshots have in common
+    current = pandas.read_csv(qc_input, sep='\t', dtype=str, nrows=0).columns
+    previous = set(pandas.read_csv(previous_input, sep='\t', dtype=str, nrows=0).columns)
+
+    return [column for column in current if column in previous and column != 'ftq_series_id'
+            and (column == 'file_source' or column.startswith('ftq_'))]
+
+
+def series_hashes(input, columns):
+    # fingerprint the compared columns of every series row
+    values = input[columns].astype(object).fillna('')
+    return pandas.util.hash_pandas_object(values, index=False)
+
+
+def read_previous_hashes(args, columns):
+    # fingerprint every series in the previous snapshot, keyed by ftq_series_id
+    if args.chunk_size is not None:
+        reader = pandas.read_csv(args.previous, sep='\t', dtype=str, chunksize=args.chunk_size)
+        chunks = []
+        for i, chunk in enumerate(reader):
+            if i == 0:
+                chunk = chunk.iloc[1:]
+            hashes = series_hashes(chunk, columns)
+            hashes.index = chunk['ftq_series_id'].astype(object)
+            chunks.append(hashes)
+        previous = pandas.concat(chunks)
+    else:
+        # -compact hashes the file_source templates on both sides alike
+        if args.compact:
+            input, keys, _ = read_compact_qc_input(args.previous)
+            series_ids = compact_series_ids(keys)
+        else:
+            input, _ = read_qc_input(args.previous, use_cache=args.cache)
+            series_ids = input['ftq_series_id'].astype(object)
+
+        previous = series_hashes(input, columns)
+        previous.index = series_ids
+
+    return previous[~previous.index.duplicated(keep='last')]
+
+
+def delta_mask(input, previous_hashes, columns):
+    # keep the series that are new or whose compared columns changed
+    series_ids = input['ftq_series_id'].astype(object)
+    is_new = ~series_ids.isin(previous_hashes.index)
+
+    current = series_hashes(input, columns).values
+    previous = previous_hashes.reindex(series_ids.values, fill_value=0).values
+
+    return is_new | pandas.Series(current != previous, index=input.index)
+
+
+def write_sessions_csv(output_sessions, subses_pairs):
+    # write the subject+session pairs in the same format -csv reads
+    with open(output_sessions, 'w') as f:
+        for subber, sesser in subses_pairs:
+            f.write(f"{subber},ses-{sesser}\n")
+
+
+def read_size_history(size_history):
+    # median TGZ gigabytes per series type from past downloads
+    sizes = pandas.read_csv(size_history, sep='\t', header=None, names=['tgz', 'bytes'],
+                            dtype={'tgz': str, 'bytes': 'int64'})
+    series_ids = sizes['tgz'].map(os.path.basename).str.replace(r'\.tgz$', '', regex=True)
+    keys = parse_series_keys(series_ids)
+
+    return (sizes['bytes'] / 1024**3).groupby(keys['series_type']).median()
+
+
+def session_footprints(keys, tgz_gb=None):
+    # estimate every session's scratch gigabytes and minutes from its series
+    if tgz_gb is None:
+        series_gb = pandas.Series(DEFAULT_TGZ_GB, index=keys.index)
+    else:
+        series_gb = keys['series_type'].map(tgz_gb).astype(float).fillna(DEFAULT_TGZ_GB)
+
+    group_keys = [keys['participant'].str.upper(), keys['session_key']]
+    footprints = pandas.DataFrame({'tgz_gb': series_gb, 'series': 1}).groupby(group_keys, sort=False).sum()
+    spellings = keys[['participant', 'session']].groupby(group_keys, sort=False).first()
+    footprints = footprints.join(spellings)
+    footprints['scratch_gb'] = footprints['tgz_gb'] * SCRATCH_PER_TGZ_GB
+    footprints['minutes'] = footprints['series'] * MINUTES_PER_SERIES
+
+    return footprints
+
+
+def pack_bundles(footprints, scratch_gb, minutes):
+    # start from the fewest bundles the totals allow, then hand out the
+    # biggest sessions first to the least loaded bundle that still fits
+    n_bundles = max(1, math.ceil(max(footprints['scratch_gb'].sum() / scratch_gb,
+                                     footprints['minutes'].sum() / minutes)))
+    bundles = [{'sessions': [], 'scratch_gb': 0.0, 'minutes': 0.0} for _ in range(n_bundles)]
+    heap = [(0.0, i) for i in range(n_bundles)]
+
+    ordered = footprints.sort_values('scratch_gb', ascending=False, kind='stable')
+
+    for key, session_gb, session_minutes in zip(ordered.index, ordered['scratch_gb'], ordered['minutes']):
+        load, i = heapq.heappop(heap)
+        bundle = bundles[i]
+
+        if bundle['sessions'] and (load + session_gb > scratch_gb or bundle['minutes'] + session_minutes > minutes):
+            # even the least loaded bundle is too full, so open another one
+            heapq.heappush(heap, (load, i))
+            i = len(bundles)
+            bundle = {'sessions': [], 'scratch_gb': 0.0, 'minutes': 0.0}
+            bundles.append(bundle)
+
+        if session_gb > scratch_gb or session_minutes > minutes:
+            warning(f"sub-{ordered.loc[key, 'participant']}_ses-{ordered.loc[key, 'session']} alone exceeds the bundle budget "
+                    f"with ~{session_gb:.1f} GB and ~{session_minutes:.0f} minutes")
+
+        bundle['sessions'].append(key)
+        bundle['scratch_gb'] += session_gb
+        bundle['minutes'] += session_minutes
+        heapq.heappush(heap, (bundle['scratch_gb'], i))
+
+    return [bundle for bundle in bundles if bundle['sessions']]
+
+
+def write_bundles(args, input, keys, row0, output_dir):
+    # pack the sessions into bundles that fit the scratch and time budget
+    tgz_gb = read_size_history(args.size_history) if args.size_history != None else None
+    footprints = session_footprints(keys, tgz_gb)
+    scratch_gb, minutes = args.bundle
+    bundles = pack_bundles(footprints, scratch_gb, minutes)
+
+    info(f"Packed {len(footprints)} sessions into {len(bundles)} bundles")
+
+    group_keys = keys['participant'].str.upper() + '_' + keys['session_key']
+    summary = []
+
+    for n, bundle in enumerate(bundles, start=1):
+        name = f"bundle-{n:04}"
+        members = [f"{part_key}_{ses_key}" for part_key, ses_key in bundle['sessions']]
 
+        # keep each bundle's rows in the input order
+        bundle_output = input[group_keys.isin(set(members))]
+
+        with open(output_dir / f"{name}_s3links.txt", 'w') as f:
+            for series in bundle_output['file_source']:
+                f.write(f"{series}\n")
+
+        prepend_row0(bundle_output, row0).to_csv(output_dir / f"{name}_filtered.txt",
+                                                 sep='\t', quoting=csv.QUOTE_ALL, index=False)
+
+        for key in bundle['sessions']:
+            session = footprints.loc[key]
+            summary.append([name, session['participant'], session['session'], session['series'],
+                            round(session['scratch_gb'], 3), round(session['minutes'], 1)])
+
+    # list which sessions went where with their estimates
+    pandas.DataFrame(summary, columns=['bundle', 'participant', 'session', 'series', 'scratch_gb', 'minutes']
+                     ).to_csv(output_dir / 'bundles.tsv', sep='\t', index=False)
+
+    # write a swarm header covering the biggest bundle's estimates
+    max_gb = math.ceil(max([bundle['scratch_gb'] for bundle in bundles]))
+    max_minutes = math.ceil(max([bundle['minutes'] for bundle in bundles]))
+
+    with open(HERE / 'header.swarm', 'r') as f:
+        header = f.readlines()
+
+    with open(output_dir / 'bundles_header.swarm', 'w') as f:
+        for line in header:
+            if line.startswith('#SWARM --time'):
+                line = f"#SWARM --time {max_minutes}\n"
+            elif line.startswith('#SWARM --gres lscratch'):
+                line = f"#SWARM --gres lscratch:{max_gb}\n"
+            f.write(line)
+
+
+def prepend_row0(df, row0):
+    # put the row 0 back on top of a filtered table for completeness
+    return pandas.concat([row0.to_frame().T, df])
+
+
+def stream_filter(args, subses, subjects, sessions, dt_list, datatypes_str, previous=None, ignored=None, predicate=None):
+    # stream through a temporary directory that never outlives the run
+    temp_dir = args.output_dir / f".{args.qc_input.stem}_{os.getpid()}.tmp"
+    temp_dir.joinpath('sessions').mkdir(parents=True)
+
+    try:
+        stream_to_temp(args, subses, subjects, sessions, dt_list, datatypes_str, temp_dir, previous, ignored, predicate)
+    finally:
+        if temp_dir.exists():
+            shutil.rmtree(temp_dir)
+
+
+def stream_to_temp(args, subses, subjects, sessions, dt_list, datatypes_str, temp_dir, previous=None, ignored=None, predicate=None):
+    # phase 1: stream every chunk's matches into the temporary directory
+    temp_sessions = temp_dir / 'sessions'
+    temp_s3 = temp_dir / 's3links.txt'
+    temp_qc = temp_dir / 'filtered.txt'
+
+    unique_sub = set()
+    unique_subses = set()
+    ordered_subses = []
+    spellings = {}
+    header = None
+
+    reader = pandas.read_csv(args.qc_input, sep='\t', dtype=str, chunksize=args.chunk_size)
+
+    with open(temp_s3, 'w') as s3_file, open(temp_qc, 'w', newline='') as qc_file:
+        for chunk in reader:
+            if header is None:
+                # keep the header and row 0 text for every filtered file
+                row0 = chunk.iloc[0]
+                chunk = chunk.iloc[1:]
+                header = prepend_row0(chunk.iloc[:0], row0).to_csv(sep='\t', quoting=csv.QUOTE_ALL, index=False)
+                qc_file.write(header)
+
+            keys = parse_series_keys(chunk['ftq_series_id'])
+            mask = filter_mask(keys, subses, subjects, sessions, dt_list, ignored)
+
+            if predicate is not None:
+                mask = mask & qc_mask(chunk, predicate)
+
+            if previous is not None:
+                previous_hashes, columns = previous
+                mask = mask & delta_mask(chunk, previous_hashes, columns)
+
+            chunk = chunk[mask]
+            keys = keys[mask]
+
+            debug(f"Streamed {len(chunk)} matching rows")
+
+            if len(chunk) == 0:
+                continue
+
+            s3_file.write(''.join(f"{series}\n" for series in chunk['file_source']))
+            chunk.to_csv(qc_file, sep='\t', quoting=csv.QUOTE_ALL, index=False, header=False)
+
+            unique_sub.update(keys['participant'])
+
+            for subber, sesser in keys[['participant', 'session']].drop_duplicates().itertuples(index=False):
+                if (subber, sesser) not in unique_subses:
+                    unique_subses.add((subber, sesser))
+                    ordered_subses.append((subber, sesser))
+                    spellings.setdefault((subber.upper(), sesser.upper()), []).append((subber, sesser))
+
+            if args.separate:
+                # append this chunk's rows to each subject+session pair's files
+                group_keys = [keys['participant'].str.upper(), keys['session_key']]
+
+                for (part_key, ses_key), subses_output in chunk.groupby(group_keys, sort=False):
+                    temp_mini_s3 = temp_sessions / f"{part_key}_{ses_key}_s3links.txt"
+                    temp_mini_qc = temp_sessions / f"{part_key}_{ses_key}_filtered.txt"
+                    is_new = not temp_mini_qc.exists()
+
+                    with open(temp_mini_s3, 'a') as f:
+                        f.write(''.join(f"{series}\n" for series in subses_output['file_source']))
+
+                    with open(temp_mini_qc, 'a', newline='') as f:
+                        if is_new:
+                            f.write(header)
+                        subses_output.to_csv(f, sep='\t', quoting=csv.QUOTE_ALL, index=False, header=False)
+
+    if header is None:
+        raise ValueError(f"No rows found in {args.qc_input}")
+
+    # phase 2: rename everything now that the suffix counts are known
+    suffix = f"{datatypes_str}_p-{len(unique_sub)}_s-{len(unique_subses)}"
+
+    debug(suffix)
+
+    os.replace(temp_s3, args.output_dir / f"{args.qc_input.stem}_{suffix}_s3links.txt")
+    os.replace(temp_qc, args.output_dir / f"{args.qc_input.stem}_{suffix}_filtered.txt")
+
+    if previous is not None:
+        write_sessions_csv(args.output_dir / f"{args.qc_input.stem}_{suffix}_sessions.csv", ordered_subses)
+
+    if args.separate:
+        output_dir = Path(f"{args.output_dir}/{args.qc_input.stem}_{suffix}")
+        output_dir.mkdir(exist_ok=True)
+
+        # every spelling of a subject+session pair gets its own files
+        for (part_key, ses_key), names in spellings.items():
+            for kind in ['s3links', 'filtered']:
+                temp_mini = temp_sessions / f"{part_key}_{ses_key}_{kind}.txt"
+
+                for subber, sesser in names[1:]:
+                    shutil.copyfile(temp_mini, output_dir / f"sub-{subber}_ses-{sesser}_{kind}.txt")
+
+                subber, sesser = names[0]
+                os.replace(temp_mini, output_dir / f"sub-{subber}_ses-{sesser}_{kind}.txt")
+
+
+def query_filters(args):
     # read in the participant and session csv file
     subses_list = []
     subjects = []
@@ -456,7 +1051,7 @@ def main():
             if len(sub) < 8:
                 raise ValueError(f"Invalid participant ID: {sub}")
 
-            subses.append(sub.upper()[-8:] + '_' + ses.lstrip('ses-'))
+            subses.append(sub.upper()[-8:] + '_' + ses.lstrip('ses-').upper())
 
     if len(subjects) > 0:
         for sub in subjects:
@@ -470,7 +1065,7 @@ def main():
             if ses not in SESSIONS:
                 raise ValueError(f"Invalid session ID: {ses}")
 
-        sessions = [ses.lstrip('ses-') for ses in sessions]
+        sessions = [ses.lstrip('ses-').upper() for ses in sessions]
 
     if len(subses) == 0 and len(subjects) == 0 and len(sessions) == 0:
         warning("No participant or session filters provided. All participants and sessions will be included.")
@@ -488,90 +1083,433 @@ def main():
     debug(datatypes_str)
     debug(dt_list)
 
-    # 2. Warn users about the filtered qc_input file for invalid data. Things like:
-    #    - fMRI is selected and there's no fieldmap with it
+    return subses, subjects, sessions, dt_list, datatypes_str
 
-    # 3. Apply pid, sid, and datatype filters to filter the qc_input file
 
-    # Read in the qc_input file
-    input = pandas.read_csv(args.qc_input, sep='\t', dtype=str)
+def query_extras(args):
+    # Index the already converted BIDS sessions to leave out
+    if args.ignore_bids != None:
+        ignored = ignored_subses(args.ignore_bids, args.output_dir)
+        info(f"Ignoring {len(ignored)} already converted sessions in {args.ignore_bids}")
+    else:
+        ignored = None
 
-    # Get the first row for later before it's gone
-    row0 = input.iloc[0]
+    # Fingerprint the previous snapshot to only keep the release delta
+    if args.previous != None:
+        columns = delta_columns(args.qc_input, args.previous)
+        debug(columns)
 
-    # Filter by subses
-    if len(subses) != 0:
-        mask = input['ftq_series_id'].str.contains('|'.join(subses), flags=re.IGNORECASE)
-        input = input[mask]
+        previous = (read_previous_hashes(args, columns), columns)
+        info(f"Comparing against {len(previous[0])} series in {args.previous}")
+    else:
+        previous = None
 
-    # Filter by subjects
-    if len(subjects) != 0:
-        mask = input['ftq_series_id'].str.contains('|'.join(subjects), flags=re.IGNORECASE)
-        input = input[mask]
+    return previous, ignored
 
-    # Filter by sessions
-    if len(sessions) != 0:
-        mask = input['ftq_series_id'].str.contains('|'.join(sessions), flags=re.IGNORECASE)
-        input = input[mask]
 
-    # Filter by datatype
-    input = input[input['ftq_series_id'].str.contains('|'.join(dt_list))]
+def check_query(args):
+    parse_qc_filter(args.qc_filter)
+
+    if args.chunk_size is not None and args.chunk_size < 1:
+        raise ValueError(f"Invalid chunk size: {args.chunk_size}")
 
-    debug(input["ftq_series_id"])
+    if args.bundle != None:
+        if args.chunk_size is not None:
+            raise ValueError("The -bundle and -chunk options cannot be combined")
+
+        if min(args.bundle) <= 0:
+            raise ValueError(f"Invalid bundle budget: {args.bundle}")
+
+
+def run_query(args, input, keys, row0):
+    # apply one query's filters to an already parsed qc_input table
+    subses, subjects, sessions, dt_list, datatypes_str = query_filters(args)
+    previous, ignored = query_extras(args)
+
+    # Filter by subses, subjects, sessions, and datatype
+    mask = filter_mask(keys, subses, subjects, sessions, dt_list, ignored)
+
+    # -compact only keeps ftq_series_id as its keys, so join it back together
+    # for the QC filters and release deltas that compare against it
+    predicate = parse_qc_filter(args.qc_filter)
+    if args.compact and (previous is not None or 'ftq_series_id' in qc_filter_columns(predicate)):
+        input = input.assign(ftq_series_id=compact_series_ids(keys))
+
+    # Filter by the ftq_* QC columns in the same pass
+    if predicate is not None:
+        mask = mask & qc_mask(input, predicate)
+
+    if previous is not None:
+        previous_hashes, columns = previous
+        mask = mask & delta_mask(input, previous_hashes, columns)
+
+    if args.compact and not (args.separate or args.bundle != None):
+        chunks = filtered_chunks(input, keys, mask, row0.index)
+
+        # the scanner suffixes are only needed to put back ftq_series_id
+        keys = keys.drop(columns='scanner_suffix')[mask]
+    else:
+        if args.compact:
+            # the per-session outputs group on plain strings again, which for
+            # the categories are only references to the shared category values
+            input = pandas.concat(filtered_chunks(input, keys, mask, row0.index))
+            keys = keys[mask].astype(object)
+        else:
+            input = input[mask]
+            keys = keys[mask]
+
+        debug(input["ftq_series_id"])
+        chunks = [input]
 
     # 4. Produce both the filtered qc_input file and the s3_output file named as
     #    {qc_input}_{suffix}.txt, see format at the top of this file
-    unique_sub = list(set([series.split('_')[0] for series in input['ftq_series_id']]))
-    unique_subses = list(set([(series.split('_')[0], series.split('_')[1]) for series in input['ftq_series_id']]))
+    unique_sub = keys['participant'].unique()
+    unique_subses = keys[['participant', 'session']].drop_duplicates()
     suffix = f"{datatypes_str}_p-{len(unique_sub)}_s-{len(unique_subses)}"
 
     debug(suffix)
 
-    # check if the separate flag is being flown
-    if args.separate:
+    # check if the separate or bundle flags are being flown
+    if args.separate or args.bundle != None:
         output_dir = Path(f"{args.output_dir}/{args.qc_input.stem}_{suffix}")
         output_dir.mkdir(exist_ok=True)
     else:
         output_dir = args.output_dir
 
-    # write out the S3 links file
+    # write out the S3 links file and the filtered qc_input file
     output_s3 = args.output_dir / f"{args.qc_input.stem}_{suffix}_s3links.txt"
+    output_qc = args.output_dir / f"{args.qc_input.stem}_{suffix}_filtered.txt"
 
-    with open(output_s3, 'w') as f:
-        for series in input['file_source']:
-            f.write(f"{series}\n")
+    with open(output_s3, 'w') as s3_file, open(output_qc, 'w', newline='') as qc_file:
+        for n, chunk in enumerate(chunks):
+            s3_file.write(''.join(f"{series}\n" for series in chunk['file_source']))
 
-    # write out the filtered qc_input file
-    output_qc = args.output_dir / f"{args.qc_input.stem}_{suffix}_filtered.txt"
+            # append back in the row 0 for completeness
+            if n == 0:
+                chunk = prepend_row0(chunk, row0)
 
-    # append back in the row 0 for completeness
-    input.loc[-1] = row0
-    input.index = input.index + 1  # shift index
-    input = input.sort_index()  # sort by index
-    input.to_csv(output_qc, sep='\t', quoting=csv.QUOTE_ALL, index=False)
+            chunk.to_csv(qc_file, sep='\t', quoting=csv.QUOTE_ALL, index=False, header=(n == 0))
+
+    # write out the sessions that need reconversion
+    if previous is not None:
+        output_sessions = args.output_dir / f"{args.qc_input.stem}_{suffix}_sessions.csv"
+        write_sessions_csv(output_sessions, unique_subses.itertuples(index=False))
 
     if args.separate:
-        # for every subject+session pair
-        for subber, sesser in unique_subses:
-            # write out a "mini" S3 links file
-            output_mini_s3 = output_dir / f"sub-{subber}_ses-{sesser}_s3links.txt"
+        # group every subject+session pair in one pass, ignoring letter case
+        group_keys = [keys['participant'].str.upper(), keys['session_key']]
 
-            mask = input['ftq_series_id'].str.contains(f"{subber}_{sesser}", flags=re.IGNORECASE)
-            subses_output = deepcopy(input[mask])
+        for _, subses_output in input.groupby(group_keys, sort=False):
+            subses_keys = keys.loc[subses_output.index, ['participant', 'session']]
+            subses_s3 = ''.join(f"{series}\n" for series in subses_output['file_source'])
 
-            with open(output_mini_s3, 'w') as f:
-                for series in subses_output['file_source']:
-                    f.write(f"{series}\n")
+            # append back in the row 0 for completeness
+            subses_output = prepend_row0(subses_output, row0)
 
-            # write out a "mini" qc_input file
-            output_mini_qc = output_dir / f"sub-{subber}_ses-{sesser}_filtered.txt"
+            # every spelling of this subject+session pair gets its own files
+            for subber, sesser in subses_keys.drop_duplicates().itertuples(index=False):
+                # write out a "mini" S3 links file
+                output_mini_s3 = output_dir / f"sub-{subber}_ses-{sesser}_s3links.txt"
+
+                with open(output_mini_s3, 'w') as f:
+                    f.write(subses_s3)
+
+                # write out a "mini" qc_input file
+                output_mini_qc = output_dir / f"sub-{subber}_ses-{sesser}_filtered.txt"
+                subses_output.to_csv(output_mini_qc, sep='\t', quoting=csv.QUOTE_ALL, index=False)
+
+    if args.bundle != None:
+        write_bundles(args, input, keys, row0, output_dir)
+
+
+def run_single(args):
+    check_query(args)
+
+    # 2. Warn users about the filtered qc_input file for invalid data. Things like:
+    #    - fMRI is selected and there's no fieldmap with it
+
+    # 3. Apply pid, sid, and datatype filters to filter the qc_input file
+
+    # Stream the qc_input file through the filters in bounded chunks
+    if args.chunk_size is not None:
+        subses, subjects, sessions, dt_list, datatypes_str = query_filters(args)
+        previous, ignored = query_extras(args)
+        predicate = parse_qc_filter(args.qc_filter)
+        stream_filter(args, subses, subjects, sessions, dt_list, datatypes_str, previous, ignored, predicate)
+        return
+
+    # Read in the qc_input file, keep the first row for later, and parse
+    # ftq_series_id once
+    if args.compact:
+        input, keys, row0 = read_compact_qc_input(args.qc_input)
+    else:
+        input, row0 = read_qc_input(args.qc_input, use_cache=args.cache)
+        keys = parse_series_keys(input['ftq_series_id'])
+
+    run_query(args, input, keys, row0)
+
+
+def run_batch(args):
+    # parse every query line with the same options as the command line
+    if args.chunk_size is not None:
+        raise ValueError("The -batch and -chunk options cannot be combined")
+
+    # every query option belongs in the query lines, where it would otherwise
+    # be silently overridden
+    defaults = vars(cli([str(args.qc_input), str(args.output_dir)]))
+    given = [f"--{option.replace('_', '-')}" for option, default in defaults.items()
+             if option not in ['qc_input', 'output_dir', 'batch', 'cache', 'compact', 'log_level']
+             and getattr(args, option) != default]
+
+    if len(given) != 0:
+        raise ValueError(f"{', '.join(given)} cannot be combined with -batch, "
+                         f"put them in the queries of {args.batch} instead")
+
+    queries = []
+    with open(args.batch, 'r') as f:
+        for line in f.readlines():
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+
+            query = cli([str(args.qc_input), str(args.output_dir)] + shlex.split(line))
+
+            if query.batch != None or query.chunk_size is not None or query.cache or query.compact:
+                raise ValueError(f"The -batch, -chunk, -cache, and -compact options are not allowed in batch queries: {line}")
+
+            query.compact = args.compact
+
+            check_query(query)
+            queries.append(query)
+
+    if len(queries) == 0:
+        raise ValueError(f"No queries found in {args.batch}")
+
+    info(f"Running {len(queries)} queries from {args.batch}")
+
+    # Read in the qc_input file and parse ftq_series_id only once for all queries
+    if args.compact:
+        input, keys, row0 = read_compact_qc_input(args.qc_input)
+    else:
+        input, row0 = read_qc_input(args.qc_input, use_cache=args.cache)
+        keys = parse_series_keys(input['ftq_series_id'])
+
+    # filter and write every query's outputs concurrently
+    with ThreadPoolExecutor(max_workers=min(len(queries), os.cpu_count() or 1)) as executor:
+        futures = [executor.submit(run_query, query, input, keys, row0) for query in queries]
+        for future in futures:
+            future.result()
+
+
+def cli(argv=None):
+    # build parser CLI
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=f"Filter down NDA ABCD fast track series TGZ files from "
+                    "an abcd_fastqc01.txt file using datatype, participant ID, "
+                    "and session ID options.")
+
+
+    # positional arguments
+    parser.add_argument(dest='qc_input', metavar='INPUT_FILE', type=readable,
+                        help="The NDA-formatted abcd_fastqc01.txt as-provided "
+                            "from the NDA.")
+
+    parser.add_argument(dest='output_dir', metavar='OUTPUT_DIR', type=writable,
+                        help="The output folder for the S3 links file and "
+                            "subset abcd_fastqc01.txt file.")
+
+
+    # make argument groups
+    part_sess = parser.add_argument_group(
+        title='Participant and Session Options',
+        description="You can filter by exact participants and sessions with "
+                    "the below options. All participant IDs can be in "
+                    "either NDA GUID or BIDS ID or just the last eight ID "
+                    "characters format. Letter case is ignored during "
+                    "filtering. In the absence of any participant or session "
+                    "options, all participants and sessions are included.")
+
+    participants = part_sess.add_mutually_exclusive_group()
+    sessions = part_sess.add_mutually_exclusive_group()
+
+    control = parser.add_argument_group(title='Control Options')
+
+
+    # controls argument group
+    control.add_argument('-d', '--datatypes', nargs='+', default=['all'],
+                        choices=['all'] + list(DATATYPES.keys()), metavar='TYPE',
+                        help="The space-separated datatypes to include. Defaults to \"all\".\n"
+                            "Options are:\n"
+                            f"    {datatypes_str}")
+
+    # control.add_argument('-x', '--exclude', nargs='+', type=str, default=[],
+    #                     help="Space-separated strings to exclude within"
+    #                         "ftq_series_id. Defaults to no exclusions.")
+
+    grouping = control.add_mutually_exclusive_group()
+
+    grouping.add_argument('-sep', '--separate', action='store_true', default=False,
+                        help="Separate the output file by session. Defaults "
+                            "to False.")
+
+    grouping.add_argument('-bundle', '--bundle', nargs=2, type=float, default=None,
+                        metavar=('GB', 'MINUTES'),
+                        help="Separate the output file into bundles of whole "
+                            "sessions, each estimated to fit within GB of "
+                            "scratch space and MINUTES of run time. Also "
+                            "writes a bundles.tsv summary and a "
+                            "bundles_header.swarm header for swarm.sh. "
+                            "Mutually exclusive with -sep and -chunk.")
+
+    control.add_argument('-qc', '--qc-filter', default=None, metavar='EXPR', type=str,
+                        help="Only keep series whose ftq_* QC columns pass EXPR, "
+                            "one or more \"COLUMN OPERATOR VALUE\" conditions "
+                            "joined by \"and\" or \"or\" (\"and\" binds "
+                            "tighter, no parentheses). Operators are == and != "
+                            "for exact text, \"in\" and \"not in\" for "
+                            "comma-separated text values, and <, <=, >, >= for "
+                            "numbers. Quote values that contain commas, \"and\", "
+                            "or \"or\" in single or double quotes, and quote "
+                            "EXPR on the command line, e.g.\n"
+                            "    -qc \"ftq_usable == 1 and ftq_complete in 1,2\"")
+
+    control.add_argument('-hist', '--size-history', default=None, metavar='FILE', type=readable,
+                        help="A tab-separated file with no header of past TGZ "
+                            "file names and their sizes in bytes, one per line, "
+                            "used to estimate session sizes for -bundle. Without "
+                            "it, every series is estimated from the "
+                            "header.swarm one session budget.")
+
+    reading = control.add_mutually_exclusive_group()
+
+    reading.add_argument('-cache', '--cache', action='store_true', default=False,
+                        help="Read INPUT_FILE through a columnar cache kept "
+                            "next to it, creating or refreshing the cache "
+                            "when the file's size, modification time, or "
+                            "content hash changes. Only the file_source and "
+                            "ftq_* columns are cached, so the filtered output "
+                            "files only include those columns. Defaults to False.")
+
+    reading.add_argument('-compact', '--compact', action='store_true', default=False,
+                        help="Only read the file_source and ftq_* columns of "
+                            "INPUT_FILE, dictionary-encoded, with the S3 "
+                            "prefix of every file_source factored out and "
+                            "every ftq_series_id kept as its parsed parts, "
+                            "then write the outputs a chunk at a time, which "
+                            "cuts the peak memory use many times over. Like "
+                            "-cache, the filtered output files only include "
+                            "those columns. Defaults to False.")
+
+    reading.add_argument('-chunk', '--chunk-size', type=int, default=None, metavar='ROWS',
+                        help="Stream INPUT_FILE in chunks of ROWS rows, writing "
+                            "matches straight to the output files, so memory "
+                            "use stays flat no matter how big INPUT_FILE is. "
+                            "The outputs are the same as without streaming. "
+                            "Mutually exclusive with -cache and -compact.")
+
+    control.add_argument('-batch', '--batch', default=None, metavar='FILE', type=readable,
+                        help="The path to a plain text file of queries, one per "
+                            "line, each made of the Participant and Session "
+                            "and Control Options above (blank lines and lines "
+                            "starting with # are skipped). INPUT_FILE is read "
+                            "and parsed only once and every query is filtered "
+                            "and written concurrently as if run on its own. "
+                            "Queries with the same output suffix overwrite "
+                            "each other. Only -cache, -compact, and -l are "
+                            "allowed alongside it, every other option is an "
+                            "error.")
+
+    control.add_argument('-prev', '--previous', default=None, metavar='FILE', type=readable,
+                        help="The path to a previous abcd_fastqc01.txt snapshot. "
+                            "Only series that are new or whose file_source or "
+                            "ftq_* columns changed since that snapshot are "
+                            "output, along with a {stem}_{suffix}_sessions.csv "
+                            "file listing the sessions to reconvert in the "
+                            "-csv format. Read through its own cache with -cache.")
+
+    control.add_argument('-l', '--log-level', metavar='LEVEL',
+                        choices=LOG_LEVELS, default='INFO',
+                        help="Set the minimum logging level. Defaults to INFO.\n"
+                            "Options, in most to least verbose order, are:\n"
+                            f"    {log_levels_str}")
+
+
+    # participant and session argument group
+    part_sess.add_argument('-csv', '--csv', '--participant-session-csv',
+                            default=None, metavar='FILE',type=readable,
+                            help="The path to a comma-separated value file with "
+                                "no header or index column. The file MUST have "
+                                "exactly 1 participant ID, a comma, and then 1 "
+                                "session ID per line. This is the preferred "
+                                "method of passing in exact pairings of "
+                                "participants and sessions to convert.")
+
+    part_sess.add_argument('-ignore', '--ignore-bids', default=None, metavar='DIR', type=readable,
+                            help="The path to an already converted BIDS "
+                                "directory (or its rawdata directory). Every "
+                                "sub-*/ses-* session found there is left out. "
+                                "The session index is cached in a "
+                                "bids_sessions_manifest.json file in OUTPUT_DIR "
+                                "and only changed participant folders are "
+                                "re-listed on later runs into the same OUTPUT_DIR.")
+
+    participants.add_argument('-pid', '--participant-id', nargs='+',
+                                default=None, metavar='PID', type=str,
+                                help="A space-separated exact participant ID "
+                                    "list to filter on. Mutually exclusive "
+                                    "with -ptxt.")
+
+    participants.add_argument('-ptxt', '--participant-txt',
+                                default=None, metavar='FILE', type=readable,
+                                help="The path to a newline-separated plain "
+                                    "text file with exactly 1 participant ID "
+                                    "per line. Mutually exclusive with -pid.")
+
+    sessions.add_argument('-sid', '--session-id', nargs='+', metavar='SID',
+                            choices=SESSIONS,
+                            default=SESSIONS,
+                            help="A space-separated session ID list to filter "
+                                "on. Defaults to all sessions. Mutually "
+                                "exclusive with -stxt.\n"
+                                "Options are:\n"
+                                f"    {sessions_str}")
+
+    sessions.add_argument('-stxt', '--session-txt', metavar='FILE',
+                            default=None,  type=readable,
+                            help="The path to a newline-separated plain text "
+                                "file with exactly 1 session ID per line. "
+                                "Mutually exclusive with -sid.")
+
+
+    return parser.parse_args(argv)
+
+
+def main():
+    # 1. Parse command line arguments
+    args = cli()
+
+    # Set up logging
+    if args.log_level == 'DEBUG':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+    elif args.log_level == 'INFO':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    elif args.log_level == 'WARNING':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.WARNING)
+    elif args.log_level == 'ERROR':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.ERROR)
+    elif args.log_level == 'CRITICAL':
+        logging.basicConfig(format=LOG_FORMAT, level=logging.CRITICAL)
+    else:
+        raise ValueError(f"Invalid log level: {args.log_level}")
+
+    debug(args)
+
+    if args.batch != None:
+        run_batch(args)
+    else:
+        run_single(args)
 
-            # append back in the row 0 for completeness
-            subses_output.loc[-1] = row0
-            subses_output.index = subses_output.index + 1
-            subses_output = subses_output.sort_index()
-            subses_output.to_csv(output_mini_qc, sep='\t', quoting=csv.QUOTE_ALL, index=False)
-            del(subses_output)
 
 if __name__ == '__main__':
     main()
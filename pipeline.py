@@ -1,17 +1,25 @@
 #! /usr/bin/env python3
 
 import argparse
+import json
 import logging
 import os
 import random
+import shlex
 import string
+import subprocess
+import threading
+import time
 
+from functools import partial
 from logging import debug, info, warning, error, critical
 from nipype import Workflow
 from nipype import Node
 from nipype import MapNode
 from nipype import Function
 from nipype.interfaces.base import CommandLine
+from tgz_cache import fetch_cached, store_cached
+from transfer import remove_tree, transfer, transfer_file
 from utilities import readable, available, writable
 
 # Set up logging
@@ -21,6 +29,14 @@ LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 # create help string for the log level option
 log_levels_str = "\n    ".join(LOG_LEVELS)
 
+# --overlap polls for landed TGZs this often, and a TGZ whose size and
+# modification time stayed the same this long counts as completely downloaded
+OVERLAP_POLL_SECONDS = 2
+OVERLAP_SETTLE_SECONDS = 10
+
+# converter threads record their sessions in the same manifest
+MANIFEST_LOCK = threading.RLock()
+
 
 def cli():
 
@@ -54,10 +70,63 @@ def cli():
     parser.add_argument('-d', '--disable-workaround', action='store_true',
                         help='By default (when present), a "corrupt volume" in any func run '
                             'DICOM series [where the first DICOM contains "=RawDataStorage" '
-                            'in field (0002,0002)] is deleted after unpacking and before '
-                            'conversion to BIDS. This flag disables that default feature in '
+                            'in field (0002,0002)] is left out while unpacking (or deleted '
+                            'after unpacking) and before conversion to BIDS. This flag disables that default feature in '
                             'order to preserve the "corrupt volume" DICOMs. This flag will '
                             'make dcm2niix fail.')
+    parser.add_argument('--unpack-engine', choices=['auto', 'pigz', 'igzip', 'gzip', 'python'], default='auto',
+                        help='How to decompress the TGZs. "pigz", "igzip", and "gzip" '
+                            'decompress in a separate process that streams into the tar '
+                            'reader, "python" decompresses with tarfile itself. Defaults '
+                            'to "auto", the first of pigz or igzip that is installed and '
+                            'otherwise "python".')
+    parser.add_argument('--unpack-exclude', nargs='+', default=[], metavar='PATTERN',
+                        help='Shell-style patterns (e.g. "*.zip") of TGZ member paths to '
+                            'never unpack. By default, every member is unpacked.')
+    parser.add_argument('--overlap', action='store_true',
+                        help='Unpack every TGZ as soon as it is completely downloaded, '
+                            'with --n-unpack workers draining the landed TGZs while '
+                            'downloadcmd keeps downloading the rest. By default, all '
+                            'TGZs are downloaded before any are unpacked.')
+    parser.add_argument('--per-session', action='store_true',
+                        help='Implies --overlap. As soon as all of a session\'s TGZs '
+                            'from the S3 links file are unpacked, run that session\'s '
+                            'corrupt volume workaround and dcm2bids conversion with '
+                            '--n-convert workers, while later sessions keep downloading '
+                            'and unpacking. By default, every stage waits for all '
+                            'sessions to finish the stage before it.')
+    parser.add_argument('--engine', choices=['nipype', 'futures'], default='nipype',
+                        help='How to run the download, unpack, and convert stages. '
+                            '"nipype" runs them as nipype workflows, with their working '
+                            'directories, DOT graphs, and MultiProc plugin. "futures" runs '
+                            'the same stage functions directly, unpacking in a process pool '
+                            'and converting in a thread pool, which saves their overhead on '
+                            'small sessions. Defaults to "nipype".')
+    parser.add_argument('--tgz-cache', type=writable, metavar='DIR',
+                        help='A TGZ cache directory shared by every job on the same '
+                            'filesystem. TGZs already in it are hardlinked (or copied) '
+                            'instead of downloaded, and newly downloaded TGZs are added '
+                            'to it. By default, every TGZ is downloaded.')
+    parser.add_argument('--tgz-cache-size', type=float, metavar='GB',
+                        help='The most gigabytes of TGZs to keep in the --tgz-cache, the '
+                            'least recently used TGZs are evicted first. By default, the '
+                            'cache is never evicted.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue a run of the same S3 links file that was '
+                            'interrupted, using the manifest of its completed stages and '
+                            'sessions in the temporary (or output) directory. Stages whose '
+                            'recorded TGZ sizes or series file counts still match are '
+                            'skipped, and so are sessions whose recorded BIDS files all '
+                            'still exist. By default, every stage starts from scratch.')
+    parser.add_argument('--checkpoint-dir', type=writable, metavar='DIR',
+                        help='A persistent directory to keep the --resume manifest in, '
+                            'along with a copy of every converted session\'s BIDS files '
+                            'and of the scans.tsv, so that --resume still works after '
+                            'the temporary (or output) directory is lost, e.g. when a '
+                            'preempted job restarts on another node with a new local '
+                            'scratch. The download and unpack stages of the sessions '
+                            'left to convert then start over. By default, the manifest '
+                            'is only kept in the temporary (or output) directory.')
 
     return parser.parse_args()
 
@@ -82,103 +151,707 @@ def format_dcm2bids_args(bids_session_directory, config_file, output_dir):
     return arguments
 
 
-def unpack_tgz(tgz_file, output_dir):
+def unpack_tgz(tgz_file, output_dir, engine='auto', exclude=None, skip_corrupt=False):
+
+    def corrupt_slices(data, dicom_one_basename):
+        # the other 59 slices of the corrupt first volume, when the first
+        # DICOM of a func run is "Raw Data Storage", see corrupt_volume_removal
+        import io
+        import pydicom
+
+        try:
+            dicom_one_meta = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True)
+            if dicom_one_meta.file_meta.MediaStorageSOPClassUID.name != 'Raw Data Storage':
+                return set()
+            num_temporal_positions = int(dicom_one_meta[0x2001,0x1081].value)
+        except Exception as e:
+            # leave it to the corrupt volume workaround to complain
+            print(f'WARNING: Unable to check {dicom_one_basename} while unpacking: {e}')
+            return set()
+
+        return set(dicom_one_basename.replace('000001', str((i * num_temporal_positions) + 1).zfill(6))
+                   for i in range(1, 60))
+
+    def extract_members(tar):
+        # extract one member at a time, never writing the excluded members
+        # or the corrupt first volume slices of func runs
+        from fnmatch import fnmatch
+
+        directories = []
+        corrupt = {}
+        skipped = {}
+
+        for member in tar:
+            if any(fnmatch(member.name, pattern) for pattern in exclude):
+                continue
+
+            if member.isdir():
+                directories.append(member)
+                tar.extract(member, output_dir, set_attrs=False)
+                continue
+
+            run_dir, basename = posixpath.split(member.name)
+            if skip_corrupt and member.isfile() and run_dir.split('/')[-2:-1] == ['func']:
+                if basename.endswith('_dicom000001.dcm') and run_dir not in corrupt:
+                    # stream mode can't go back, so write the read DICOM 1 directly
+                    data = tar.extractfile(member).read()
+                    corrupt[run_dir] = corrupt_slices(data, basename)
+
+                    path = os.path.join(output_dir, member.name)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                    tar.chmod(member, path)
+                    tar.utime(member, path)
+                    continue
+
+                if basename in corrupt.get(run_dir, set()):
+                    skipped.setdefault(run_dir, []).append(basename)
+                    continue
+
+            tar.extract(member, output_dir)
+
+        # set the directory times last, like extractall
+        for member in sorted(directories, key=lambda m: m.name, reverse=True):
+            path = os.path.join(output_dir, member.name)
+            tar.utime(member, path)
+            tar.chmod(member, path)
+
+        # record the slices left out for corrupt_volume_removal and scans.tsv
+        for run_dir, basenames in skipped.items():
+            record = os.path.join(output_dir, '.corrupt_volumes', '_'.join(run_dir.split('/')[-4:]) + '.json')
+            os.makedirs(os.path.dirname(record), exist_ok=True)
+            with open(record, 'w') as f:
+                json.dump({'func_run': os.path.join(output_dir, run_dir), 'skipped': sorted(basenames)}, f, indent=4)
+
+    import json
+    import os
+    import posixpath
+    import shutil
+    import subprocess
     import tarfile
 
-    with tarfile.open(tgz_file, 'r:gz') as tar:
-        tar.extractall(output_dir)
-    
+    # the external gzip decompressors to try for the "auto" engine, fastest first
+    decompressors = ['pigz', 'igzip']
+    buffer_size = 4 * 1024 * 1024
+
+    if exclude is None:
+        exclude = []
+
+    # only go member by member when there is something to leave out
+    selective = len(exclude) > 0 or skip_corrupt
+
+    if engine == 'auto':
+        engine = next((d for d in decompressors if shutil.which(d) is not None), 'python')
+
+    if engine == 'python':
+        # single-threaded zlib inflate in this process
+        if selective:
+            with tarfile.open(tgz_file, 'r|gz', copybufsize=buffer_size) as tar:
+                extract_members(tar)
+        else:
+            with tarfile.open(tgz_file, 'r:gz', copybufsize=buffer_size) as tar:
+                tar.extractall(output_dir)
+
+    elif engine in decompressors + ['gzip']:
+        # inflate in a separate (multi-threaded for pigz) process and stream
+        # its output straight into the tar reader
+        decompress = subprocess.Popen([engine, '-dc', str(tgz_file)], stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE, bufsize=buffer_size)
+        try:
+            with tarfile.open(fileobj=decompress.stdout, mode='r|', copybufsize=buffer_size) as tar:
+                if selective:
+                    extract_members(tar)
+                else:
+                    tar.extractall(output_dir)
+
+            # drain the end of archive padding so the decompressor exits cleanly
+            while decompress.stdout.read(buffer_size):
+                pass
+        finally:
+            decompress.stdout.close()
+            stderr = decompress.stderr.read().decode(errors='replace')
+            decompress.stderr.close()
+            decompress.wait()
+
+        if decompress.returncode != 0:
+            raise tarfile.ReadError(f'{engine} failed to decompress {tgz_file}: {stderr.strip()}')
+
+    else:
+        raise ValueError(f'Invalid unpack engine: {engine}')
+
     return output_dir
 
 
-def corrupt_volume_check(func_dcm):
-    import os
-    import pydicom
+def get_unpack_options(args):
+    # how to unpack every TGZ, skipping the corrupt volumes while unpacking
+    # only when the workaround runs, which it only does for BIDS conversions,
+    # so that preserved DICOMs are never left half corrected
+    return {
+        'engine': args.unpack_engine,
+        'exclude': args.unpack_exclude,
+        'skip_corrupt': not args.disable_workaround and 'BIDS' in args.preserve,
+    }
+
 
-    dicom_one_meta = pydicom.dcmread(func_dcm)
+def landed_tgzs(pattern, sizes, downloading):
+    # TGZs the downloader is done with: all of them once it exits, otherwise
+    # the ones whose size and modification time stopped changing a while ago
+    from glob import glob
 
-    if dicom_one_meta.file_meta.MediaStorageSOPClassUID.name == 'Raw Data Storage':
-        func_run = os.path.dirname(func_dcm)
+    landed = []
+    now = time.time()
 
-    else:
-        func_run = ''
-
-    return func_run
-
-
-def corrupt_volume_removal(func_run):
-
-    def rename_scan(series):
-        import re
-        from pathlib import Path
-
-        scan = Path(series)
-        basename = scan.name
-        funcdir = scan.parent
-        if 'rsfMRI' in basename:
-            task = 'rest'
-        elif 'MID' in basename:
-            task = 'MID'
-        elif 'SST' in basename:
-            task = 'SST'
-        elif 'nBack' in basename:
-            task = 'nback'
-
-        glob_expression = re.sub(r'_run-\d+', '_run-*', str(basename))
-        scans = sorted([str(x) for x in funcdir.glob(glob_expression) if x.is_dir()])
-        for i, scandir in enumerate(scans):
-            run = i + 1
-            if scandir == str(scan):
+    for tgz_file in glob(pattern):
+        try:
+            stat = os.stat(tgz_file)
+        except FileNotFoundError:
+            continue
+
+        signature = (stat.st_size, stat.st_mtime)
+        if not downloading or (sizes.get(tgz_file) == signature and now - stat.st_mtime >= OVERLAP_SETTLE_SECONDS):
+            landed.append(tgz_file)
+
+        sizes[tgz_file] = signature
+
+    return sorted(landed)
+
+
+def overlap_download_unpack(download_args, output_tgz_root, output_dicom_root, n_unpack, log_dir, on_unpacked=None,
+                            unpack_options=None, skip_sessions=None):
+    # run downloadcmd in the background and unpack every TGZ as it lands,
+    # calling on_unpacked(tgz_file) after each one, without download_args
+    # only the TGZs already there are unpacked, and never the TGZs of the
+    # (sub-*, ses-*) skip_sessions
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    os.makedirs(output_tgz_root, exist_ok=True)
+    os.makedirs(output_dicom_root, exist_ok=True)
+    os.makedirs(f'{log_dir}/download', exist_ok=True)
+    os.makedirs(f'{log_dir}/unpack', exist_ok=True)
+
+    pattern = f'{output_tgz_root}/image03/*.tgz'
+    sizes = {}
+    submitted = {}
+    unpacked = []
+    retry = set()
+
+    with open(f'{log_dir}/download/downloadcmd.log', 'w') as download_log, \
+            ProcessPoolExecutor(max_workers=n_unpack) as executor:
+
+        if download_args is not None:
+            command = ['downloadcmd'] + shlex.split(download_args)
+            info(f'Running in the background: {" ".join(command)}')
+            downloader = subprocess.Popen(command, stdout=download_log, stderr=subprocess.STDOUT)
+        else:
+            downloader = None
+
+        pending = {}
+        while True:
+            downloading = downloader is not None and downloader.poll() is None
+
+            # queue every newly landed TGZ, and once downloading stopped,
+            # the ones that failed to unpack while it was still running
+            for tgz_file in landed_tgzs(pattern, sizes, downloading):
+                if skip_sessions is not None and tgz_session(tgz_file) in skip_sessions:
+                    continue
+
+                if tgz_file not in submitted or (not downloading and tgz_file in retry):
+                    retry.discard(tgz_file)
+                    debug(f'Unpacking {tgz_file}')
+                    future = executor.submit(unpack_tgz, tgz_file, output_dicom_root, **(unpack_options or {}))
+                    submitted[tgz_file] = downloading
+                    pending[future] = tgz_file
+
+            # a TGZ to retry that disappeared is left for downloadcmd to report
+            if not downloading and len(retry) > 0:
+                warning(f'TGZs gone before they could be unpacked again: {sorted(retry)}')
+                retry.clear()
+
+            if not downloading and len(pending) == 0:
                 break
 
-        subsesdir = str(funcdir.parent)
-        subject = subsesdir.split('/')[-2]
-        session = subsesdir.split('/')[-1]
-        newname = f'{subject}/{session}/func/{subject}_{session}_task-{task}_run-{run:02}_bold.nii.gz'
+            done, _ = wait(list(pending), timeout=OVERLAP_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            if len(pending) == 0:
+                time.sleep(OVERLAP_POLL_SECONDS)
+
+            for future in done:
+                tgz_file = pending.pop(future)
+                try:
+                    future.result()
+                    unpacked.append(tgz_file)
+                    if on_unpacked is not None:
+                        on_unpacked(tgz_file)
+                except Exception as e:
+                    # a TGZ that was still being written gets another try
+                    if submitted[tgz_file]:
+                        warning(f'Unpacking {tgz_file} failed while downloading, retrying later: {e}')
+                        retry.add(tgz_file)
+                    else:
+                        raise
+
+    with open(f'{log_dir}/unpack/unpacked_tgzs.txt', 'w') as f:
+        for tgz_file in unpacked:
+            f.write(f'{tgz_file}\n')
+
+    if downloader is not None and downloader.returncode != 0:
+        raise RuntimeError(f'downloadcmd exited with code {downloader.returncode}, see {log_dir}/download/downloadcmd.log')
+
+    info(f'Downloaded and unpacked {len(unpacked)} TGZs')
+
+    return unpacked
+
+
+def tgz_session(tgz_file):
+    # NDARINVxxxxxxxx_baselineYear1Arm1_ABCD-T1_..._.tgz unpacks into DICOM/sub-NDARINVxxxxxxxx/ses-baselineYear1Arm1
+    participant, session = os.path.basename(tgz_file).split('_')[:2]
+    return f'sub-{participant}', f'ses-{session}'
+
+
+def convert_session(session_dir, config_file, output_bids_root, workaround, log_dir, scans_lock):
+    # run one DICOM session through the corrupt volume workaround and dcm2bids
+    participant, session = session_dir.split('/')[-2:]
+
+    if workaround:
+        # every session appends to the same scans.tsv
+        func_runs = collect_glob(f'{session_dir}/func/*', 'directories')
+        corrected = corrupt_volume_workaround(func_runs, scans_lock=scans_lock)
+
+        with open(f'{log_dir}/workaround/{participant}_{session}_corrected.txt', 'w') as f:
+            for func_run in corrected:
+                f.write(f'{func_run}\n')
+
+    arguments = format_dcm2bids_args(session_dir, config_file, output_bids_root)
+    with open(f'{log_dir}/convert/{participant}_{session}_dcm2bids.log', 'w') as log:
+        subprocess.run(['dcm2bids'] + shlex.split(arguments), stdout=log, stderr=subprocess.STDOUT, check=True)
+
+    return session_dir
+
+
+def stream_sessions(download_args, input_s3_links, output_tgz_root, output_dicom_root, output_bids_root,
+                    config_file, n_unpack, n_convert, workaround, log_dir, unpack_options=None, on_converted=None,
+                    skip_sessions=None):
+    # download and unpack like --overlap, converting every session as soon
+    # as all of its TGZs from the S3 links file are unpacked, and calling
+    # on_converted(session_dir) from the converter thread after each one
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    os.makedirs(output_bids_root, exist_ok=True)
+    os.makedirs(f'{log_dir}/convert', exist_ok=True)
+    if workaround:
+        os.makedirs(f'{log_dir}/workaround', exist_ok=True)
+
+    # the TGZs still to be unpacked for every session
+    remaining = {}
+    with open(input_s3_links, 'r') as f:
+        for line in f.readlines():
+            line = line.strip()
+            if line != '':
+                remaining.setdefault(tgz_session(line), set()).add(os.path.basename(line))
+
+    info(f'Streaming {len(remaining)} sessions through all stages')
+
+    scans_lock = threading.Lock()
+    unpacked_sessions = set()
+    submitted = set()
+    converting = {}
+
+    with ThreadPoolExecutor(max_workers=n_convert) as converter:
+
+        def submit(key):
+            submitted.add(key)
+            session_dir = f'{output_dicom_root}/{key[0]}/{key[1]}'
+            if not os.path.isdir(session_dir):
+                warning(f'No DICOMs were unpacked for {key[0]} {key[1]}, skipping its conversion')
+                return
+
+            info(f'Converting {key[0]} {key[1]}')
+            future = converter.submit(convert_session, session_dir, config_file, output_bids_root,
+                                      workaround, log_dir, scans_lock)
+            converting[future] = key
+            if on_converted is not None:
+                future.add_done_callback(lambda f: f.exception() is None and on_converted(f.result()))
+
+        def on_unpacked(tgz_file):
+            key = tgz_session(tgz_file)
+            unpacked_sessions.add(key)
+
+            if key in remaining:
+                remaining[key].discard(os.path.basename(tgz_file))
+                if len(remaining[key]) == 0:
+                    del remaining[key]
+                    submit(key)
+
+        overlap_download_unpack(download_args, output_tgz_root, output_dicom_root, n_unpack, log_dir, on_unpacked,
+                                unpack_options, skip_sessions)
+
+        # convert what there is of sessions that are missing TGZs, and of
+        # sessions that were unpacked without being in the S3 links file
+        for key in sorted(remaining):
+            warning(f'{key[0]} {key[1]} is missing {len(remaining[key])} TGZs, converting it anyway')
+            submit(key)
+
+        for key in sorted(unpacked_sessions):
+            if key not in submitted:
+                submit(key)
 
-        return newname
+        failed = []
+        for future in as_completed(converting):
+            key = converting[future]
+            try:
+                future.result()
+            except Exception as e:
+                error(f'Converting {key[0]} {key[1]} failed: {e}')
+                failed.append(key)
+
+    if len(failed) > 0:
+        raise RuntimeError(f'{len(failed)} of {len(converting)} sessions failed to convert: {sorted(failed)}')
+
+    info(f'Converted {len(converting)} sessions')
+
+
+def download_tgzs(download_args, output_tgz_root, log_dir):
+    # the --engine futures download stage, downloadcmd without a nipype node
+    os.makedirs(output_tgz_root, exist_ok=True)
+    os.makedirs(f'{log_dir}/download', exist_ok=True)
+
+    command = ['downloadcmd'] + shlex.split(download_args)
+    info(f'Running: {" ".join(command)}')
+    with open(f'{log_dir}/download/downloadcmd.log', 'w') as download_log:
+        downloader = subprocess.run(command, stdout=download_log, stderr=subprocess.STDOUT)
+
+    if downloader.returncode != 0:
+        raise RuntimeError(f'downloadcmd exited with code {downloader.returncode}, see {log_dir}/download/downloadcmd.log')
+
+
+def unpack_tgzs(tgz_files, output_dicom_root, n_unpack, log_dir, unpack_options=None):
+    # the --engine futures unpack stage, decompressing is CPU bound so every
+    # TGZ gets one of n_unpack processes
+    from concurrent.futures import ProcessPoolExecutor
+
+    os.makedirs(output_dicom_root, exist_ok=True)
+    os.makedirs(f'{log_dir}/unpack', exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=n_unpack) as executor:
+        unpacking = {executor.submit(unpack_tgz, tgz_file, output_dicom_root, **(unpack_options or {})): tgz_file
+                     for tgz_file in tgz_files}
+
+    unpacked = []
+    failed = []
+    for future, tgz_file in unpacking.items():
+        try:
+            future.result()
+            unpacked.append(tgz_file)
+        except Exception as e:
+            error(f'Unpacking {tgz_file} failed: {e}')
+            failed.append(tgz_file)
 
-    import os
-    import pydicom
-    from glob import glob
+    with open(f'{log_dir}/unpack/unpacked_tgzs.txt', 'w') as f:
+        for tgz_file in unpacked:
+            f.write(f'{tgz_file}\n')
+
+    if len(failed) > 0:
+        raise RuntimeError(f'{len(failed)} of {len(tgz_files)} TGZs failed to unpack: {failed}')
+
+    info(f'Unpacked {len(unpacked)} TGZs')
+
+
+def convert_sessions(session_dirs, config_file, output_bids_root, n_convert, log_dir, on_converted=None):
+    # the --engine futures convert stage, dcm2bids runs in its own process
+    # so n_convert threads are enough to keep n_convert of them busy,
+    # calling on_converted(session_dir) after each one
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    os.makedirs(output_bids_root, exist_ok=True)
+    os.makedirs(f'{log_dir}/convert', exist_ok=True)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=n_convert) as converter:
+        converting = {converter.submit(convert_session, session_dir, config_file, output_bids_root,
+                                       False, log_dir, None): session_dir
+                      for session_dir in session_dirs}
+
+        for future in as_completed(converting):
+            session_dir = converting[future]
+            try:
+                future.result()
+                if on_converted is not None:
+                    on_converted(session_dir)
+            except Exception as e:
+                error(f'Converting {session_dir} failed: {e}')
+                failed.append(session_dir)
+
+    if len(failed) > 0:
+        raise RuntimeError(f'{len(failed)} of {len(session_dirs)} sessions failed to convert: {failed}')
+
+    info(f'Converted {len(session_dirs)} sessions')
+
+
+def read_manifest(manifest_file):
+    # the stages and sessions a run completed, as written by write_manifest
+    if not os.path.exists(manifest_file):
+        return {'download': None, 'unpack': None, 'convert': {}}
+
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_file, manifest):
+    # replace the manifest in one step, so that an interrupted run never
+    # leaves a partial one behind
+    with MANIFEST_LOCK:
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+        with open(f'{manifest_file}.tmp', 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(f'{manifest_file}.tmp', manifest_file)
 
-    if func_run == '':
+
+def tgz_sizes(output_tgz_root):
+    # every downloaded TGZ's name and size
+    return {os.path.basename(tgz_file): os.path.getsize(tgz_file)
+            for tgz_file in collect_glob(f'{output_tgz_root}/image03/*.tgz', 'files')}
+
+
+def series_file_counts(series_dirs, output_dicom_root):
+    # the number of files in every unpacked series directory, relative to output_dicom_root
+    counts = {}
+    for series_dir in series_dirs:
+        with os.scandir(series_dir) as entries:
+            counts[os.path.relpath(series_dir, output_dicom_root)] = sum(1 for entry in entries if entry.is_file())
+
+    return counts
+
+
+def session_outputs(session_dir, output_bids_root):
+    # every BIDS file converted from one DICOM session, relative to output_bids_root
+    participant, session = session_dir.split('/')[-2:]
+    outputs = []
+    for root, _, files in os.walk(f'{output_bids_root}/{participant}/{session}'):
+        outputs += [os.path.relpath(os.path.join(root, file), output_bids_root) for file in files]
+
+    return sorted(outputs)
+
+
+def download_complete(manifest, output_tgz_root):
+    # a recorded download stage whose TGZs are all still there at their sizes
+    if manifest['download'] is None:
         return False
 
-    else:
-        # rename the scan to the BIDS format for scans.tsv
-        alt_name = rename_scan(func_run)
-
-        # in dicom_one, grab the number of temporal positions (2001,1081) and check the number of slices per time point is 60
-        dicom_one = glob(f'{func_run}/*_dicom000001.dcm')[0]
-        dicom_one_meta = pydicom.dcmread(dicom_one)
-        num_temporal_positions = int(dicom_one_meta[0x2001,0x1081].value)
-        func_run_dicoms = [dicom for dicom in glob(f'{func_run}/*.dcm')]
-
-        # if the number of slices per time point is not 60, print an error message
-        if num_temporal_positions * 60 != len(func_run_dicoms):
-            raise ValueError(f'ERROR: {func_run} has {len(func_run_dicoms)} DICOMs, but {num_temporal_positions} temporal positions X 60 does not equal {len(func_run_dicoms)}')
-
-        # remove the entire first corrupt volume by removing 60 slices
-        dicom_one_basename = os.path.basename(dicom_one)
-        for i in range(60):
-            dicom_num = str( (i * num_temporal_positions) + 1 ).zfill(6)
-            dicom_basename = dicom_one_basename.replace('000001', dicom_num)
+    for tgz_name, size in manifest['download'].items():
+        tgz_file = f'{output_tgz_root}/image03/{tgz_name}'
+        if not os.path.isfile(tgz_file) or os.path.getsize(tgz_file) != size:
+            return False
+
+    return True
+
+
+def unpack_complete(manifest, output_dicom_root):
+    # a recorded unpack stage whose series directories all still hold as many files
+    if manifest['unpack'] is None:
+        return False
+
+    for series, count in manifest['unpack'].items():
+        series_dir = f'{output_dicom_root}/{series}'
+        if not os.path.isdir(series_dir):
+            return False
+
+        if series_file_counts([series_dir], output_dicom_root)[series] != count:
+            return False
+
+    return True
+
+
+def converted_sessions(manifest, output_bids_root):
+    # the (sub-*, ses-*) sessions whose recorded BIDS files all still exist
+    converted = set()
+    for session, outputs in manifest['convert'].items():
+        if len(outputs) > 0 and all(os.path.exists(f'{output_bids_root}/{output}') for output in outputs):
+            converted.add(tuple(session.split('/')))
+
+    return converted
+
+
+def copy_files(relpaths, source_root, destination_root):
+    # copy files between two roots, replacing each one in one step so that
+    # a killed job never leaves half a file behind
+    import shutil
+
+    for relpath in relpaths:
+        destination = f'{destination_root}/{relpath}'
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copy2(f'{source_root}/{relpath}', f'{destination}.tmp')
+        os.replace(f'{destination}.tmp', destination)
+
+
+def record_converted(manifest_file, manifest, output_bids_root, session_dir, checkpoint_base_dir=None):
+    # add one converted session's BIDS files to the manifest right away,
+    # converter threads call this concurrently
+    participant, session = session_dir.split('/')[-2:]
+    outputs = session_outputs(session_dir, output_bids_root)
+
+    # the manifest only lists the session once its checkpoint is complete
+    if checkpoint_base_dir != None:
+        copy_files(outputs, output_bids_root, f'{checkpoint_base_dir}/BIDS')
+
+    with MANIFEST_LOCK:
+        output_dir = os.path.dirname(output_bids_root)
+        if checkpoint_base_dir != None and os.path.exists(f'{output_dir}/scans.tsv'):
+            copy_files(['scans.tsv'], output_dir, checkpoint_base_dir)
+
+        manifest['convert'][f'{participant}/{session}'] = outputs
+        write_manifest(manifest_file, manifest)
+
+
+def restore_checkpoint(manifest, checkpoint_base_dir, output_dir):
+    # copy the checkpointed BIDS files and scans.tsv back into a temporary
+    # (or output) directory that lost them, returning the number of files
+    outputs = [output for outputs in manifest['convert'].values() for output in outputs
+               if not os.path.exists(f'{output_dir}/BIDS/{output}')
+               and os.path.exists(f'{checkpoint_base_dir}/BIDS/{output}')]
+    copy_files(outputs, f'{checkpoint_base_dir}/BIDS', f'{output_dir}/BIDS')
+
+    if os.path.exists(f'{checkpoint_base_dir}/scans.tsv') and not os.path.exists(f'{output_dir}/scans.tsv'):
+        copy_files(['scans.tsv'], checkpoint_base_dir, output_dir)
+
+    return len(outputs)
+
+
+def func_run_bids_name(func_run):
+    # the BIDS name of a func run DICOM series for scans.tsv, numbering the
+    # runs of the same task in order of their series directories
+    import re
+    from pathlib import Path
+
+    scan = Path(func_run)
+    basename = scan.name
+    funcdir = scan.parent
+    if 'rsfMRI' in basename:
+        task = 'rest'
+    elif 'MID' in basename:
+        task = 'MID'
+    elif 'SST' in basename:
+        task = 'SST'
+    elif 'nBack' in basename:
+        task = 'nback'
+
+    glob_expression = re.sub(r'_run-\d+', '_run-*', str(basename))
+    scans = sorted([str(x) for x in funcdir.glob(glob_expression) if x.is_dir()])
+    for i, scandir in enumerate(scans):
+        run = i + 1
+        if scandir == str(scan):
+            break
+
+    subsesdir = str(funcdir.parent)
+    subject = subsesdir.split('/')[-2]
+    session = subsesdir.split('/')[-1]
+    newname = f'{subject}/{session}/func/{subject}_{session}_task-{task}_run-{run:02}_bold.nii.gz'
+
+    return newname
+
+
+def corrupt_volume_check(func_runs, n_threads=1):
+    # decide for every func run DICOM series at once whether its first volume
+    # is corrupt, listing each series once and reading only the file meta and
+    # temporal positions of its DICOM 1, in a pool of n_threads threads
+    from concurrent.futures import ThreadPoolExecutor
+    import pydicom
+
+    def check(func_run):
+        dicoms = sorted(entry.name for entry in os.scandir(func_run)
+                        if entry.name.endswith('.dcm') and entry.is_file())
+        dicom_ones = [dicom for dicom in dicoms if dicom.endswith('_dicom000001.dcm')]
+
+        if len(dicom_ones) == 0:
+            return None
+
+        dicom_one_meta = pydicom.dcmread(os.path.join(func_run, dicom_ones[0]), stop_before_pixels=True,
+                                         specific_tags=[(0x0002,0x0002), (0x2001,0x1081)])
+        corrupt = dicom_one_meta.file_meta.MediaStorageSOPClassUID.name == 'Raw Data Storage'
+
+        return {
+            'func_run': func_run,
+            'corrupt': corrupt,
+            'dicom_one': dicom_ones[0],
+            'dicoms': dicoms,
+            # the number of temporal positions (2001,1081)
+            'num_temporal_positions': int(dicom_one_meta[0x2001,0x1081].value) if corrupt else None,
+        }
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return [decision for decision in executor.map(check, func_runs) if decision is not None]
+
+
+def corrupt_volume_removal(decision):
+    # remove the 60 slices of a corrupt first volume found by
+    # corrupt_volume_check, returning the run's scans.tsv filename
+    import json
+
+    func_run = decision['func_run']
+    num_temporal_positions = decision['num_temporal_positions']
+
+    # the corrupt slices unpack_tgz already left out, if any
+    dicom_root = '/'.join(func_run.split('/')[:-4])
+    record = f"{dicom_root}/.corrupt_volumes/{'_'.join(func_run.split('/')[-4:])}.json"
+    skipped = []
+    if os.path.exists(record):
+        with open(record, 'r') as f:
+            skipped = json.load(f)['skipped']
+
+    num_dicoms = len(decision['dicoms']) + len(skipped)
+
+    # if the number of slices per time point is not 60, print an error message
+    if num_temporal_positions * 60 != num_dicoms:
+        raise ValueError(f'ERROR: {func_run} has {num_dicoms} DICOMs, but {num_temporal_positions} temporal positions X 60 does not equal {num_dicoms}')
+
+    # remove the entire first corrupt volume by removing 60 slices
+    for i in range(60):
+        dicom_num = str( (i * num_temporal_positions) + 1 ).zfill(6)
+        dicom_basename = decision['dicom_one'].replace('000001', dicom_num)
+        if dicom_basename not in skipped:
             os.remove(os.path.join(func_run, dicom_basename))
-        
-        # go to the parent folder of the DICOM folder and create a scans.tsv
-        root_relpath = '/'.join(func_run.split('/')[:-5])
-        scans_file = f'{root_relpath}/scans.tsv'
 
-        if not os.path.exists(scans_file):
-            with open(scans_file, 'w') as f:
-                f.write('filename\tcorrupt_volume\n')
-            print(f'Creating "scans.tsv": {scans_file}')
+    return func_run_bids_name(func_run)
+
+
+def corrupt_volume_workaround(func_runs, n_threads=1, scans_lock=None):
+    # check all func runs in one batch, remove the corrupt volumes found, and
+    # list them in the scans.tsv in the parent folder of the DICOM folder
+    from concurrent.futures import ThreadPoolExecutor
 
-        with open(scans_file, 'a') as f:
-            f.write(f'{alt_name}\t1\n')
+    corrupt = [decision for decision in corrupt_volume_check(func_runs, n_threads) if decision['corrupt']]
 
-        return True
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        alt_names = list(executor.map(corrupt_volume_removal, corrupt))
+
+    if scans_lock is None:
+        scans_lock = threading.Lock()
+
+    with scans_lock:
+        listed = {}
+        for decision, alt_name in zip(corrupt, alt_names):
+            root_relpath = '/'.join(decision['func_run'].split('/')[:-5])
+            scans_file = f'{root_relpath}/scans.tsv'
+
+            if not os.path.exists(scans_file):
+                with open(scans_file, 'w') as f:
+                    f.write('filename\tcorrupt_volume\n')
+                info(f'Creating "scans.tsv": {scans_file}')
+
+            # a resumed run corrects its unconverted sessions again, which
+            # must not list their runs twice
+            if scans_file not in listed:
+                with open(scans_file, 'r') as f:
+                    listed[scans_file] = set(line.split('\t')[0] for line in f.read().splitlines()[1:])
+
+            if alt_name in listed[scans_file]:
+                debug(f'{alt_name} is already listed in {scans_file}')
+                continue
+
+            with open(scans_file, 'a') as f:
+                f.write(f'{alt_name}\t1\n')
+            listed[scans_file].add(alt_name)
+
+    return [decision['func_run'] for decision in corrupt]
 
 
 def retrieve_task_events(input_root, output_root):
@@ -287,9 +960,109 @@ def main():
     output_bids_root = f'{output_dir}/BIDS'
     pipeline_base_dir = f'{output_dir}/pipeline'
 
+    # the manifest of the stages and sessions this run completed, kept with
+    # the converted sessions' BIDS files in the checkpoint directory if any
+    if args.checkpoint_dir != None:
+        checkpoint_base_dir = f'{args.checkpoint_dir}/{pipeline_suffix}'
+        manifest_file = f'{checkpoint_base_dir}/manifest.json'
+    else:
+        checkpoint_base_dir = None
+        manifest_file = f'{pipeline_base_dir}/manifest.json'
+
+    s3_links_file = str(args.input_s3_links)
+    converted = set()
+    downloaded = False
+    unpacked = False
+
+    if args.resume and args.preserve != ['LOGS']:
+        manifest = read_manifest(manifest_file)
+
+        if checkpoint_base_dir != None:
+            restored = restore_checkpoint(manifest, checkpoint_base_dir, output_dir)
+            info(f'Restored {restored} BIDS files from the checkpoint in {checkpoint_base_dir}')
+
+        converted = converted_sessions(manifest, output_bids_root)
+        downloaded = download_complete(manifest, output_tgz_root)
+        unpacked = downloaded and unpack_complete(manifest, output_dicom_root)
+        info(f'Resuming with {len(converted)} sessions converted, download '
+             f'{"complete" if downloaded else "incomplete"}, and unpack {"complete" if unpacked else "incomplete"}')
+
+        # only the sessions that are not converted yet are left to download
+        with open(args.input_s3_links, 'r') as f:
+            s3_links = [line.strip() for line in f.readlines() if line.strip() != '']
+
+        os.makedirs(f'{pipeline_base_dir}/download', exist_ok=True)
+        s3_links_file = f'{pipeline_base_dir}/download/resume_s3links.txt'
+        with open(s3_links_file, 'w') as f:
+            for s3_link in s3_links:
+                if tgz_session(s3_link) not in converted:
+                    f.write(f'{s3_link}\n')
+    else:
+        manifest = {'download': None, 'unpack': None, 'convert': {}}
+        if args.preserve != ['LOGS']:
+            # a run that starts from scratch also drops an older checkpoint
+            if checkpoint_base_dir != None:
+                remove_tree(checkpoint_base_dir)
+            write_manifest(manifest_file, manifest)
+
+    on_converted = partial(record_converted, manifest_file, manifest, output_bids_root,
+                           checkpoint_base_dir=checkpoint_base_dir)
+
+    # the downloadcmd arguments
+    download_args = f'-dp {args.package_id} -t {s3_links_file} -d {output_tgz_root} --workerThreads {n_download}'
+
+    # take what the TGZ cache has, and only download the rest
+    if args.tgz_cache is not None and args.preserve != ['LOGS']:
+        if args.tgz_cache_size is not None and args.tgz_cache_size <= 0:
+            raise ValueError(f"Invalid TGZ cache size: {args.tgz_cache_size}")
+
+        with open(s3_links_file, 'r') as f:
+            s3_links = [line.strip() for line in f.readlines() if line.strip() != '']
+
+        uncached = fetch_cached(args.tgz_cache, s3_links, f'{output_tgz_root}/image03')
+        info(f'{len(s3_links) - len(uncached)} of {len(s3_links)} TGZs were in the TGZ cache')
+
+        os.makedirs(f'{pipeline_base_dir}/download', exist_ok=True)
+        uncached_s3_links = f'{pipeline_base_dir}/download/uncached_s3links.txt'
+        with open(uncached_s3_links, 'w') as f:
+            for s3_link in uncached:
+                f.write(f'{s3_link}\n')
+
+        if len(uncached) > 0:
+            download_args = f'-dp {args.package_id} -t {uncached_s3_links} -d {output_tgz_root} --workerThreads {n_download}'
+        else:
+            download_args = None
+
+    # a resumed run whose download stage completed downloads nothing
+    if downloaded:
+        download_args = None
+
+    unpack_options = get_unpack_options(args)
+
+    # only unpack when DICOM or BIDS files are to be produced
+    unpacking = 'DICOM' in args.preserve or 'BIDS' in args.preserve
+
+    # streaming sessions through all stages also overlaps download and unpack
+    if args.per_session:
+        args.overlap = True
+    per_session = args.per_session and 'BIDS' in args.preserve
+
     if args.preserve == ['LOGS']:
         error('Only the LOGS option was selected to be preserved. You MUST choose to preserve something besides LOGS to produce files.')
         return
+    elif per_session:
+        # download, unpack, and convert every session as soon as it can be
+        stream_sessions(download_args, s3_links_file, output_tgz_root, output_dicom_root, output_bids_root,
+                        dcm2bids_config_json, n_unpack, n_convert, not args.disable_workaround, pipeline_base_dir,
+                        unpack_options, on_converted, converted)
+    elif args.overlap and unpacking and not unpacked:
+        # download and unpack at the same time
+        overlap_download_unpack(download_args, output_tgz_root, output_dicom_root, n_unpack, pipeline_base_dir,
+                                unpack_options=unpack_options, skip_sessions=converted)
+    elif download_args is None:
+        info('Every TGZ is already downloaded, nothing to download.')
+    elif args.engine == 'futures':
+        download_tgzs(download_args, output_tgz_root, pipeline_base_dir)
     else:
 
         # make the TGZ directory
@@ -299,8 +1072,7 @@ def main():
 
         # download the TGZ files
         downloadcmd = Node(
-            CommandLine('downloadcmd',
-                args=f'-dp {args.package_id} -t {str(args.input_s3_links)} -d {output_tgz_root} --workerThreads {n_download}'),
+            CommandLine('downloadcmd', args=download_args),
             name='downloadcmd')
 
         ### Create the NDA TGZ downloading workflow ###
@@ -323,9 +1095,38 @@ def main():
         download_results = download_wf.run()
         debug(download_results)
 
-    # decide whether or not to continue with the unpacking
-    if 'DICOM' not in args.preserve and 'BIDS' not in args.preserve:
+    # share the newly downloaded TGZs with later jobs
+    if args.tgz_cache is not None and download_args is not None:
+        budget = None if args.tgz_cache_size is None else int(args.tgz_cache_size * 1024 ** 3)
+        stored = store_cached(args.tgz_cache, uncached, f'{output_tgz_root}/image03', budget)
+        info(f'Added {stored} TGZs to the TGZ cache')
+
+    # record the downloaded TGZs, and the unpacked series if that happened
+    # at the same time
+    if not downloaded:
+        manifest['download'] = tgz_sizes(output_tgz_root)
+        manifest['unpack'] = None
+        if args.overlap and unpacking:
+            series_dirs = collect_glob(f'{output_dicom_root}/sub-*/ses-*/*/*', 'directories')
+            manifest['unpack'] = series_file_counts(series_dirs, output_dicom_root)
+        write_manifest(manifest_file, manifest)
+
+    # decide whether or not to continue with the unpacking, the TGZs of
+    # already converted sessions are not needed again
+    if unpacking:
+        tgz_files = [tgz_file for tgz_file in collect_glob(f'{output_tgz_root}/image03/*.tgz', 'files')
+                     if tgz_session(tgz_file) not in converted]
+
+    if not unpacking:
         warning('DICOM and BIDS intermediary files are not to be preserved and will not be produced.')
+    elif args.overlap:
+        info('All TGZs were already unpacked while downloading.')
+    elif unpacked:
+        info('All TGZs were already unpacked before resuming.')
+    elif len(tgz_files) == 0:
+        warning('There are no TGZs left to unpack.')
+    elif args.engine == 'futures':
+        unpack_tgzs(tgz_files, output_dicom_root, n_unpack, pipeline_base_dir, unpack_options)
     else:
 
         # make the DICOM directory
@@ -333,29 +1134,21 @@ def main():
             CommandLine('mkdir', args=f'-p {output_dicom_root}'),
             name='mkdir_dicom')
 
-        # collect the input DICOM sessions
-        collect_tgzs = Node(
-            Function(
-                function=collect_glob,
-                input_names=['pattern', 'mode'],
-                output_names=['output_list']
-            ),
-            name='collect_tgzs')
-
-        collect_tgzs.inputs.pattern = f'{output_tgz_root}/image03/*.tgz'
-        collect_tgzs.inputs.mode = 'files'
-
         # unpack the TGZ files
         unpack_tgz_node = MapNode(
             Function(
                 function=unpack_tgz,
-                input_names=['tgz_file', 'output_dir'],
+                input_names=['tgz_file', 'output_dir', 'engine', 'exclude', 'skip_corrupt'],
                 output_names=['output_dir']
             ),
             iterfield=['tgz_file'],
             name='unpack_tgz')
         
+        unpack_tgz_node.inputs.tgz_file = tgz_files
         unpack_tgz_node.inputs.output_dir = output_dicom_root
+        unpack_tgz_node.inputs.engine = unpack_options['engine']
+        unpack_tgz_node.inputs.exclude = unpack_options['exclude']
+        unpack_tgz_node.inputs.skip_corrupt = unpack_options['skip_corrupt']
         
         ### Create the TGZ unpacking workflow ###
         unpack_wf = Workflow(
@@ -365,13 +1158,11 @@ def main():
 
         unpack_wf.add_nodes([
             mkdir_dicom,
-            collect_tgzs,
             unpack_tgz_node,
         ])
 
         unpack_wf.connect([
-            (mkdir_dicom, collect_tgzs, []),
-            (collect_tgzs, unpack_tgz_node, [('output_list', 'tgz_file')]),
+            (mkdir_dicom, unpack_tgz_node, []),
         ])
 
         # Run the unpacking workflow
@@ -379,250 +1170,159 @@ def main():
         unpack_results = unpack_wf.run(plugin='MultiProc', plugin_args={'n_procs' : n_unpack})
         debug(unpack_results)
 
+    # record the unpacked series
+    if unpacking and not args.overlap and not unpacked:
+        series_dirs = collect_glob(f'{output_dicom_root}/sub-*/ses-*/*/*', 'directories')
+        manifest['unpack'] = series_file_counts(series_dirs, output_dicom_root)
+        write_manifest(manifest_file, manifest)
+
 
     # decide whether or not to continue with the conversion
     if 'BIDS' not in args.preserve:
         warning('BIDS files are not to be preserved and so will not be produced.')
+    elif per_session:
+        info('All sessions were already converted while streaming.')
     else:
 
-        ### Create the DICOM to BIDS conversion workflow ###
-        # make the BIDS directory
-        mkdir_bids = Node(
-            CommandLine('mkdir', args=f'-p {output_bids_root}'),
-            name='mkdir_bids')
-
-        # collect the input DICOM sessions
-        collect_dicom_sessions = Node(
-            Function(
-                function=collect_glob,
-                input_names=['pattern', 'mode'],
-                output_names=['output_list']
-            ),
-            name='collect_dicom_sessions')
-
-        collect_dicom_sessions.inputs.pattern = f'{output_dicom_root}/sub-*/ses-*'
-        collect_dicom_sessions.inputs.mode = 'directories'
+        # collect the DICOM sessions that are not converted yet
+        session_dirs = [session_dir for session_dir in collect_glob(f'{output_dicom_root}/sub-*/ses-*', 'directories')
+                        if tuple(session_dir.split('/')[-2:]) not in converted]
 
         # as long as the workaround is not disabled, remove the corrupt volumes
         if not args.disable_workaround:
-            # collect all func DICOM 1's
-            collect_func_dcms = Node(
-                Function(
-                    function=collect_glob,
-                    input_names=['pattern', 'mode'],
-                    output_names=['output_list']
-                ),
-                name='collect_func_dcms')
-
-            collect_func_dcms.inputs.pattern = f'{output_dicom_root}/sub-*/ses-*/func/*/*_dicom000001.dcm'
-            collect_func_dcms.inputs.mode = 'files'
-
-            # check for corrupt volumes
-            check_corrupt_volumes = MapNode(
+            # check all func runs in one batch
+            os.makedirs(f'{pipeline_base_dir}/workaround', exist_ok=True)
+            func_runs = [func_run for session_dir in session_dirs
+                         for func_run in collect_glob(f'{session_dir}/func/*', 'directories')]
+            corrected = corrupt_volume_workaround(func_runs, n_convert)
+            info(f'Removed the corrupt volume of {len(corrected)} of {len(func_runs)} func runs')
+
+            with open(f'{pipeline_base_dir}/workaround/corrected_func_runs.txt', 'w') as f:
+                for func_run in corrected:
+                    f.write(f'{func_run}\n')
+
+            # the corrected series hold fewer files than were unpacked
+            if len(corrected) > 0 and manifest['unpack'] is not None:
+                manifest['unpack'].update(series_file_counts(corrected, output_dicom_root))
+                write_manifest(manifest_file, manifest)
+
+        if len(session_dirs) == 0:
+            info('All sessions were already converted before resuming.')
+        elif args.engine == 'futures':
+            convert_sessions(session_dirs, dcm2bids_config_json, output_bids_root, n_convert, pipeline_base_dir,
+                             on_converted)
+        else:
+            ### Create the DICOM to BIDS conversion workflow ###
+            # make the BIDS directory
+            mkdir_bids = Node(
+                CommandLine('mkdir', args=f'-p {output_bids_root}'),
+                name='mkdir_bids')
+
+            # setup for the DICOM to BIDS conversion
+            format_args = MapNode(
                 Function(
-                    function=corrupt_volume_check,
-                    input_names=['func_dcm'],
-                    output_names=['func_run']
+                    function=format_dcm2bids_args,
+                    input_names=['bids_session_directory', 'config_file', 'output_dir'],
+                    output_names=['arguments']
                 ),
-                iterfield=['func_dcm'],
-                name='check_corrupt_volumes')
-
-            # remove any found corrupt volumes
-            remove_corrupt_volume = MapNode(
-                Function(
-                    function=corrupt_volume_removal,
-                    input_names=['func_run'],
-                    output_names=['is_corrected']
-                ),
-                iterfield=['func_run'],
-                name='remove_corrupt_volume')
-
-            # define workaround workflow
-            workaround_wf = Workflow(
-                name="workaround",
+                iterfield=['bids_session_directory'],
+                name='format_args')
+
+            format_args.inputs.bids_session_directory = session_dirs
+            format_args.inputs.config_file = dcm2bids_config_json
+            format_args.inputs.output_dir = output_bids_root
+
+            # DICOM to BIDS conversion MapNode
+            dcm2bids = MapNode(
+                CommandLine('dcm2bids'),
+                iterfield=['args'],
+                name='dcm2bids')
+
+            ### Create the DICOM to BIDS conversion workflow ###
+            convert_wf = Workflow(
+                name="convert",
                 base_dir=pipeline_base_dir,
             )
 
-            workaround_wf.add_nodes([
-                collect_func_dcms,
-                check_corrupt_volumes,
-                remove_corrupt_volume
+            convert_wf.add_nodes([
+                mkdir_bids,
+                format_args,
+                dcm2bids
             ])
 
-            workaround_wf.connect([
-                (collect_func_dcms, check_corrupt_volumes, [('output_list', 'func_dcm')]),
-                (check_corrupt_volumes, remove_corrupt_volume, [('func_run', 'func_run')])
+            convert_wf.connect([
+                (mkdir_bids, format_args, []),
+                (format_args, dcm2bids, [('arguments', 'args')]),
             ])
 
-            # Run the workaround workflow
-            workaround_wf.write_graph("workaround.dot")
-            workaround_results = workaround_wf.run(plugin='MultiProc', plugin_args={'n_procs' : n_convert})
-            debug(workaround_results)
+            # Run the conversion workflow
+            convert_wf.write_graph("convert.dot")
+            convert_results = convert_wf.run(plugin='MultiProc', plugin_args={'n_procs' : n_convert})
+            debug(convert_results)
 
-        # setup for the DICOM to BIDS conversion
-        format_args = MapNode(
-            Function(
-                function=format_dcm2bids_args,
-                input_names=['bids_session_directory', 'config_file', 'output_dir'],
-                output_names=['arguments']
-            ),
-            iterfield=['bids_session_directory'],
-            name='format_args')
+            # nipype only returns once every session converted
+            for session_dir in session_dirs:
+                on_converted(session_dir)
 
-        format_args.inputs.config_file = dcm2bids_config_json
-        format_args.inputs.output_dir = output_bids_root
-
-        # DICOM to BIDS conversion MapNode
-        dcm2bids = MapNode(
-            CommandLine('dcm2bids'),
-            iterfield=['args'],
-            name='dcm2bids')
-
-        ### Create the DICOM to BIDS conversion workflow ###
-        convert_wf = Workflow(
-            name="convert",
-            base_dir=pipeline_base_dir,
-        )
-
-        convert_wf.add_nodes([
-            mkdir_bids,
-            collect_dicom_sessions,
-            format_args,
-            dcm2bids
-        ])
-
-        convert_wf.connect([
-            (mkdir_bids, collect_dicom_sessions, []),
-            (collect_dicom_sessions, format_args, [('output_list', 'bids_session_directory')]),
-            (format_args, dcm2bids, [('arguments', 'args')]),
-        ])
-
-        # Run the conversion workflow
-        convert_wf.write_graph("convert.dot")
-        convert_results = convert_wf.run(plugin='MultiProc', plugin_args={'n_procs' : n_convert})
-        debug(convert_results)
 
+    # move the preserved files with as many threads as any stage used
+    n_transfer = max(n_download, n_unpack, n_convert)
 
     if 'BIDS' in args.preserve:
-        # make the BIDS rawdata output directory
-        mkdir_bids = Node(
-            CommandLine('mkdir', args=f'-p {cleanup_dir}/rawdata'),
-            name='mkdir_bids')
-        mkdir_bids_results = mkdir_bids.run()
-        debug(mkdir_bids_results)
-
         # retrieve the scans.tsv file if it's there and uniquely identify it
         scans_tsv = f'{output_dir}/scans.tsv'
         if os.path.exists(scans_tsv):
             temp_string = ''.join(random.choices(string.ascii_uppercase + '123456789', k=8))
             scans_tsv_unique = f'{cleanup_dir}/rawdata/scans_{temp_string}.tsv'
-            rsync_scans = Node(
-                CommandLine('rsync', args=f'-art {scans_tsv} {scans_tsv_unique}'),
-                name='rsync_scans')
-            rsync_scans_results = rsync_scans.run()
-            debug(rsync_scans_results)
+            transfer_file(scans_tsv, scans_tsv_unique)
 
         # move the BIDS files to the output directory
-        rsync_bids = Node(
-            CommandLine('rsync', args=f'-art {output_bids_root}/sub-* {cleanup_dir}/rawdata/'),
-            name='rsync_bids')
-        rsync_bids_results = rsync_bids.run()
-        debug(rsync_bids_results)
+        transfer(f'{output_bids_root}/sub-*', f'{cleanup_dir}/rawdata', n_transfer)
 
         # retrieve the task events
-        task_events = Node(
-            Function(
-                function=retrieve_task_events,
-                input_names=['input_root', 'output_root']
-            ),
-            name='task_events')
-        task_events.inputs.input_root = output_dicom_root
-        task_events.inputs.output_root = cleanup_dir
-        task_events_results = task_events.run()
-        debug(task_events_results)
+        if args.engine == 'futures':
+            retrieve_task_events(output_dicom_root, cleanup_dir)
+        else:
+            task_events = Node(
+                Function(
+                    function=retrieve_task_events,
+                    input_names=['input_root', 'output_root']
+                ),
+                name='task_events')
+            task_events.inputs.input_root = output_dicom_root
+            task_events.inputs.output_root = cleanup_dir
+            task_events_results = task_events.run()
+            debug(task_events_results)
 
         if 'LOGS' in args.preserve:
-            # make the BIDS LOGS output directory
-            mkdir_bids_logs = Node(
-                CommandLine('mkdir', args=f'-p {cleanup_dir}/code/logs/tmp_dcm2bids/log'),
-                name='mkdir_bids_logs')
-            mkdir_bids_logs_results = mkdir_bids_logs.run()
-            debug(mkdir_bids_logs_results)
-
             # move the LOG files to the output directory
-            rsync_bids_logs = Node(
-                CommandLine('rsync', args=f'-art {output_bids_root}/tmp_dcm2bids/log/*.log {cleanup_dir}/code/logs/tmp_dcm2bids/log/'),
-                name='rsync_bids_logs')
-            rsync_bids_logs_results = rsync_bids_logs.run()
-            debug(rsync_bids_logs_results)
+            transfer(f'{output_bids_root}/tmp_dcm2bids/log/*.log', f'{cleanup_dir}/code/logs/tmp_dcm2bids/log',
+                     n_transfer)
 
     if 'DICOM' in args.preserve:
-        # make the DICOM sourcedata output directory
-        mkdir_sddicom = Node(
-            CommandLine('mkdir', args=f'-p {cleanup_dir}/sourcedata/DICOM'),
-            name='mkdir_sdtgz')
-        mkdir_sddicom_results = mkdir_sddicom.run()
-        debug(mkdir_sddicom_results)
-
         # move the DICOM files to the output directory
-        rsync_dicom = Node(
-            CommandLine('rsync', args=f'-art {output_dicom_root}/* {cleanup_dir}/sourcedata/DICOM/'),
-            name='rsync_dicom')
-        rsync_dicom_results = rsync_dicom.run()
-        debug(rsync_dicom_results)
+        transfer(f'{output_dicom_root}/*', f'{cleanup_dir}/sourcedata/DICOM', n_transfer)
 
     if 'TGZ' in args.preserve:
-        # make the TGZ sourcedata output directory
-        mkdir_sdtgz = Node(
-            CommandLine('mkdir', args=f'-p {cleanup_dir}/sourcedata/TGZ'),
-            name='mkdir_sdtgz')
-        mkdir_sdtgz_results = mkdir_sdtgz.run()
-        debug(mkdir_sdtgz_results)
-
         # move the TGZ files to the output directory
-        rsync_tgz = Node(
-            CommandLine('rsync', args=f'-art {output_tgz_root}/* {cleanup_dir}/sourcedata/TGZ/'),
-            name='rsync_tgz')
-        rsync_tgz_results = rsync_tgz.run()
-        debug(rsync_tgz_results)
+        transfer(f'{output_tgz_root}/*', f'{cleanup_dir}/sourcedata/TGZ', n_transfer)
 
 
     if 'LOGS' in args.preserve:
-        # make the LOGS output directory
-        mkdir_logs = Node(
-            CommandLine('mkdir', args=f'-p {cleanup_dir}/code/logs/{pipeline_suffix}'),
-            name='mkdir_logs')
-        mkdir_logs_results = mkdir_logs.run()
-        debug(mkdir_logs_results)
-
-        # sync the LOG files to the output directory
-        rsync_logs = Node(
-            CommandLine('rsync', args=f'-art {pipeline_base_dir}/download {pipeline_base_dir}/unpack {pipeline_base_dir}/convert {cleanup_dir}/code/logs/{pipeline_suffix}/'),
-            name='rsync_logs')
-        rsync_logs_results = rsync_logs.run()
-        debug(rsync_logs_results)
+        # move the LOG files to the output directory
+        for stage in ['download', 'unpack', 'convert']:
+            transfer(f'{pipeline_base_dir}/{stage}', f'{cleanup_dir}/code/logs/{pipeline_suffix}', n_transfer)
 
         if not args.disable_workaround:
-            # sync the workaround LOG files to the output directory
-            rsync_workaround = Node(
-                CommandLine('rsync', args=f'-art {pipeline_base_dir}/workaround {cleanup_dir}/code/logs/{pipeline_suffix}/'),
-                name='rsync_workaround')
-            rsync_workaround_results = rsync_workaround.run()
-            debug(rsync_workaround_results)
+            # move the workaround LOG files to the output directory
+            transfer(f'{pipeline_base_dir}/workaround', f'{cleanup_dir}/code/logs/{pipeline_suffix}', n_transfer)
 
 
+    # remove the temporary directory
     if args.temporary_dir != None:
-        # remove the temporary directory
-        rm_tmp = Node(
-            CommandLine('rm', args=f'-rf {args.temporary_dir}/{pipeline_suffix}'),
-            name='rm_tmp')
+        remove_tree(f'{args.temporary_dir}/{pipeline_suffix}', n_transfer)
     else:
-        rm_tmp = Node(
-            CommandLine('rm', args=f'-rf {args.output_dir}/{pipeline_suffix}'),
-            name='rm_tmp')
-
-    rm_tmp_results = rm_tmp.run()
-    debug(rm_tmp_results)
+        remove_tree(f'{args.output_dir}/{pipeline_suffix}', n_transfer)
 
 
 if __name__ == '__main__':
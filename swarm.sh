@@ -25,6 +25,9 @@ MCR91_DIR=/data/NIMH_scratch/zwallymi/earlea-d2b/abcd-dicom2bids/env_setup/MCR_v
 # These are the space-separated options for the fasttrack2s3.py desired data types
 DATATYPE_OPTIONS="all"
 
+# Leave empty for one session per swarm line, or pack sessions into bundles with a per-bundle lscratch GB and minutes budget like "-bundle 100 240"
+BUNDLE_OPTIONS=""
+
 # This will typically be empty for subjects with fMRI data present, the -d flag is for when there's no func data
 PIPELINE_OPTIONS=""
 
@@ -46,7 +49,7 @@ CODE_DIR=$(readlink -f `dirname $0`)
 TEMP_BASENAME=`date '+%Y-%m-%d'`_`head /dev/urandom | tr -dc A-Z1-9 | head -c8`
 LOG_DIR=${LOG_BASEDIR}/${TEMP_BASENAME}
 mkdir -p $LOG_DIR
-poetry run --directory ${CODE_DIR} python ${CODE_DIR}/fasttrack2s3.py -d ${DATATYPE_OPTIONS} -sep -csv ${SESSIONS_CSV} ${ABCD_FASTQC01} ${LOG_DIR}
+poetry run --directory ${CODE_DIR} python ${CODE_DIR}/fasttrack2s3.py -d ${DATATYPE_OPTIONS} ${BUNDLE_OPTIONS:--sep} -csv ${SESSIONS_CSV} ${ABCD_FASTQC01} ${LOG_DIR}
 
 # create the swarm file
 echo `date` "### Creating the swarm file ###"
@@ -56,18 +59,26 @@ S3LINKS_COMPLETE_FILE=`ls -d ${LOG_DIR}/${ABCD_FASTQC01_BASENAME}_*_s3links.txt`
 OUTPUT_SUFFIX=`basename ${S3LINKS_COMPLETE_FILE} | sed "s|${ABCD_FASTQC01_BASENAME}_||g" | sed "s|_s3links.txt||g"`
 BIDS_OUTPUT_DIR=${BIDS_BASEDIR}/${OUTPUT_SUFFIX}
 mkdir -p ${BIDS_OUTPUT_DIR}
+# Keep the pipeline.py checkpoints off lscratch, so a requeued job can --resume on a new node
+CHECKPOINT_DIR=${BIDS_OUTPUT_DIR}/.checkpoints
+mkdir -p ${CHECKPOINT_DIR}
 
 OUTPUT_PREFIX=`basename ${BIDS_BASEDIR}`
 SWARM_FILE=${LOG_DIR}/${OUTPUT_PREFIX}_${OUTPUT_SUFFIX}.swarm
-cp ${CODE_DIR}/header.swarm ${SWARM_FILE}
+BUNDLES_HEADER=`ls -d ${LOG_DIR}/*/bundles_header.swarm 2>/dev/null`
+if [ -n "${BUNDLES_HEADER}" ] ; then
+    cp ${BUNDLES_HEADER} ${SWARM_FILE}
+else
+    cp ${CODE_DIR}/header.swarm ${SWARM_FILE}
+fi
 echo "#SWARM --logdir ${LOG_DIR}" >> ${SWARM_FILE}
 
-# for each s3links file (each separated session) in the LOG_DIR, run the pipeline, bids_corrections, and rsync back
+# for each s3links file (each separated session or bundle) in the LOG_DIR, run the pipeline, bids_corrections, and rsync back
 for LINK in ${LOG_DIR}/*/*_s3links.txt ; do
     CMD0="DOWNLOADCMD_PATH=/lscratch/\${SLURM_JOB_ID}/pip_install ; mkdir \${DOWNLOADCMD_PATH} ; poetry run --directory ${CODE_DIR} python -m pip install nda-tools -t \${DOWNLOADCMD_PATH} ; poetry run --directory ${CODE_DIR} python ${CODE_DIR}/fix_downloadcmd.py \${DOWNLOADCMD_PATH} ; cp \${DOWNLOADCMD_PATH}/bin/downloadcmd \${DOWNLOADCMD_PATH}/  ; export PATH=\${DOWNLOADCMD_PATH}:\${PATH}"
-    CMD1="poetry run --directory ${CODE_DIR} python ${CODE_DIR}/pipeline.py ${PIPELINE_OPTIONS} -p ${NDA_PACKAGE_ID} -c ${CODE_DIR}/dcm2bids_v3_config.json -z LOGS BIDS --n-download 2 --n-unpack 2 --n-convert 1 -o /lscratch/\${SLURM_JOB_ID} -s ${LINK}"
+    CMD1="poetry run --directory ${CODE_DIR} python ${CODE_DIR}/pipeline.py ${PIPELINE_OPTIONS} -p ${NDA_PACKAGE_ID} -c ${CODE_DIR}/dcm2bids_v3_config.json -z LOGS BIDS --n-download 2 --n-unpack 2 --n-convert 1 -o /lscratch/\${SLURM_JOB_ID} --resume --checkpoint-dir ${CHECKPOINT_DIR} -s ${LINK}"
     CMD2="poetry run --directory ${CODE_DIR} python ${CODE_DIR}/bids_corrections.py -b /lscratch/\${SLURM_JOB_ID}/rawdata -t /lscratch/\${SLURM_JOB_ID} ${CORRECTION_OPTIONS}"
-    CMD3="for BIDS in code rawdata sourcedata ; do if [ -d /lscratch/\${SLURM_JOB_ID}/\${BIDS} ] ; then echo rsyncing from /lscratch/\${SLURM_JOB_ID}/\${BIDS} ; rsync -art /lscratch/\${SLURM_JOB_ID}/\${BIDS} ${BIDS_OUTPUT_DIR}/ ; echo cleaning out /lscratch/\${SLURM_JOB_ID}/\${BIDS} ; rm -rf /lscratch/\${SLURM_JOB_ID}/\${BIDS} ; fi ; done"
+    CMD3="for BIDS in code rawdata sourcedata ; do if [ -d /lscratch/\${SLURM_JOB_ID}/\${BIDS} ] ; then echo rsyncing from /lscratch/\${SLURM_JOB_ID}/\${BIDS} ; rsync -art /lscratch/\${SLURM_JOB_ID}/\${BIDS} ${BIDS_OUTPUT_DIR}/ ; echo cleaning out /lscratch/\${SLURM_JOB_ID}/\${BIDS} ; rm -rf /lscratch/\${SLURM_JOB_ID}/\${BIDS} ; fi ; done ; rm -rf ${CHECKPOINT_DIR}/`basename ${LINK} _s3links.txt`"
 
     echo "${CMD0} ; ${CMD1} ; ${CMD2} ; ${CMD3} ; echo rsync completed to ${BIDS_OUTPUT_DIR}" >> ${SWARM_FILE}
 done
@@ -0,0 +1,54 @@
+import sys
+
+from pathlib import Path
+
+import pandas
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fasttrack2s3 import cli, parse_qc_filter, qc_mask, run_batch
+
+
+def test_qc_filter_connectors():
+    assert parse_qc_filter('ftq_usable == 1 and ftq_complete in 1,2 OR ftq_quality >= 2') == [
+        [('ftq_usable', '==', ['1']), ('ftq_complete', 'in', ['1', '2'])],
+        [('ftq_quality', '>=', [2.0])],
+    ]
+
+
+def test_qc_filter_quoted_connectors():
+    # connectors and commas inside quoted values belong to the values
+    predicate = parse_qc_filter('ftq_notes == "motion and noise" or '
+                                "ftq_notes in 'ghosting, or worse',none and ftq_usable == 1")
+
+    assert predicate == [
+        [('ftq_notes', '==', ['motion and noise'])],
+        [('ftq_notes', 'in', ['ghosting, or worse', 'none']), ('ftq_usable', '==', ['1'])],
+    ]
+
+    input = pandas.DataFrame({
+        'ftq_notes': ['motion and noise', 'ghosting, or worse', 'none', 'motion'],
+        'ftq_usable': ['0', '1', '0', '1'],
+    })
+
+    assert qc_mask(input, predicate).tolist() == [True, True, False, False]
+
+
+@pytest.mark.parametrize('expression', ['ftq_usable', 'ftq_quality > high', 'ftq_usable == 1,2'])
+def test_qc_filter_invalid(expression):
+    with pytest.raises(ValueError):
+        parse_qc_filter(expression)
+
+
+@pytest.mark.parametrize('options', [['-d', 'all-anat'], ['-sep'], ['-qc', 'ftq_usable == 1'], ['-pid', 'NDARINVAAAAAAAA']])
+def test_batch_rejects_query_options(tmp_path, options):
+    qc_input = tmp_path / 'abcd_fastqc01.txt'
+    qc_input.write_text('"file_source"\t"ftq_series_id"\n')
+    batch = tmp_path / 'queries.txt'
+    batch.write_text('-d all\n')
+
+    args = cli([str(qc_input), str(tmp_path), '-batch', str(batch)] + options)
+
+    with pytest.raises(ValueError, match='cannot be combined with -batch'):
+        run_batch(args)
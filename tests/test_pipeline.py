@@ -0,0 +1,143 @@
+import argparse
+import io
+import sys
+import tarfile
+
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('nipype')
+pydicom = pytest.importorskip('pydicom')
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from pipeline import (converted_sessions, corrupt_volume_workaround, get_unpack_options,
+                      read_manifest, record_converted, restore_checkpoint, unpack_tgz)
+
+
+# a func run whose first volume is corrupt, with two temporal positions
+RUN_DIR = 'sub-NDARINVAAAAAAAA/ses-baselineYear1Arm1/func/ABCD-rsfMRI_run-20200101120000'
+DICOM_BASENAME = 'ABCD-rsfMRI_run-20200101120000_dicom{:06d}.dcm'
+NUM_TEMPORAL_POSITIONS = 2
+NUM_DICOMS = NUM_TEMPORAL_POSITIONS * 60
+
+
+def raw_data_storage_dicom():
+    # the DICOM 1 of a corrupt run, which is "Raw Data Storage"
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.66'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.add_new((0x2001, 0x1081), 'IS', NUM_TEMPORAL_POSITIONS)
+
+    buffer = io.BytesIO()
+    try:
+        pydicom.dcmwrite(buffer, dataset, enforce_file_format=True)
+    except TypeError:
+        # pydicom 2
+        pydicom.dcmwrite(buffer, dataset, write_like_original=False)
+
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def corrupt_tgz(tmp_path):
+    tgz_file = tmp_path / 'NDARINVAAAAAAAA_baselineYear1Arm1_ABCD-rsfMRI_20200101120000.tgz'
+
+    with tarfile.open(tgz_file, 'w:gz') as tar:
+        for i in range(1, NUM_DICOMS + 1):
+            body = raw_data_storage_dicom() if i == 1 else b'slice'
+            member = tarfile.TarInfo(f'{RUN_DIR}/{DICOM_BASENAME.format(i)}')
+            member.size = len(body)
+            tar.addfile(member, fileobj=io.BytesIO(body))
+
+    return tgz_file
+
+
+def options(preserve, disable_workaround=False):
+    args = argparse.Namespace(unpack_engine='python', unpack_exclude=[], preserve=preserve,
+                              disable_workaround=disable_workaround)
+    return get_unpack_options(args)
+
+
+def corrupt_slices():
+    return set(DICOM_BASENAME.format(i * NUM_TEMPORAL_POSITIONS + 1) for i in range(1, 60))
+
+
+def test_dicom_only_run_keeps_every_slice(tmp_path, corrupt_tgz):
+    # without BIDS the workaround never runs, so nothing may be skipped either
+    for preserve in [['DICOM'], ['LOGS', 'DICOM']]:
+        assert options(preserve)['skip_corrupt'] is False
+
+        dicom_root = tmp_path / '_'.join(preserve) / 'DICOM'
+        unpack_tgz(corrupt_tgz, dicom_root, **options(preserve))
+
+        unpacked = set(path.name for path in (dicom_root / RUN_DIR).iterdir())
+        assert len(unpacked) == NUM_DICOMS
+        assert not (dicom_root / '.corrupt_volumes').exists()
+
+
+def test_bids_run_skips_corrupt_slices(tmp_path, corrupt_tgz):
+    assert options(['BIDS'])['skip_corrupt'] is True
+    assert options(['BIDS'], disable_workaround=True)['skip_corrupt'] is False
+
+    dicom_root = tmp_path / 'DICOM'
+    unpack_tgz(corrupt_tgz, dicom_root, **options(['BIDS']))
+
+    unpacked = set(path.name for path in (dicom_root / RUN_DIR).iterdir())
+    assert unpacked.isdisjoint(corrupt_slices())
+    assert len(unpacked) == NUM_DICOMS - len(corrupt_slices())
+
+
+def test_resumed_workaround_lists_every_run_once(tmp_path, corrupt_tgz):
+    # a resumed run unpacks and corrects its unconverted sessions again
+    dicom_root = tmp_path / 'sourcedata' / 'DICOM'
+    func_run = str(dicom_root / RUN_DIR)
+
+    for _ in range(2):
+        unpack_tgz(corrupt_tgz, dicom_root, **options(['BIDS']))
+        assert corrupt_volume_workaround([func_run]) == [func_run]
+
+        remaining = set(path.name for path in Path(func_run).iterdir())
+        assert len(remaining) == NUM_DICOMS - 60
+
+    with open(tmp_path / 'sourcedata' / 'scans.tsv', 'r') as f:
+        lines = f.read().splitlines()
+
+    assert lines == [
+        'filename\tcorrupt_volume',
+        'sub-NDARINVAAAAAAAA/ses-baselineYear1Arm1/func/'
+        'sub-NDARINVAAAAAAAA_ses-baselineYear1Arm1_task-rest_run-01_bold.nii.gz\t1',
+    ]
+
+
+def test_checkpoint_restores_converted_sessions(tmp_path):
+    # a requeued job resumes in a new, empty temporary directory
+    bids_file = 'sub-NDARINVAAAAAAAA/ses-baselineYear1Arm1/anat/sub-NDARINVAAAAAAAA_ses-baselineYear1Arm1_T1w.json'
+    first_dir = tmp_path / 'first'
+    (first_dir / 'BIDS' / bids_file).parent.mkdir(parents=True)
+    (first_dir / 'BIDS' / bids_file).write_text('{}')
+    (first_dir / 'scans.tsv').write_text('filename\tcorrupt_volume\n')
+
+    checkpoint_dir = tmp_path / 'checkpoint'
+    manifest_file = str(checkpoint_dir / 'manifest.json')
+    manifest = {'download': None, 'unpack': None, 'convert': {}}
+    record_converted(manifest_file, manifest, str(first_dir / 'BIDS'),
+                     str(first_dir / 'DICOM' / 'sub-NDARINVAAAAAAAA' / 'ses-baselineYear1Arm1'),
+                     checkpoint_base_dir=str(checkpoint_dir))
+
+    second_dir = tmp_path / 'second'
+    manifest = read_manifest(manifest_file)
+    assert converted_sessions(manifest, str(second_dir / 'BIDS')) == set()
+
+    assert restore_checkpoint(manifest, str(checkpoint_dir), str(second_dir)) == 1
+    assert converted_sessions(manifest, str(second_dir / 'BIDS')) == {('sub-NDARINVAAAAAAAA', 'ses-baselineYear1Arm1')}
+    assert (second_dir / 'BIDS' / bids_file).read_text() == '{}'
+    assert (second_dir / 'scans.tsv').read_text() == 'filename\tcorrupt_volume\n'
@@ -0,0 +1,211 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+
+from contextlib import contextmanager
+from logging import debug, info, warning, error, critical
+from pathlib import Path
+
+# temporary files of a job that died while storing are removed after this long
+STALE_TEMPORARY_SECONDS = 24 * 60 * 60
+
+
+def cache_key(s3_link):
+    """
+    Content address of one S3 object in the TGZ cache
+    :param s3_link: S3 path of the TGZ, as it appears in an S3 links file
+    :return: Hexadecimal SHA-256 digest of the S3 path
+    """
+    return hashlib.sha256(s3_link.strip().encode('utf-8')).hexdigest()
+
+
+def cache_paths(cache_dir, s3_link):
+    """
+    Paths of the cached TGZ and its metadata JSON for one S3 object
+    :param cache_dir: TGZ cache directory
+    :param s3_link: S3 path of the TGZ
+    :return: Tuple of the TGZ and metadata JSON Path objects
+    """
+    key = cache_key(s3_link)
+    entry = Path(cache_dir) / 'objects' / key[:2] / key
+    return entry.with_suffix('.tgz'), entry.with_suffix('.json')
+
+
+@contextmanager
+def cache_lock(cache_dir):
+    """
+    Hold the TGZ cache's exclusive lock, shared by every job on the filesystem
+    :param cache_dir: TGZ cache directory
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(Path(cache_dir) / '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def link_or_copy(source, destination):
+    """
+    Hardlink a file, or copy it when hardlinking is impossible (e.g. across filesystems)
+    :param source: File to link or copy
+    :param destination: New path of the file
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def temporary_path(path):
+    """
+    Hidden temporary path next to a cache file, unique across the hosts sharing the cache
+    :param path: Cache file the temporary path stands in for
+    :return: Path of a dotfile in the same directory, named after this host and process
+    """
+    return path.parent / f'.{path.name}.{socket.gethostname()}.{os.getpid()}.tmp'
+
+
+def fetch_cached(cache_dir, s3_links, tgz_dir):
+    """
+    Place every cached TGZ of an S3 links list where downloadcmd would have put it
+    :param cache_dir: TGZ cache directory
+    :param s3_links: List of S3 paths of the TGZs
+    :param tgz_dir: Directory downloadcmd downloads the TGZs into
+    :return: List of the S3 paths that were not in the cache
+    """
+    os.makedirs(tgz_dir, exist_ok=True)
+    missing = []
+
+    for s3_link in s3_links:
+        tgz, metadata = cache_paths(cache_dir, s3_link)
+        destination = Path(tgz_dir) / os.path.basename(s3_link)
+
+        try:
+            with open(metadata, 'r') as f:
+                size = json.load(f)['size']
+
+            # a TGZ that does not match its recorded size is not trusted
+            if os.path.getsize(tgz) != size:
+                warning(f'Cached {tgz} does not match its recorded size, downloading {s3_link} again')
+                missing.append(s3_link)
+                continue
+
+            if destination.exists():
+                destination.unlink()
+            link_or_copy(tgz, destination)
+
+            # the metadata's modification time is the entry's last use
+            os.utime(metadata)
+
+        except (FileNotFoundError, KeyError, ValueError):
+            # never stored, or evicted by another job in the meantime
+            missing.append(s3_link)
+            continue
+
+        debug(f'Using the cached {s3_link}')
+
+    return missing
+
+
+def store_cached(cache_dir, s3_links, tgz_dir, budget=None):
+    """
+    Add every downloaded TGZ of an S3 links list to the cache, then evict down to the budget
+    :param cache_dir: TGZ cache directory
+    :param s3_links: List of S3 paths of the TGZs
+    :param tgz_dir: Directory downloadcmd downloaded the TGZs into
+    :param budget: Maximum total bytes of cached TGZs, or None for no limit
+    :return: Number of TGZs newly stored
+    """
+    stored = 0
+
+    for s3_link in s3_links:
+        source = Path(tgz_dir) / os.path.basename(s3_link)
+        if not source.is_file():
+            continue
+
+        tgz, metadata = cache_paths(cache_dir, s3_link)
+        if metadata.exists():
+            continue
+
+        os.makedirs(tgz.parent, exist_ok=True)
+
+        # link or copy next to the entry first, so that it appears atomically,
+        # under a name that jobs on other hosts with the same pid never share
+        temporary = temporary_path(tgz)
+        link_or_copy(source, temporary)
+        size = os.path.getsize(temporary)
+
+        temporary_metadata = temporary_path(metadata)
+        with open(temporary_metadata, 'w') as f:
+            json.dump({'s3_link': s3_link, 'size': size}, f)
+
+        # an entry is only complete once its metadata exists
+        with cache_lock(cache_dir):
+            os.replace(temporary, tgz)
+            os.replace(temporary_metadata, metadata)
+
+        stored += 1
+
+    if budget is not None:
+        evict_cached(cache_dir, budget)
+
+    return stored
+
+
+def evict_cached(cache_dir, budget):
+    """
+    Remove the least recently used cached TGZs until the cache fits the budget
+    :param cache_dir: TGZ cache directory
+    :param budget: Maximum total bytes of cached TGZs
+    :return: Number of bytes evicted
+    """
+    entries = []
+    total = 0
+    evicted = 0
+
+    with cache_lock(cache_dir):
+        now = time.time()
+
+        for path in (Path(cache_dir) / 'objects').glob('*/*'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            if path.name.startswith('.'):
+                # what is left of a job that died while storing
+                if now - stat.st_mtime > STALE_TEMPORARY_SECONDS:
+                    path.unlink()
+                continue
+
+            if path.suffix != '.tgz':
+                continue
+
+            # a TGZ without metadata never finished storing, it goes first
+            metadata = path.with_suffix('.json')
+            last_use = metadata.stat().st_mtime if metadata.exists() else 0
+
+            entries.append((last_use, stat.st_size, path, metadata))
+            total += stat.st_size
+
+        for last_use, size, tgz, metadata in sorted(entries, key=lambda entry: entry[0]):
+            if total <= budget:
+                break
+
+            if metadata.exists():
+                metadata.unlink()
+            tgz.unlink()
+
+            total -= size
+            evicted += size
+
+    if evicted > 0:
+        info(f'Evicted {evicted} bytes of cached TGZs, {total} bytes remain')
+
+    return evicted
@@ -0,0 +1,153 @@
+import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from logging import debug, info, warning, error, critical
+from pathlib import Path
+
+# the default number of concurrent file copies or deletions
+TRANSFER_THREADS = 8
+
+
+def same_filesystem(source, destination):
+    """
+    Check if a path could be renamed to a destination without copying
+    :param source: Existing path
+    :param destination: Path that may not exist yet
+    :return: True if both are on the same filesystem
+    """
+    parent = Path(destination)
+    while not parent.exists():
+        parent = parent.parent
+
+    return os.stat(source, follow_symlinks=False).st_dev == os.stat(parent).st_dev
+
+
+def move_merge(source, destination):
+    """
+    Rename a file or directory on the same filesystem, merging into an existing directory like rsync
+    :param source: File or directory to rename
+    :param destination: New path, existing files in it are replaced
+    """
+    if os.path.isdir(destination) and os.path.isdir(source) and not os.path.islink(source):
+        for entry in os.listdir(source):
+            move_merge(os.path.join(source, entry), os.path.join(destination, entry))
+        os.rmdir(source)
+    else:
+        os.replace(source, destination)
+
+
+def copy_merge(source, destination, executor):
+    """
+    Copy a file or directory across filesystems, preserving times and permissions like rsync -a
+    :param source: File or directory to copy
+    :param destination: New path, existing files in it are replaced
+    :param executor: ThreadPoolExecutor to copy the files with
+    :return: List of the copies' futures
+    """
+    if not os.path.isdir(source) or os.path.islink(source):
+        return [executor.submit(shutil.copy2, source, destination, follow_symlinks=False)]
+
+    copies = []
+    for root, dirs, files in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+
+        # os.walk lists symbolic links to directories as directories
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            copies.append(executor.submit(shutil.copy2, os.path.join(root, name), os.path.join(target, name),
+                                          follow_symlinks=False))
+
+    return copies
+
+
+def transfer(pattern, destination, n_threads=TRANSFER_THREADS):
+    """
+    Move everything matching a glob pattern into a directory, merging with what is already there
+    :param pattern: Glob pattern of the files and directories to transfer
+    :param destination: Directory to transfer into, created if needed
+    :param n_threads: Number of concurrent file copies across filesystems
+    :return: Number of matches transferred
+    """
+    sources = sorted(glob(pattern))
+    if len(sources) == 0:
+        warning(f'Nothing to transfer matches {pattern}')
+        return 0
+
+    os.makedirs(destination, exist_ok=True)
+
+    # renaming only changes directory entries, so it needs no copies at all,
+    # while copies leave the sources behind for remove_tree
+    copied = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        copies = []
+        for source in sources:
+            target = os.path.join(destination, os.path.basename(source))
+            if same_filesystem(source, destination):
+                debug(f'Renaming {source} to {target}')
+                move_merge(source, target)
+            else:
+                debug(f'Copying {source} to {target}')
+                copies += copy_merge(source, target, executor)
+                copied.append((source, target))
+
+        for copy in copies:
+            copy.result()
+
+    # directory times change as files land in them, so they are set last
+    for source, target in copied:
+        if os.path.isdir(source) and not os.path.islink(source):
+            for root, _, _ in sorted(os.walk(source), reverse=True):
+                shutil.copystat(root, os.path.join(target, os.path.relpath(root, source)))
+
+    return len(sources)
+
+
+def transfer_file(source, destination):
+    """
+    Move one file to a new path, or copy it across filesystems
+    :param source: File to transfer
+    :param destination: New path of the file
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+    if same_filesystem(source, os.path.dirname(destination)):
+        os.replace(source, destination)
+    else:
+        shutil.copy2(source, destination)
+
+
+def remove_tree(path, n_threads=TRANSFER_THREADS):
+    """
+    Delete a directory tree, unlinking the files of its directories concurrently
+    :param path: Directory to delete
+    :param n_threads: Number of concurrent directories to unlink files in
+    """
+    if not os.path.lexists(path):
+        return
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        os.unlink(path)
+        return
+
+    def unlink_all(root, names):
+        for name in names:
+            os.unlink(os.path.join(root, name))
+
+    directories = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        deletions = []
+        for root, dirs, files in os.walk(path):
+            directories.append(root)
+
+            # symbolic links to directories are unlinked, never followed
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            deletions.append(executor.submit(unlink_all, root, files + links))
+
+        for deletion in deletions:
+            deletion.result()
+
+    # os.walk lists every directory before its subdirectories
+    for directory in reversed(directories):
+        os.rmdir(directory)
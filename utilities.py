@@ -63,6 +63,69 @@ def available(path):
         return Path(path).absolute()
 
 
+def bids_session_index(rawdata, manifest=None):
+    """
+    Index the sub-*/ses-* session directories of a BIDS rawdata directory
+    :param rawdata: BIDS rawdata directory to index
+    :param manifest: Optional JSON file caching the index between calls, only
+        subject directories with a changed modification time are re-listed
+    :return: Set of (sub-*, ses-*) directory name tuples
+    """
+    import json
+
+    rawdata = Path(rawdata).resolve()
+
+    cached = {}
+    if manifest is not None and Path(manifest).exists():
+        with open(manifest, 'r') as f:
+            contents = json.load(f)
+
+        if contents.get('rawdata') == str(rawdata):
+            cached = contents['subjects']
+
+    subjects = {}
+    with os.scandir(rawdata) as entries:
+        for entry in entries:
+            if not (entry.name.startswith('sub-') and entry.is_dir()):
+                continue
+
+            # adding or removing a session directory changes this mtime
+            mtime_ns = entry.stat().st_mtime_ns
+
+            if entry.name in cached and cached[entry.name]['mtime_ns'] == mtime_ns:
+                sessions = cached[entry.name]['sessions']
+            else:
+                with os.scandir(entry.path) as sub_entries:
+                    sessions = sorted([sub_entry.name for sub_entry in sub_entries
+                                       if sub_entry.name.startswith('ses-') and sub_entry.is_dir()])
+
+            subjects[entry.name] = {'mtime_ns': mtime_ns, 'sessions': sessions}
+
+    if manifest is not None:
+        import tempfile
+
+        try:
+            Path(manifest).parent.mkdir(parents=True, exist_ok=True)
+
+            # a unique temporary name per call, since threads of one process
+            # may update the same manifest at the same time
+            fd, temp_manifest = tempfile.mkstemp(dir=Path(manifest).parent,
+                                                 prefix=f'.{Path(manifest).name}.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'rawdata': str(rawdata), 'subjects': subjects}, f)
+                # mkstemp only lets the owner read it
+                os.chmod(temp_manifest, 0o644)
+                os.replace(temp_manifest, manifest)
+            except OSError:
+                os.unlink(temp_manifest)
+                raise
+        except OSError:
+            pass
+
+    return set([(sub, ses) for sub in subjects for ses in subjects[sub]['sessions']])
+
+
 def compare_json_files(a, b):
     import json
     with open(a, 'r') as file: